@@ -10,26 +10,44 @@ Mặc định:
   - max_orders = 4 (trả tối đa 4 đơn hợp lệ)
 """
 
-from flask import Flask, request, jsonify
-import requests, re, time
+import time
+_BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, request, jsonify, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
+# asyncio / http.cookiejar import trễ (engine async, http_session) cho cold start nhẹ
+import re, os, io, csv, json, base64, hashlib, hmac, sqlite3, tempfile, threading, zlib, dataclasses
+from contextlib import asynccontextmanager
+from types import MappingProxyType
 from collections import deque
+from functools import partial, wraps
+from operator import attrgetter
 from datetime import datetime
-from typing import Optional
+from typing import Any, Optional
 
 # ========= Flask =========
 app = Flask(__name__)
 
 # ========= Shopee API config =========
 UA   = "Android app Shopee appver=28320 app_type=1"
-BASE = "https://shopee.vn/api/v4"
+BASE = os.environ.get("SHOPEE_BASE") or "https://shopee.vn/api/v4"   # override để chạy với stub server local
 CHECK_URL = f"{BASE}/account/basic/get_account_info"
+ORDER_LIST_URL = f"{BASE}/order/get_all_order_and_checkout_list"
+ORDER_DETAIL_URL = f"{BASE}/order/get_order_detail"
 SHOPEE_CONFIRM_URL = f"{BASE}/order/action/confirm_order_delivered/"
 SHOPEE_CONFIRM_UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/145.0.0.0 Safari/537.36"
 
 DEFAULT_LIST_LIMIT = 5
 DEFAULT_MAX_ORDERS = 4
 
+# lazy (mặc định): chỉ import `requests` khi có request đầu tiên ra Shopee -> /api/ping cold start nhẹ hơn
+# eager: import + dựng pool ngay lúc load module
+STARTUP_MODE = (os.environ.get("STARTUP_MODE") or "lazy").strip().lower()
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE") or 32)
+
 # ================= HTTP =================
+_RE_COOKIE_SPLIT = re.compile(r"[;\n]+")
+
 def sanitize_cookie(cookie: str) -> str:
     raw = str(cookie or "").strip()
     if not raw:
@@ -38,7 +56,7 @@ def sanitize_cookie(cookie: str) -> str:
     if raw.lower().startswith("cookie:"):
         raw = raw.split(":", 1)[1].strip()
     parts = []
-    for piece in re.split(r"[;\n]+", raw):
+    for piece in _RE_COOKIE_SPLIT.split(raw):
         item = piece.strip()
         if not item or "=" not in item:
             continue
@@ -50,9 +68,9 @@ def sanitize_cookie(cookie: str) -> str:
         parts.append(f"{k}={v}")
     return "; ".join(parts)
 
-def cookie_map(cookie: str) -> dict:
+def _cookie_pairs(sanitized: str) -> dict:
     out = {}
-    for part in sanitize_cookie(cookie).split(";"):
+    for part in sanitized.split(";"):
         item = part.strip()
         if "=" not in item:
             continue
@@ -61,58 +79,616 @@ def cookie_map(cookie: str) -> dict:
             out[k.strip()] = v.strip()
     return out
 
-def build_headers(cookie: str) -> dict:
-    ck = sanitize_cookie(cookie)
-    return {
-        "User-Agent": UA,
-        "Cookie": ck,
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Referer": "https://shopee.vn/",
-    }
+def cookie_map(cookie) -> dict:
+    return dict(as_cookie_context(cookie).keys)
 
-def build_order_header_variants(cookie: str):
-    ck = sanitize_cookie(cookie)
-    ckm = cookie_map(ck)
-    csrf = str(ckm.get("csrftoken") or ckm.get("CSRFTOKEN") or "").strip()
-
-    v1 = build_headers(ck)
-    v2 = {
-        "User-Agent": "Mozilla/5.0",
-        "Cookie": ck,
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Referer": "https://shopee.vn/",
-        "X-API-SOURCE": "pc",
-    }
-    v3 = {
-        **v2,
-        "Origin": "https://shopee.vn",
-        "X-Requested-With": "XMLHttpRequest",
-    }
-    if csrf:
-        v3["x-csrftoken"] = csrf
-        v3["X-CSRFToken"] = csrf
+SESSION_KEYS = ("SPC_U", "SPC_ST", "SPC_EC")
+SESSION_TOKEN_KEYS = ("SPC_ST", "SPC_EC")   # token do Shopee cấp, client không tự đặt được như SPC_U
 
-    return [v1, v2, v3]
+def cookie_identity(cookie) -> str:
+    return as_cookie_context(cookie).identity
 
-def http_get(url: str, headers: dict, params: dict | None = None, timeout: int = 12):
+# header template dựng 1 lần / process, mỗi call chỉ copy + gắn Cookie
+_HEADERS_APP = {
+    "User-Agent": UA,
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Referer": "https://shopee.vn/",
+}
+_HEADERS_PC = {
+    "User-Agent": "Mozilla/5.0",
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Referer": "https://shopee.vn/",
+    "X-API-SOURCE": "pc",
+}
+_HEADERS_PC_XHR = {
+    **_HEADERS_PC,
+    "Origin": "https://shopee.vn",
+    "X-Requested-With": "XMLHttpRequest",
+}
+
+_HEADERS_CONFIRM = {
+    "Accept": "application/json, text/plain, */*",
+    "Content-Type": "application/json",
+    "Origin": "https://shopee.vn",
+    "Referer": "https://shopee.vn/user/purchase/?type=8",
+    "User-Agent": SHOPEE_CONFIRM_UA,
+    "X-API-SOURCE": "pc",
+    "X-Requested-With": "XMLHttpRequest",
+    "X-Shopee-Language": "vi",
+    "x-shopee-language": "vi",
+}
+
+class CookieContext:
+    """
+    Cookie parse đúng 1 lần cho mỗi request/batch rồi truyền qua mọi hàm:
+    chuỗi đã sanitize, key map, csrf, identity (hash ổn định), session (hash token phiên) và các bộ header
+    dựng sẵn, read-only (account / list+detail / confirm).
+    """
+    __slots__ = ("cookie", "keys", "csrf", "identity", "session",
+                 "account_headers", "order_header_variants", "confirm_headers")
+
+    def __init__(self, cookie: str, sanitized: bool = False):
+        ck = str(cookie or "").strip() if sanitized else sanitize_cookie(cookie)
+        keys = _cookie_pairs(ck)
+        csrf = str(keys.get("csrftoken") or keys.get("CSRFTOKEN") or "").strip()
+        self.cookie = ck
+        self.keys = MappingProxyType(keys)
+        self.csrf = csrf
+        self.identity = self._identity(ck, keys)
+        self.session = self._identity(ck, keys, SESSION_TOKEN_KEYS)
+
+        csrf_headers = {"x-csrftoken": csrf, "X-CSRFToken": csrf} if csrf else {}
+        self.account_headers = MappingProxyType({**_HEADERS_APP, "Cookie": ck})
+        self.order_header_variants = (
+            self.account_headers,
+            MappingProxyType({**_HEADERS_PC, "Cookie": ck}),
+            MappingProxyType({**_HEADERS_PC_XHR, "Cookie": ck, **csrf_headers}),
+        )
+        self.confirm_headers = MappingProxyType({
+            **_HEADERS_CONFIRM,
+            "Cookie": ck,
+            **({"X-CSRFToken": csrf, "x-csrftoken": csrf} if csrf else {}),
+        })
+
+    @staticmethod
+    def _identity(ck: str, keys: dict, names=SESSION_KEYS) -> str:
+        # ưu tiên SPC_U (user id), sau đó session key, cuối cùng hash cả chuỗi
+        for k in names:
+            v = str(keys.get(k) or "").strip()
+            if v and v != "-":
+                return f"{k}:{v}" if k == "SPC_U" else f"{k}:" + hashlib.sha1(v.encode("utf-8")).hexdigest()
+        return "ck:" + hashlib.sha1(ck.encode("utf-8")).hexdigest()
+
+    def __bool__(self):
+        return bool(self.cookie)
+
+def as_cookie_context(cookie) -> CookieContext:
+    if isinstance(cookie, CookieContext):
+        return cookie
+    return CookieContext(cookie)
+
+def build_headers(cookie) -> dict:
+    return dict(as_cookie_context(cookie).account_headers)
+
+def build_order_header_variants(cookie):
+    return [dict(h) for h in as_cookie_context(cookie).order_header_variants]
+
+_requests = None
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def requests_module():
+    global _requests
+    if _requests is None:
+        import requests as _rq
+        _requests = _rq
+    return _requests
+
+def http_session():
+    """requests.Session dùng chung (connection pool keep-alive) cho cả process."""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                import http.cookiejar
+                rq = requests_module()
+                sess = rq.Session()
+                # mỗi call tự gửi header Cookie riêng -> không lưu Set-Cookie vào jar dùng chung
+                sess.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                adapter = rq.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+                sess.mount("https://", adapter)
+                sess.mount("http://", adapter)
+                _http_session = sess
+    return _http_session
+
+# ================= Circuit breaker (theo endpoint Shopee) =================
+# Mỗi URL upstream 1 breaker: trong BREAKER_WINDOW call gần nhất, tỉ lệ lỗi (mạng / 5xx / 429) hoặc
+# tỉ lệ call chậm (>= BREAKER_SLOW_S) vượt ngưỡng -> mở BREAKER_OPEN_S giây: call bị từ chối ngay (503 circuit_open),
+# hết thời gian thì cho 1 call thăm dò (half-open); thành công -> đóng lại, lỗi -> mở tiếp.
+UPSTREAM_BREAKER = (os.environ.get("UPSTREAM_BREAKER") or "on").strip().lower() not in ("0", "off", "false", "no")
+BREAKER_WINDOW = int(os.environ.get("BREAKER_WINDOW") or 20)
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS") or 8)
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE") or 0.5)
+BREAKER_SLOW_S = float(os.environ.get("BREAKER_SLOW_S") or 6)
+BREAKER_SLOW_RATE = float(os.environ.get("BREAKER_SLOW_RATE") or 0.5)
+BREAKER_OPEN_S = float(os.environ.get("BREAKER_OPEN_S") or 15)
+
+def is_upstream_failure(status) -> bool:
+    return not status or status == 429 or status >= 500
+
+class CircuitBreaker:
+    """Breaker closed / open / half_open cho 1 endpoint; dùng chung giữa các thread."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self._window = deque(maxlen=max(1, BREAKER_WINDOW))   # (failed, slow)
+        self._lock = threading.Lock()
+        self._open_until = 0.0
+        self._probe_inflight = False
+        self._epoch = 0          # tăng mỗi lần mở; vé mang epoch lúc allow()
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def allow(self) -> Optional[tuple]:
+        """-> vé (epoch, probe) nếu được gọi, None nếu bị từ chối; vé phải đưa lại cho record()."""
+        with self._lock:
+            if self.state == "closed":
+                return (self._epoch, False)
+            if self.state == "open" and time.monotonic() >= self._open_until:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_inflight:
+                self._probe_inflight = True
+                return (self._epoch, True)
+            self.rejected += 1
+            return None
+
+    def record(self, ticket: tuple, status, elapsed: float):
+        failed = is_upstream_failure(status)
+        slow = elapsed >= BREAKER_SLOW_S
+        epoch, probe = ticket
+        with self._lock:
+            self.calls += 1
+            self.failures += failed
+            self.slow_calls += slow
+            # call bắt đầu trước lần mở gần nhất (epoch cũ) chỉ được tính vào bộ đếm
+            if epoch != self._epoch:
+                return
+            if probe:
+                self._probe_inflight = False
+                if failed or slow:
+                    self._trip()
+                else:
+                    self.state = "closed"
+                    self._window.clear()
+                return
+            if self.state != "closed":
+                return
+            self._window.append((failed, slow))
+            n = len(self._window)
+            if n < BREAKER_MIN_CALLS:
+                return
+            if (sum(f for f, _ in self._window) / n >= BREAKER_ERROR_RATE
+                    or sum(s for _, s in self._window) / n >= BREAKER_SLOW_RATE):
+                self._trip()
+
+    def _trip(self):
+        self.state = "open"
+        self._epoch += 1
+        self.opened += 1
+        self._open_until = time.monotonic() + BREAKER_OPEN_S
+        self._window.clear()
+
+    def retry_after(self) -> float:
+        return round(max(0.0, self._open_until - time.monotonic()), 2)
+
+    def rejection(self):
+        wait = self.retry_after()
+        msg = f"Shopee {self.name} dang loi, tam ngung goi (thu lai sau {wait:g}s)."
+        return 503, {"error": "circuit_open", "error_msg": msg, "message": msg, "retry_after": wait}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            n = len(self._window)
+            return {
+                "state": self.state,
+                "calls": self.calls,
+                "failures": self.failures,
+                "slow_calls": self.slow_calls,
+                "rejected": self.rejected,
+                "opened": self.opened,
+                "window_error_rate": round(sum(f for f, _ in self._window) / n, 3) if n else 0.0,
+                "window_slow_rate": round(sum(s for _, s in self._window) / n, 3) if n else 0.0,
+                "retry_after": self.retry_after() if self.state != "closed" else 0.0,
+            }
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def breaker_for(url: str) -> Optional[CircuitBreaker]:
+    if not UPSTREAM_BREAKER:
+        return None
+    key = url.split("?", 1)[0]
+    b = _breakers.get(key)
+    if b is None:
+        with _breakers_lock:
+            b = _breakers.get(key)
+            if b is None:
+                b = _breakers[key] = CircuitBreaker(key.rstrip("/").rsplit("/", 1)[-1])
+    return b
+
+def breaker_metrics() -> dict:
+    return {b.name: b.snapshot() for b in list(_breakers.values())}
+
+# ================= JSON codec =================
+# JSON_CODEC=auto (orjson nếu có cài, không thì stdlib) | orjson | stdlib; dùng cho body Shopee, response, cache.
+# Body JSON của Shopee decode thành RawJSON (dict + bytes gốc): khi raw được trả nguyên về client
+# (shopee_raw, shopee_full, api_data) encoder orjson chèn thẳng bytes gốc thay vì encode lại cả cây.
+JSON_CODEC = (os.environ.get("JSON_CODEC") or "auto").strip().lower()
+_orjson = None
+
+def orjson_module():
+    """orjson nếu được bật và có cài, không thì False."""
+    global _orjson
+    if _orjson is None:
+        mod = False
+        if JSON_CODEC in ("auto", "orjson"):
+            try:
+                import orjson as mod
+            except ImportError:
+                mod = False
+        _orjson = mod
+    return _orjson
+
+class RawJSON(dict):
+    """
+    dict decode từ body upstream, nhớ bytes gốc trong raw_bytes.
+    Sửa dict ở cấp trên cùng thì bỏ bytes gốc; cây con coi như read-only (code trong file không sửa raw).
+    """
+    __slots__ = ("raw_bytes",)
+
+    def __init__(self, data=(), raw_bytes: Optional[bytes] = None):
+        super().__init__(data)
+        self.raw_bytes = raw_bytes
+
+def _invalidating(name: str):
+    base = getattr(dict, name)
+
+    def method(self, *args, **kwargs):
+        self.raw_bytes = None
+        return base(self, *args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+for _name in ("__setitem__", "__delitem__", "__ior__", "pop", "popitem", "setdefault", "update", "clear"):
+    setattr(RawJSON, _name, _invalidating(_name))
+
+def json_loads_strict(data) -> tuple:
+    """-> (obj, strict): strict=True khi orjson decode được, tức bytes gốc là JSON hợp lệ (không NaN / Infinity)."""
+    mod = orjson_module()
+    if mod:
+        try:
+            return mod.loads(data), True
+        except mod.JSONDecodeError:
+            pass    # orjson chặt hơn stdlib (NaN / Infinity, UTF-8 lỗi...) -> thử lại bằng stdlib
+    return json.loads(data), False
+
+def json_loads(data):
+    return json_loads_strict(data)[0]
+
+def decode_json_body(data: bytes):
+    obj, strict = json_loads_strict(data)
+    if type(obj) is not dict:
+        return obj
+    if not strict:
+        # stdlib nhận cả NaN / Infinity: bytes gốc không chèn thẳng vào response được
+        return RawJSON(obj)
+    raw = data.strip()
+    # chỉ giữ bytes gốc khi là UTF-8 không BOM (JSON UTF-16/32 có byte 0 ở đầu)
+    return RawJSON(obj, raw if raw[:1] == b"{" and b"\x00" not in raw[:4] else None)
+
+def _orjson_default(default, o):
+    if isinstance(o, RawJSON):
+        fragment = getattr(_orjson, "Fragment", None)
+        if o.raw_bytes is not None and fragment is not None:
+            return fragment(o.raw_bytes)
+        return dict(o)
+    # OPT_PASSTHROUGH_SUBCLASS đẩy mọi subclass của dict/list/str/int vào đây
+    for base in (dict, list, str, int):
+        if isinstance(o, base):
+            return base(o)
+    if default is not None:
+        return default(o)
+    raise TypeError(f"Type is not JSON serializable: {type(o).__name__}")
+
+def json_dumps_bytes(obj, default=None, sort_keys: bool = False) -> bytes:
+    """JSON compact UTF-8; orjson nếu có (kèm passthrough RawJSON), lỗi / không có thì stdlib."""
+    mod = orjson_module()
+    if mod:
+        option = mod.OPT_PASSTHROUGH_SUBCLASS | mod.OPT_NON_STR_KEYS | (mod.OPT_SORT_KEYS if sort_keys else 0)
+        try:
+            return mod.dumps(obj, default=partial(_orjson_default, default), option=option)
+        except mod.JSONEncodeError:
+            pass    # int > 64 bit, ... -> stdlib
+    return json.dumps(obj, default=default, sort_keys=sort_keys, ensure_ascii=False,
+                      separators=(",", ":")).encode("utf-8")
+
+# ================= Đọc body upstream (stream, có giới hạn) =================
+# JSON đọc tối đa UPSTREAM_MAX_BODY byte (quá thì bỏ, trả lỗi body_too_large);
+# body không phải JSON (trang lỗi HTML...) chỉ giữ UPSTREAM_PREVIEW_BYTES byte đầu làm preview.
+UPSTREAM_MAX_BODY = int(os.environ.get("UPSTREAM_MAX_BODY") or 4 * 1024 * 1024)
+UPSTREAM_PREVIEW_BYTES = int(os.environ.get("UPSTREAM_PREVIEW_BYTES") or 2048)
+_READ_CHUNK = 64 * 1024
+
+def is_json_content(content_type: str) -> bool:
+    return "application/json" in (content_type or "")
+
+def body_limit(content_type: str) -> int:
+    return UPSTREAM_MAX_BODY if is_json_content(content_type) else UPSTREAM_PREVIEW_BYTES
+
+def declared_too_large(content_type: str, content_length) -> bool:
+    # Content-Length đã vượt giới hạn JSON -> bỏ luôn, không đọc
     try:
-        r = requests.get(url, headers=headers, params=params, timeout=timeout)
-        if "application/json" in (r.headers.get("Content-Type") or ""):
-            return r.status_code, r.json()
-        return r.status_code, {"raw": r.text}
-    except requests.RequestException as e:
-        return 0, {"error": str(e)}
+        return is_json_content(content_type) and int(content_length or 0) > UPSTREAM_MAX_BODY
+    except (TypeError, ValueError):
+        return False
 
-def http_post(url: str, headers: dict, payload: dict | None = None, timeout: int = 12):
+def read_capped(chunks, limit: int):
+    """Gom chunk tới tối đa limit byte rồi dừng. -> (bytes, truncated)."""
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) > limit:
+            del buf[limit:]
+            return bytes(buf), True
+    return bytes(buf), False
+
+def decode_upstream_body(status, content_type: str, data: bytes, truncated: bool, encoding: Optional[str] = None):
+    """-> (status, dict) giống http_get cũ; JSON quá lớn / hỏng -> status 0 + error."""
+    if is_json_content(content_type):
+        if truncated:
+            msg = f"Phan hoi Shopee qua lon (> {UPSTREAM_MAX_BODY} bytes), da bo qua."
+            return 0, {"error": "body_too_large", "error_msg": msg, "http_status": status}
+        try:
+            return status, decode_json_body(data)
+        except ValueError as e:
+            return 0, {"error": str(e)}
+    out = {"raw": data.decode(encoding or "utf-8", errors="replace")}
+    if truncated:
+        out["raw_truncated"] = True
+    return status, out
+
+# ================= Record / replay transport =================
+# HTTP_TRANSPORT=record: gọi Shopee thật và ghi (request, response, latency) vào corpus gzip JSONL;
+# HTTP_TRANSPORT=replay: không gọi mạng, trả lại response đã ghi (latency x REPLAY_LATENCY_SCALE).
+# Corpus không chứa header / cookie: mỗi phiên được đổi sang cookie tổng hợp (SPC_U=u1; SPC_ST=s1...), các key
+# nhạy cảm bị thay "<scrubbed>". Request vào /api/check-cookie, /api/confirm-received-sll cũng được ghi (đã đổi cookie)
+# để bench/replay_corpus.py chạy lại đúng luồng traffic thật trên corpus.
+HTTP_TRANSPORT = (os.environ.get("HTTP_TRANSPORT") or "live").strip().lower()
+TRANSPORT_CORPUS = os.environ.get("TRANSPORT_CORPUS") or os.path.join(tempfile.gettempdir(), "ngamiu_http_corpus.jsonl.gz")
+REPLAY_LATENCY_SCALE = float(os.environ.get("REPLAY_LATENCY_SCALE") or 1.0)
+_SCRUB_KEYS = frozenset(("cookie", "set-cookie", "csrftoken", "spc_ec", "spc_st", "spc_u", "spc_f", "token", "phone", "email"))
+
+def scrub(obj):
+    if isinstance(obj, dict):
+        return {k: ("<scrubbed>" if str(k).lower() in _SCRUB_KEYS else scrub(v)) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [scrub(v) for v in obj]
+    return obj
+
+RECORDED_ROUTES = ("/api/check-cookie", "/api/confirm-received-sll")
+
+def exchange_key(method: str, url: str, account: str, kw: dict) -> str:
+    """Khóa của 1 request trong corpus: method + URL + nhãn phiên tổng hợp + params/body (không có cookie)."""
+    req = json.dumps({"p": kw.get("params"), "j": scrub(kw.get("json"))}, sort_keys=True, default=str)
+    return f"{method} {url.split('?', 1)[0]} {account} {req}"
+
+def _header_cookie(headers) -> str:
+    return (headers or {}).get("Cookie") or ""
+
+class ExchangeRecorder:
+    """Ghi nối tiếp vào 1 file gzip (flush từng dòng để không mất dữ liệu khi process bị dừng)."""
+
+    def __init__(self, path: str = TRANSPORT_CORPUS):
+        self.path = path
+        self.count = 0
+        self.inbound = 0
+        self._fh = None
+        self._sessions = {}        # ctx.session -> "s<n>"
+        self._users = {}           # ctx.identity -> "u<n>" (giữ nguyên nhóm cookie cùng tài khoản)
+        self._lock = threading.Lock()
+
+    def _label(self, table: dict, key: str, prefix: str) -> str:
+        with self._lock:
+            label = table.get(key)
+            if label is None:
+                label = table[key] = f"{prefix}{len(table) + 1}"
+            return label
+
+    def account(self, cookie) -> str:
+        """Nhãn phiên tổng hợp của cookie thật; trùng với SPC_ST của synthetic_cookie()."""
+        if not cookie:
+            return "-"
+        return self._label(self._sessions, as_cookie_context(cookie).session, "s")
+
+    def synthetic_cookie(self, cookie) -> str:
+        ctx = as_cookie_context(cookie)
+        return f"SPC_U={self._label(self._users, ctx.identity, 'u')}; SPC_ST={self.account(ctx.cookie)}"
+
+    def synthetic_payload(self, payload: dict) -> dict:
+        """Body request vào với cookie đổi sang cookie tổng hợp; bỏ cursor (gắn với danh sách cookie thật)."""
+        out = scrub({k: v for k, v in payload.items() if k not in ("cookie", "cookies", "cookies_text", "cursor")})
+        cookies = [self.synthetic_cookie(ck) for ck in parse_cookie_inputs(payload)]
+        if "cookie" in payload and len(cookies) == 1:
+            out["cookie"] = cookies[0]
+        elif cookies:
+            out["cookies"] = cookies
+        return out
+
+    def _write(self, entry: dict):
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if self._fh is None:
+                import atexit, gzip
+                self._fh = gzip.open(self.path, "at", encoding="utf-8")
+                atexit.register(self.close)
+            self._fh.write(line + "\n")
+            self._fh.flush()
+
+    def record(self, method: str, url: str, headers, kw: dict, result, elapsed: float):
+        status, body = result
+        self._write({
+            "k": exchange_key(method, url, self.account(_header_cookie(headers)), kw),
+            "s": status,
+            "r": json_dumps_bytes(scrub(body), default=str).decode("utf-8"),
+            "ms": round(elapsed * 1000, 2),
+        })
+        with self._lock:
+            self.count += 1
+
+    def record_inbound(self, path: str, payload: dict, status: int, elapsed: float):
+        self._write({"in": path, "b": self.synthetic_payload(payload), "s": status, "ms": round(elapsed * 1000, 2)})
+        with self._lock:
+            self.inbound += 1
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+class ReplayCorpus:
+    """Nạp corpus vào bộ nhớ; cùng 1 khóa có nhiều bản ghi thì trả lần lượt theo thứ tự đã ghi (xoay vòng)."""
+
+    def __init__(self, path: str = TRANSPORT_CORPUS):
+        import gzip
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}         # key -> [(status, body_json, ms)]
+        self.inbound = []          # request vào đã ghi: {"in": path, "b": body, "s": status, "ms": latency}
+        self._next = {}
+        self._lock = threading.Lock()
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    e = json.loads(line)
+                    if "in" in e:
+                        self.inbound.append(e)
+                    else:
+                        self._entries.setdefault(e["k"], []).append((e["s"], e["r"], float(e.get("ms") or 0)))
+        except (OSError, EOFError, ValueError):
+            # corpus thiếu / ghi dở: phần đọc được vẫn dùng, còn lại là replay_miss
+            pass
+
+    def __len__(self):
+        return sum(len(v) for v in self._entries.values())
+
+    def lookup(self, method: str, url: str, headers, kw: dict):
+        """-> (status, body, độ trễ giây cần mô phỏng). Cookie là cookie tổng hợp: SPC_ST chính là nhãn phiên."""
+        cookie = _header_cookie(headers)
+        account = (as_cookie_context(cookie).keys.get("SPC_ST") or "-") if cookie else "-"
+        key = exchange_key(method, url, account, kw)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.misses += 1
+                return 0, {"error": "replay_miss", "error_msg": "Khong co ban ghi cho request nay trong corpus."}, 0.0
+            i = self._next.get(key, 0)
+            self._next[key] = (i + 1) % len(entries)
+            self.hits += 1
+        status, body, ms = entries[i]
+        # parse lại mỗi lần: mỗi caller có dict riêng, chi phí CPU giống khi đọc body thật
+        return status, decode_json_body(body.encode("utf-8")), max(0.0, ms / 1000 * REPLAY_LATENCY_SCALE)
+
+_recorder = None
+_replay_corpus = None
+_transport_lock = threading.Lock()
+
+def get_recorder() -> ExchangeRecorder:
+    global _recorder
+    if _recorder is None:
+        with _transport_lock:
+            if _recorder is None:
+                _recorder = ExchangeRecorder()
+    return _recorder
+
+def get_replay_corpus() -> ReplayCorpus:
+    global _replay_corpus
+    if _replay_corpus is None:
+        with _transport_lock:
+            if _replay_corpus is None:
+                _replay_corpus = ReplayCorpus()
+    return _replay_corpus
+
+def transport_metrics() -> dict:
+    out = {"mode": HTTP_TRANSPORT, "corpus": TRANSPORT_CORPUS if HTTP_TRANSPORT != "live" else None}
+    if _recorder is not None:
+        out.update(recorded=_recorder.count, recorded_inbound=_recorder.inbound)
+    if _replay_corpus is not None:
+        out.update(replay_entries=len(_replay_corpus), replay_hits=_replay_corpus.hits, replay_misses=_replay_corpus.misses)
+    return out
+
+@app.before_request
+def _record_inbound_start():
+    if HTTP_TRANSPORT == "record" and request.path in RECORDED_ROUTES:
+        g.record_t0 = time.perf_counter()
+
+@app.after_request
+def _record_inbound_end(resp):
+    t0 = g.pop("record_t0", None)
+    if t0 is not None:
+        payload = request.get_json(silent=True)
+        if isinstance(payload, dict):
+            get_recorder().record_inbound(request.path, payload, resp.status_code, time.perf_counter() - t0)
+    return resp
+
+def _http_send_live(method: str, url: str, headers: dict, timeout, kw: dict):
+    """-> (status upstream thật cho breaker, (status, body))."""
+    rq = requests_module()
     try:
-        r = requests.post(url, headers=headers, json=(payload or {}), timeout=timeout)
-        if "application/json" in (r.headers.get("Content-Type") or ""):
-            return r.status_code, r.json()
-        return r.status_code, {"raw": r.text}
-    except requests.RequestException as e:
-        return 0, {"error": str(e)}
+        with http_session().request(method, url, headers=headers, timeout=timeout, stream=True, **kw) as r:
+            ctype = r.headers.get("Content-Type") or ""
+            if declared_too_large(ctype, r.headers.get("Content-Length")):
+                data, truncated = b"", True
+            else:
+                data, truncated = read_capped(r.iter_content(_READ_CHUNK), body_limit(ctype))
+            return r.status_code, decode_upstream_body(r.status_code, ctype, data, truncated, r.encoding)
+    except rq.RequestException as e:
+        return 0, (0, {"error": str(e)})
+
+def _http_send(method: str, url: str, headers: dict, timeout, **kw):
+    breaker = breaker_for(url)
+    ticket = breaker.allow() if breaker is not None else None
+    if breaker is not None and ticket is None:
+        return breaker.rejection()
+    status, t0 = 0, time.perf_counter()
+    try:
+        if HTTP_TRANSPORT == "replay":
+            status, body, delay = get_replay_corpus().lookup(method, url, headers, kw)
+            time.sleep(delay)
+            return status, body
+        status, result = _http_send_live(method, url, headers, timeout, kw)
+        if HTTP_TRANSPORT == "record":
+            get_recorder().record(method, url, headers, kw, result, time.perf_counter() - t0)
+        return result
+    finally:
+        if breaker is not None:
+            breaker.record(ticket, status, time.perf_counter() - t0)
+
+def http_get(url: str, headers: dict, params: dict | None = None, timeout: int = 12):
+    return _http_send("GET", url, headers, timeout, params=params)
+
+def http_post(url: str, headers: dict, payload: dict | None = None, timeout: int = 12):
+    return _http_send("POST", url, headers, timeout, json=(payload or {}))
 
 # ================= JSON helpers =================
 def find_first_key(data, key):
@@ -141,6 +717,209 @@ def bfs_values_by_key(data, target_keys=("order_id",)):
             dq.extend(cur)
     return out
 
+# ================= Order detail view =================
+class OrderDetailView:
+    """
+    Bọc 1 order detail raw, mỗi thứ chỉ tính 1 lần (lazy):
+      - index key -> value đầu tiên (cùng thứ tự BFS với find_first_key)
+      - tập string có trong cây (thay cho tree_contains_str)
+      - status / buyer_cancelled / delivered / timeline / summary
+    Tất cả route + classifier dùng chung 1 view cho mỗi detail.
+    """
+    __slots__ = ("raw", "fallback_order_id", "_keys", "_strs", "_status",
+                 "_cancelled", "_timeline", "_summary")
+
+    def __init__(self, detail_raw, fallback_order_id: Optional[str] = None):
+        self.raw = detail_raw if isinstance(detail_raw, dict) else {}
+        self.fallback_order_id = fallback_order_id
+        self._keys = None
+        self._strs = None
+        self._status = None
+        self._cancelled = None
+        self._timeline = None
+        self._summary = None
+
+    def _build_index(self):
+        keys, strs = {}, set()
+        dq = deque([self.raw])
+        while dq:
+            cur = dq.popleft()
+            if isinstance(cur, dict):
+                for k, v in cur.items():
+                    if k not in keys:
+                        keys[k] = v
+                    if isinstance(v, (dict, list)):
+                        dq.append(v)
+                    elif isinstance(v, str):
+                        strs.add(v)
+            elif isinstance(cur, list):
+                for x in cur:
+                    if isinstance(x, (dict, list)):
+                        dq.append(x)
+                    elif isinstance(x, str):
+                        strs.add(x)
+        self._keys, self._strs = keys, strs
+
+    def first(self, key):
+        if self._keys is None:
+            self._build_index()
+        return self._keys.get(key)
+
+    def has_str(self, target: str) -> bool:
+        if self._strs is None:
+            self._build_index()
+        return target in self._strs
+
+    def first_of(self, keys):
+        """first(k1) or first(k2) or ... (hết giá trị truthy thì trả giá trị của key cuối)."""
+        val = None
+        for k in keys:
+            val = self.first(k)
+            if val:
+                return val
+        return val
+
+    @property
+    def status(self):
+        if self._status is None:
+            self._status = build_status_text_and_color(self)
+        return self._status
+
+    @property
+    def timeline(self):
+        if self._timeline is None:
+            self._timeline = build_rich_timeline(self.raw)
+        return self._timeline
+
+    @property
+    def buyer_cancelled(self) -> bool:
+        if self._cancelled is None:
+            self._cancelled = is_buyer_cancelled(self)
+        return self._cancelled
+
+    @property
+    def delivered(self) -> bool:
+        return is_detail_delivered(self)
+
+    def summary(self) -> "OrderSummary":
+        if self._summary is None:
+            self._summary = _pick_columns(self)
+        return self._summary.copy()
+
+def as_detail_view(detail, fallback_order_id: Optional[str] = None) -> OrderDetailView:
+    if isinstance(detail, OrderDetailView):
+        return detail
+    return OrderDetailView(detail, fallback_order_id=fallback_order_id)
+
+# ================= Result records =================
+class _Record:
+    """
+    Base của các record dataclass(slots=True) bên dưới: thêm truy cập kiểu dict
+    (row["x"], row.get("x")) để code cũ chạy y nguyên.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def copy(self):
+        return dataclasses.replace(self)
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+# Mỗi record là dataclass(slots=True): ít bộ nhớ hơn dict mỗi row (xem bench/bench_records.py);
+# __init__ keyword-only, field thiếu mặc định None, field lạ -> TypeError.
+@dataclasses.dataclass(slots=True, kw_only=True)
+class OrderSummary(_Record):
+    status_text: Optional[str] = None
+    status_color: Optional[str] = None
+    cod_amount: Optional[int] = None
+    cod_display: Optional[str] = None
+    shipping_address: Optional[str] = None
+    shipping_name: Optional[str] = None
+    shipping_phone: Optional[str] = None
+    shipper_name: Optional[str] = None
+    shipper_phone: Optional[str] = None
+    product_image: Optional[str] = None
+    tracking_no: Optional[str] = None
+    shop_username: Optional[str] = None
+    shop_id: Optional[Any] = None
+    product_name: Optional[str] = None
+    timeline_preview: Optional[list] = None
+    timeline_full: Optional[list] = None
+    order_time: Optional[Any] = None
+    order_code: Optional[str] = None
+    order_id: Optional[str] = None
+    shopee_raw: Optional[Any] = None
+
+@dataclasses.dataclass(slots=True, kw_only=True)
+class CookieRow(_Record):
+    index: Optional[int] = None
+    cookie: Optional[str] = None
+    cookie_preview: Optional[str] = None
+    live: Optional[bool] = None
+    delivered_count: Optional[int] = None
+    confirmed_count: Optional[int] = None
+    already_count: Optional[int] = None
+    failed_count: Optional[int] = None
+    note: Optional[str] = None
+    order_api_error: Optional[str] = None
+    alias_of: Optional[int] = None
+
+@dataclasses.dataclass(slots=True, kw_only=True)
+class OrderRow(_Record):
+    index: Optional[int] = None
+    cookie_preview: Optional[str] = None
+    order_id: Optional[str] = None
+    tracking_no: Optional[str] = None
+    status_text: Optional[str] = None
+    ok: Optional[bool] = None
+    state: Optional[str] = None
+    result_text: Optional[str] = None
+    api_data: Optional[Any] = None
+
+class RecordJSONProvider(DefaultJSONProvider):
+    """
+    jsonify() serialize thẳng các record, không cần dựng dict trung gian ở route.
+    Có orjson: encode / decode qua json_dumps_bytes / json_loads (response là UTF-8, không escape \\uXXXX).
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, _Record):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs or not orjson_module():
+            return super().dumps(obj, **kwargs)
+        return json_dumps_bytes(obj, default=self.default, sort_keys=self.sort_keys).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return super().loads(s, **kwargs) if kwargs else json_loads(s)
+
+    def response(self, *args, **kwargs):
+        if not orjson_module() or self._app.debug or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = json_dumps_bytes(obj, default=self.default, sort_keys=self.sort_keys)
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+app.json = RecordJSONProvider(app)
+
 def as_text(val):
     if isinstance(val, dict):
         return (
@@ -160,6 +939,8 @@ def as_text(val):
             return f
     return val
 
+_RE_IMAGE_HASH = re.compile(r"[A-Za-z0-9\-_]{20,}")
+
 def normalize_image_url(s):
     if not isinstance(s, str) or not s:
         return None
@@ -170,7 +951,7 @@ def normalize_image_url(s):
         return "https://cf.shopee.vn" + s
     if s.startswith("http"):
         return s
-    if re.fullmatch(r"[A-Za-z0-9\-_]{20,}", s):
+    if _RE_IMAGE_HASH.fullmatch(s):
         return f"https://cf.shopee.vn/file/{s}"
     return s
 
@@ -184,20 +965,30 @@ def fmt_ts(ts):
             return str(ts)
     return str(ts) if ts is not None else None
 
+_RE_STATUS_PREFIX = re.compile(r"^tình trạng\s*:?\s*", re.I)
+_RE_STATUS_EMOJI = re.compile(r"^[\s\N{VARIATION SELECTOR-16}\uFE0F\U0001F300-\U0001FAFF]+")
+_RE_SHOPEE_PROCESSING = (
+    re.compile(r"đơn\s*hàng.*đang.*(được)?\s*xử lý.*shopee"),
+    re.compile(r"processing.*by.*shopee"),
+)
+_RE_TO_SHIP = (
+    re.compile(r"(chuẩn|chuan)\s*bi.*h(à|a)ng"),
+    re.compile(r"ch(ờ|o)\s*shop\s*g(ử|u)i"),
+    re.compile(r"người\s*g(ử|u)i\s*đang\s*chuẩn\s*bị\s*h(à|a)ng"),
+    re.compile(r"(prepar|packing|to\s*ship|ready\s*to\s*ship)"),
+)
+
 def normalize_status_text(status: str) -> str:
     if not isinstance(status, str):
         return ""
     s = status.strip()
-    s = re.sub(r"^tình trạng\s*:?\s*", "", s, flags=re.I)
-    s = re.sub(r"^[\s\N{VARIATION SELECTOR-16}\uFE0F\U0001F300-\U0001FAFF]+", "", s)
+    s = _RE_STATUS_PREFIX.sub("", s)
+    s = _RE_STATUS_EMOJI.sub("", s)
     return s.strip()
 
 def is_shopee_processing_text(status: str) -> bool:
     s = normalize_status_text(status).lower()
-    return bool(
-        re.search(r"đơn\s*hàng.*đang.*(được)?\s*xử lý.*shopee", s)
-        or re.search(r"processing.*by.*shopee", s)
-    )
+    return any(rx.search(s) for rx in _RE_SHOPEE_PROCESSING)
 
 # ================= Status map (Shopee CODE MAP) =================
 CODE_MAP = {
@@ -248,35 +1039,27 @@ def tree_contains_str(data, target: str) -> bool:
         return data == target
     return False
 
-def is_buyer_cancelled(detail_raw: dict) -> bool:
-    d = detail_raw if isinstance(detail_raw, dict) else {}
-    if tree_contains_str(d, "order_status_text_cancelled_by_buyer"):
+CANCELLED_BY_BUYER_LABEL = "order_status_text_cancelled_by_buyer"
+DELIVERED_LABELS = ("label_order_delivered", "order_status_text_to_receive_delivery_done")
+CANCEL_BY_KEYS = ("cancel_by", "canceled_by", "cancel_user_role", "initiator", "operator_role", "operator")
+CANCEL_REASON_KEYS = ("cancel_reason", "buyer_cancel_reason", "cancel_desc", "cancel_description", "reason")
+
+def is_buyer_cancelled(detail_raw) -> bool:
+    d = as_detail_view(detail_raw)
+    if d.has_str(CANCELLED_BY_BUYER_LABEL):
         return True
 
-    who = (
-        find_first_key(d, "cancel_by")
-        or find_first_key(d, "canceled_by")
-        or find_first_key(d, "cancel_user_role")
-        or find_first_key(d, "initiator")
-        or find_first_key(d, "operator_role")
-        or find_first_key(d, "operator")
-    )
+    who = d.first_of(CANCEL_BY_KEYS)
     if isinstance(who, dict):
         who = as_text(who)
     who_s = (str(who or "")).lower()
 
-    reason = (
-        find_first_key(d, "cancel_reason")
-        or find_first_key(d, "buyer_cancel_reason")
-        or find_first_key(d, "cancel_desc")
-        or find_first_key(d, "cancel_description")
-        or find_first_key(d, "reason")
-    )
+    reason = d.first_of(CANCEL_REASON_KEYS)
     if isinstance(reason, dict):
         reason = as_text(reason)
     reason_s = (str(reason or "")).lower()
 
-    status_label = (as_text(find_first_key(d, "status_label")) or "").lower()
+    status_label = (as_text(d.first("status_label")) or "").lower()
     is_cancel_status = (
         ("cancel" in status_label)
         or ("hủy" in status_label)
@@ -292,17 +1075,21 @@ def is_buyer_cancelled(detail_raw: dict) -> bool:
     return False
 
 # ================= Fetch orders (LIST LIMIT = 5) =================
-def fetch_orders_and_details(cookie: str, list_limit: int = DEFAULT_LIST_LIMIT, offset: int = 0):
+def fetch_orders_and_details(cookie, list_limit: int = DEFAULT_LIST_LIMIT, offset: int = 0,
+                             store=None, identity: Optional[str] = None, prune: bool = True):
     """
     list_limit=5 để nhẹ khi deploy Vercel.
+    Có store: đơn đã ở trạng thái chốt (FINAL_ORDER_STATES) lấy từ store, không gọi get_order_detail.
+    prune=False: detail giữ nguyên vẹn (include_raw=full); store chỉ giữ raw đã prune nên khi đó không đọc store.
     """
-    variants = build_order_header_variants(cookie)
-    list_url = f"{BASE}/order/get_all_order_and_checkout_list"
+    ctx = as_cookie_context(cookie)
+    variants = order_variants(ctx)
 
     list_status, data1 = 0, {}
-    for headers in variants:
-        list_status, data1 = http_get(list_url, headers, params={"limit": int(list_limit), "offset": int(offset)})
+    for idx, headers in variants:
+        list_status, data1 = http_get(ORDER_LIST_URL, headers, params={"limit": int(list_limit), "offset": int(offset)})
         if list_status == 200 and isinstance(data1, dict):
+            remember_variant(ctx, variants, idx)
             break
 
     order_ids = bfs_values_by_key(data1, ("order_id",)) if isinstance(data1, dict) else []
@@ -315,16 +1102,21 @@ def fetch_orders_and_details(cookie: str, list_limit: int = DEFAULT_LIST_LIMIT,
             uniq.append(oid)
 
     details = []
+    read_store = store is not None and identity and store_raw_usable(prune)
     for oid in uniq[: int(list_limit)]:
-        detail_url = f"{BASE}/order/get_order_detail"
-        detail_status, data2 = 0, {}
-        for headers in variants:
-            detail_status, data2 = http_get(detail_url, headers, params={"order_id": oid})
-            if detail_status == 200 and isinstance(data2, dict):
-                break
+        rec = store.get_final(identity, str(oid)) if read_store else None
+        if rec is not None:
+            details.append({
+                "order_id": oid,
+                "http_status": 200,
+                "raw": rec["raw"],
+                "from_store": True,
+            })
+            continue
+        data2, meta = fetch_order_detail_by_id(ctx, oid, prune=prune)
         details.append({
             "order_id": oid,
-            "http_status": detail_status,
+            "http_status": meta.get("status_code"),
             "raw": data2
         })
 
@@ -335,13 +1127,16 @@ def fetch_orders_and_details(cookie: str, list_limit: int = DEFAULT_LIST_LIMIT,
     }
 
 # ================= Extract COD =================
+COD_AMOUNT_KEYS = ("final_total", "total_amount", "amount", "cod_amount", "buyer_total_amount")
+
 def extract_cod_amount(d) -> int:
     """
     Shopee thường trả amount theo đơn vị nhỏ (x100000)
     => giữ đúng logic của bạn: amount//100000
     """
-    for key in ["final_total", "total_amount", "amount", "cod_amount", "buyer_total_amount"]:
-        val = find_first_key(d, key)
+    d = as_detail_view(d)
+    for key in COD_AMOUNT_KEYS:
+        val = d.first(key)
         if val is not None:
             try:
                 amount = int(val) if isinstance(val, (int, float, str)) else 0
@@ -349,7 +1144,7 @@ def extract_cod_amount(d) -> int:
                     return amount // 100000
             except Exception:
                 pass
-    info_card = find_first_key(d, "info_card")
+    info_card = d.first("info_card")
     if isinstance(info_card, dict):
         for key in ["final_total", "total"]:
             val = info_card.get(key)
@@ -425,9 +1220,12 @@ def build_rich_timeline(d):
     p = rows[:3] if len(rows) > 3 else rows
     return p, rows
 
+IMAGE_KEYS = ("image","img","thumb","thumbnail","cover","photo","pic","icon","product_image","item_image")
+
 def first_image(obj):
-    for k in ("image","img","thumb","thumbnail","cover","photo","pic","icon","product_image","item_image"):
-        v = find_first_key(obj, k)
+    obj = as_detail_view(obj)
+    for k in IMAGE_KEYS:
+        v = obj.first(k)
         if isinstance(v, str):
             return normalize_image_url(v)
         if isinstance(v, list):
@@ -439,7 +1237,7 @@ def first_image(obj):
                         u = x.get(kk)
                         if isinstance(u, str):
                             return normalize_image_url(u)
-    items = find_first_key(obj, "card_item_list") or find_first_key(obj, "items")
+    items = obj.first("card_item_list") or obj.first("items")
     if isinstance(items, list):
         for it in items:
             if isinstance(it, dict):
@@ -449,12 +1247,15 @@ def first_image(obj):
                         return normalize_image_url(u)
     return None
 
+TRACKING_NO_KEYS = ("tracking_number","tracking_no","tracking_num","trackingid","waybill","waybill_no","awb","billcode","bill_code","consignment_no","cn_number","shipment_no")
+
 def first_tracking_number(obj):
-    for k in ("tracking_number","tracking_no","tracking_num","trackingid","waybill","waybill_no","awb","billcode","bill_code","consignment_no","cn_number","shipment_no"):
-        v = find_first_key(obj, k)
+    obj = as_detail_view(obj)
+    for k in TRACKING_NO_KEYS:
+        v = obj.first(k)
         if isinstance(v, str) and v.strip():
             return v.strip()
-    tinfo = find_first_key(obj, "tracking_info")
+    tinfo = obj.first("tracking_info")
     if isinstance(tinfo, dict):
         t = tinfo.get("tracking_number") or tinfo.get("tracking_no")
         if isinstance(t, str) and t.strip():
@@ -462,8 +1263,9 @@ def first_tracking_number(obj):
     return None
 
 def build_status_text_and_color(d):
+    d = as_detail_view(d)
     # ưu tiên tracking_info
-    tinfo = find_first_key(d, "tracking_info")
+    tinfo = d.first("tracking_info")
     if isinstance(tinfo, dict):
         desc = tinfo.get("description") or tinfo.get("text") or tinfo.get("status_text")
         if isinstance(desc, str) and desc.strip():
@@ -473,12 +1275,7 @@ def build_status_text_and_color(d):
             if is_shopee_processing_text(desc):
                 return "🎖 Shopee đang xử lý", "info"
             dl = desc_norm.lower()
-            if (
-                re.search(r"(chuẩn|chuan)\s*bi.*h(à|a)ng", dl)
-                or re.search(r"ch(ờ|o)\s*shop\s*g(ử|u)i", dl)
-                or re.search(r"người\s*g(ử|u)i\s*đang\s*chuẩn\s*bị\s*h(à|a)ng", dl)
-                or re.search(r"(prepar|packing|to\s*ship|ready\s*to\s*ship)", dl)
-            ):
+            if any(rx.search(dl) for rx in _RE_TO_SHIP):
                 return desc_norm, "warning"
             if ("không" in dl or "fail" in dl or "failed" in dl or "unsuccess" in dl):
                 return desc_norm, "danger"
@@ -488,7 +1285,7 @@ def build_status_text_and_color(d):
                 return desc_norm, "info"
             return desc_norm, "info"
 
-    status = find_first_key(d, "status") or {}
+    status = d.first("status") or {}
     if isinstance(status, dict):
         for code in [
             as_text(status.get("header_text")),
@@ -503,21 +1300,24 @@ def build_status_text_and_color(d):
                 if t:
                     return t, c
 
-    code = as_text(find_first_key(d, "status_label")) or as_text(find_first_key(d, "list_view_status_label"))
+    code = as_text(d.first("status_label")) or as_text(d.first("list_view_status_label"))
     t, c = map_code(code)
     if isinstance(t, str) and is_shopee_processing_text(t):
         return "🎖 Shopee đang xử lý", "info"
     return t, c
 
 def extract_shop_info(d):
+    d = as_detail_view(d)
     username = None
     shop_id = None
-    si = find_first_key(d, "shop_info")
+    si = d.first("shop_info")
     if isinstance(si, dict):
         username = si.get("username") or username
         shop_id  = si.get("shop_id")  or shop_id
     return username, shop_id
 
+ORDER_TIME_KEYS = ("create_time", "ctime", "order_time", "order_create_time", "purchase_time", "placed_time")
+
 def extract_order_time(d):
     """
     Lấy thời gian đặt hàng từ:
@@ -525,9 +1325,10 @@ def extract_order_time(d):
     2. Field create_time, ctime, order_time
     3. Fallback: thời gian hiện tại
     """
+    d = as_detail_view(d)
     # Thử lấy từ các field trực tiếp
-    for key in ["create_time", "ctime", "order_time", "order_create_time", "purchase_time", "placed_time"]:
-        val = find_first_key(d, key)
+    for key in ORDER_TIME_KEYS:
+        val = d.first(key)
         if val is not None:
             # Convert timestamp sang string
             if isinstance(val, str) and val.isdigit():
@@ -551,7 +1352,7 @@ def extract_order_time(d):
                 return val.strip()
     
     # Lấy từ timeline (sự kiện cũ nhất = thời gian đặt hàng)
-    _, full_timeline = build_rich_timeline(d)
+    _, full_timeline = d.timeline
     if full_timeline:
         # Timeline được sort theo thời gian mới nhất → lấy item cuối cùng
         oldest_event = full_timeline[-1] if full_timeline else None
@@ -562,21 +1363,22 @@ def extract_order_time(d):
     # Fallback: không có data
     return None
 
+ORDER_CODE_KEYS = (
+    "order_sn", "orderSn",
+    "order_id", "orderId",
+    "order_code", "orderCode",
+    "order_no", "orderNo",
+    "ordersn", "orderid", "orderno", "ordercode",
+)
+
 def extract_order_code(d, fallback: Optional[str] = None) -> Optional[str]:
     """
     Ưu tiên các key mã đơn thường gặp của Shopee.
     Nếu không có thì fallback về order_id lấy từ API list.
     """
-    key_list = (
-        "order_sn", "orderSn",
-        "order_id", "orderId",
-        "order_code", "orderCode",
-        "order_no", "orderNo",
-        "ordersn", "orderid", "orderno", "ordercode",
-    )
-
-    for k in key_list:
-        v = find_first_key(d, k)
+    d = as_detail_view(d)
+    for k in ORDER_CODE_KEYS:
+        v = d.first(k)
         if v is None:
             continue
         s = str(v).strip()
@@ -590,10 +1392,16 @@ def extract_order_code(d, fallback: Optional[str] = None) -> Optional[str]:
     return None
 
 def pick_columns_from_detail(detail_raw: dict, fallback_order_id: Optional[str] = None) -> dict:
-    d = detail_raw if isinstance(detail_raw, dict) else {}
-    s = {}
+    out = as_detail_view(detail_raw, fallback_order_id=fallback_order_id).summary().to_dict()
+    # order_id / shopee_raw do route gắn thêm, không thuộc phần "columns"
+    out.pop("order_id", None)
+    out.pop("shopee_raw", None)
+    return out
+
+def _pick_columns(d: OrderDetailView) -> OrderSummary:
+    s = OrderSummary()
 
-    txt, col = build_status_text_and_color(d)
+    txt, col = d.status
     s["status_text"]  = txt or "—"
     s["status_color"] = col or "secondary"
 
@@ -601,24 +1409,24 @@ def pick_columns_from_detail(detail_raw: dict, fallback_order_id: Optional[str]
     s["cod_amount"] = cod_amount
     s["cod_display"] = format_currency(cod_amount)
 
-    rec_addr = find_first_key(d, "recipient_address") or {}
+    rec_addr = d.first("recipient_address") or {}
     if not isinstance(rec_addr, dict):
         rec_addr = {}
 
-    s["shipping_address"] = find_first_key(d, "shipping_address") or rec_addr.get("full_address")
-    s["shipping_name"]    = find_first_key(d, "shipping_name") or rec_addr.get("name") or find_first_key(d, "recipient_name")
-    s["shipping_phone"]   = find_first_key(d, "shipping_phone") or rec_addr.get("phone")
+    s["shipping_address"] = d.first("shipping_address") or rec_addr.get("full_address")
+    s["shipping_name"]    = d.first("shipping_name") or rec_addr.get("name") or d.first("recipient_name")
+    s["shipping_phone"]   = d.first("shipping_phone") or rec_addr.get("phone")
 
-    s["shipper_name"]     = find_first_key(d, "driver_name")
-    s["shipper_phone"]    = find_first_key(d, "driver_phone")
+    s["shipper_name"]     = d.first("driver_name")
+    s["shipper_phone"]    = d.first("driver_phone")
 
-    s["product_image"]    = normalize_image_url(find_first_key(d, "image")) or first_image(d)
+    s["product_image"]    = normalize_image_url(d.first("image")) or first_image(d)
     s["tracking_no"]      = first_tracking_number(d)
     s["shop_username"], s["shop_id"] = extract_shop_info(d)
 
     # Product name (đơn giản nhưng đủ ổn)
     product_name = None
-    items = find_first_key(d, "items") or find_first_key(d, "card_item_list") or find_first_key(d, "order_items")
+    items = d.first("items") or d.first("card_item_list") or d.first("order_items")
     if isinstance(items, list) and items:
         first_item = items[0]
         if isinstance(first_item, dict):
@@ -629,24 +1437,115 @@ def pick_columns_from_detail(detail_raw: dict, fallback_order_id: Optional[str]
                 or first_item.get("model_name")
             )
     if not product_name:
-        product_name = find_first_key(d, "product_name") or find_first_key(d, "item_name") or find_first_key(d, "name")
+        product_name = d.first("product_name") or d.first("item_name") or d.first("name")
 
     s["product_name"] = product_name if isinstance(product_name, str) else None
 
-    preview, full = build_rich_timeline(d)
+    preview, full = d.timeline
     s["timeline_preview"] = preview
     s["timeline_full"] = full
 
     # ✅ THÊM: Thời gian đặt hàng
     s["order_time"] = extract_order_time(d)
-    s["order_code"] = extract_order_code(d, fallback=fallback_order_id)
+    s["order_code"] = extract_order_code(d, fallback=d.fallback_order_id)
 
     return s
 
-def fetch_shopee_account_info(cookie: str, timeout: int = 10):
-    headers = build_headers(cookie)
-    status, raw = http_get(CHECK_URL, headers, timeout=timeout)
-
+# ================= Prune order detail =================
+# Detail Shopee rất to nhưng extractor chỉ đọc vài chục key. Trước khi cache / lưu store / trả về client,
+# detail được cắt còn cây con nhỏ nhất cho cùng kết quả summary / status / classify. DETAIL_PRUNE=off để giữ nguyên.
+DETAIL_PRUNE = (os.environ.get("DETAIL_PRUNE") or "on").strip().lower() not in ("0", "off", "false", "no")
+
+# key đọc qua OrderDetailView.first() (ngoài các tuple *_KEYS ở trên)
+_DETAIL_SINGLE_KEYS = (
+    "info_card", "tracking_info", "status", "status_label", "list_view_status_label", "shop_info",
+    "recipient_address", "shipping_address", "shipping_name", "recipient_name", "shipping_phone",
+    "driver_name", "driver_phone", "items", "card_item_list", "order_items", "product_name", "item_name", "name",
+)
+DETAIL_KEYS = frozenset(
+    COD_AMOUNT_KEYS + IMAGE_KEYS + TRACKING_NO_KEYS + ORDER_TIME_KEYS + ORDER_CODE_KEYS
+    + CANCEL_BY_KEYS + CANCEL_REASON_KEYS + _DETAIL_SINGLE_KEYS
+)
+# string tìm bằng OrderDetailView.has_str()
+DETAIL_MARKER_STRS = frozenset((CANCELLED_BY_BUYER_LABEL,) + DELIVERED_LABELS)
+
+def prune_detail(raw):
+    """
+    Giữ lại:
+      - lần xuất hiện đầu tiên (BFS, cùng thứ tự với OrderDetailView) của mỗi key trong DETAIL_KEYS, nguyên value;
+      - các string thuộc DETAIL_MARKER_STRS;
+      - mọi phần tử dict có time key trong list (event của timeline), nguyên phần tử.
+    Thứ tự key / phần tử không đổi nên BFS trên cây mới gặp đúng các value như trên cây gốc.
+    """
+    if not isinstance(raw, dict):
+        return raw
+    keep, found = set(), set()      # keep: (id(container), key / index) giữ nguyên value
+    parent = {}                     # id(container) -> id(container cha)
+    needed = {id(raw)}              # container nằm trên đường tới 1 phần được giữ
+
+    def mark(cid):
+        while cid not in needed:
+            needed.add(cid)
+            cid = parent[cid]
+
+    dq = deque([raw])
+    while dq:
+        cur = dq.popleft()
+        cid = id(cur)
+        if isinstance(cur, dict):
+            for k, v in cur.items():
+                if k in DETAIL_KEYS and k not in found:
+                    found.add(k)
+                    keep.add((cid, k))
+                    mark(cid)
+                if isinstance(v, (dict, list)):
+                    parent[id(v)] = cid
+                    dq.append(v)
+                elif isinstance(v, str) and v in DETAIL_MARKER_STRS:
+                    keep.add((cid, k))
+                    mark(cid)
+        else:
+            for i, x in enumerate(cur):
+                if isinstance(x, dict) and _pick_time(x) is not None:
+                    keep.add((cid, i))
+                    mark(cid)
+                if isinstance(x, (dict, list)):
+                    parent[id(x)] = cid
+                    dq.append(x)
+                elif isinstance(x, str) and x in DETAIL_MARKER_STRS:
+                    keep.add((cid, i))
+                    mark(cid)
+
+    def build(node):
+        nid = id(node)
+        if isinstance(node, dict):
+            out = {}
+            for k, v in node.items():
+                if (nid, k) in keep:
+                    out[k] = v
+                elif id(v) in needed:
+                    out[k] = build(v)
+            return out
+        out = []
+        for i, x in enumerate(node):
+            if (nid, i) in keep:
+                out.append(x)
+            elif id(x) in needed:
+                out.append(build(x))
+        return out
+
+    return build(raw)
+
+def fetch_shopee_account_info(cookie, timeout: int = 10):
+    ctx = as_cookie_context(cookie)
+
+    def load():
+        status, raw = http_get(CHECK_URL, ctx.account_headers, timeout=timeout)
+        return _account_info_result(status, raw)
+
+    return ACCOUNT_CACHE.get_or_load(account_cache_key(ctx), load, cacheable=lambda r: r["live"])
+
+def _account_info_result(status, raw) -> dict:
     err_code = None
     if isinstance(raw, dict):
         err_code = raw.get("error")
@@ -706,14 +1605,25 @@ def parse_cookie_inputs(payload: dict):
         out.append(ck)
     return out
 
-def fetch_order_ids_with_meta(cookie: str, limit: int = 6, offset: int = 0, timeout: int = 12):
-    list_url = f"{BASE}/order/get_all_order_and_checkout_list"
-    variants = build_order_header_variants(cookie)
+def order_ids_from_list(data) -> list:
+    ids = bfs_values_by_key(data, ("order_id",)) if isinstance(data, dict) else []
+    uniq, seen = [], set()
+    for oid in ids:
+        s = str(oid).strip()
+        if not s or s in seen:
+            continue
+        seen.add(s)
+        uniq.append(s)
+    return uniq
+
+def fetch_order_ids_with_meta(cookie, limit: int = 6, offset: int = 0, timeout: int = 12):
+    ctx = as_cookie_context(cookie)
+    variants = order_variants(ctx)
     last_status, last_data = 0, {}
 
-    for headers in variants:
+    for idx, headers in variants:
         status, data = http_get(
-            list_url,
+            ORDER_LIST_URL,
             headers,
             params={"limit": int(limit), "offset": int(offset)},
             timeout=timeout,
@@ -722,18 +1632,14 @@ def fetch_order_ids_with_meta(cookie: str, limit: int = 6, offset: int = 0, time
         if status != 200 or not isinstance(data, dict):
             continue
 
-        ids = bfs_values_by_key(data, ("order_id",))
-        uniq, seen = [], set()
-        for oid in ids:
-            s = str(oid).strip()
-            if not s or s in seen:
-                continue
-            seen.add(s)
-            uniq.append(s)
-
+        uniq = order_ids_from_list(data)
         if uniq:
+            remember_variant(ctx, variants, idx)
             return uniq, {"status_code": status, "error": ""}
 
+    return [], {"status_code": last_status, "error": upstream_error_text(last_status, last_data)}
+
+def upstream_error_text(last_status, last_data) -> str:
     err = ""
     if isinstance(last_data, dict):
         emsg = str(last_data.get("message") or last_data.get("error_msg") or "").strip()
@@ -746,37 +1652,38 @@ def fetch_order_ids_with_meta(cookie: str, limit: int = 6, offset: int = 0, time
             err = (err + " - " if err else "") + emsg
     if not err:
         err = f"HTTP {last_status or 0}"
-    return [], {"status_code": last_status, "error": err}
-
-def fetch_order_detail_by_id(cookie: str, order_id: str, timeout: int = 12):
-    detail_url = f"{BASE}/order/get_order_detail"
-    variants = build_order_header_variants(cookie)
-    last_status, last_data = 0, {}
-
-    for headers in variants:
-        status, data = http_get(
-            detail_url,
-            headers,
-            params={"order_id": str(order_id)},
-            timeout=timeout,
+    return err
+
+def detail_result_ok(result) -> bool:
+    return result[1]["status_code"] == 200 and not result[1]["error"]
+
+def fetch_order_detail_by_id(cookie, order_id: str, timeout: int = 12, prune: bool = True):
+    """prune=False: trả detail nguyên vẹn (không qua cache, cache chỉ giữ bản đã prune)."""
+    ctx = as_cookie_context(cookie)
+    prune = prune or not DETAIL_PRUNE
+
+    def load():
+        variants = order_variants(ctx)
+        last_status, last_data = 0, {}
+        for idx, headers in variants:
+            status, data = http_get(
+                ORDER_DETAIL_URL,
+                headers,
+                params={"order_id": str(order_id)},
+                timeout=timeout,
+            )
+            last_status, last_data = status, data
+            if status == 200 and isinstance(data, dict):
+                remember_variant(ctx, variants, idx)
+                return (prune_detail(data) if prune and DETAIL_PRUNE else data), {"status_code": status, "error": ""}
+        return (
+            (last_data if isinstance(last_data, dict) else {}),
+            {"status_code": last_status, "error": upstream_error_text(last_status, last_data)},
         )
-        last_status, last_data = status, data
-        if status == 200 and isinstance(data, dict):
-            return data, {"status_code": status, "error": ""}
 
-    err = ""
-    if isinstance(last_data, dict):
-        emsg = str(last_data.get("message") or last_data.get("error_msg") or "").strip()
-        ecode = last_data.get("error")
-        if last_status and last_status != 200:
-            err = f"HTTP {last_status}"
-        if ecode not in (None, "", 0, "0"):
-            err = (err + " - " if err else "") + f"error {ecode}"
-        if emsg:
-            err = (err + " - " if err else "") + emsg
-    if not err:
-        err = f"HTTP {last_status or 0}"
-    return (last_data if isinstance(last_data, dict) else {}), {"status_code": last_status, "error": err}
+    if not prune:
+        return load()
+    return tuple(DETAIL_CACHE.get_or_load(f"{ctx.session}:{order_id}", load, cacheable=detail_result_ok))
 
 def is_delivered_status_text(status: str) -> bool:
     s = normalize_status_text(status).lower()
@@ -793,13 +1700,12 @@ def is_delivered_status_text(status: str) -> bool:
         or "delivered" in s
     )
 
-def is_detail_delivered(detail_raw: dict) -> bool:
-    s = pick_columns_from_detail(detail_raw).get("status_text") or ""
+def is_detail_delivered(detail_raw) -> bool:
+    d = as_detail_view(detail_raw)
+    s = d.status[0] or ""
     if is_delivered_status_text(str(s)):
         return True
-    return tree_contains_str(detail_raw, "label_order_delivered") or tree_contains_str(
-        detail_raw, "order_status_text_to_receive_delivery_done"
-    )
+    return any(d.has_str(label) for label in DELIVERED_LABELS)
 
 def _confirm_error_is_already_done(raw_error_text: str, api_data=None) -> bool:
     combined = []
@@ -852,36 +1758,28 @@ def _humanize_confirm_error(raw_error_text: str, api_data=None) -> str:
         return "Xac nhan don that bai."
     return text[:220]
 
-def request_buyer_confirm_order(order_id: str, cookie_text: str):
+def request_buyer_confirm_order(order_id: str, cookie_text, timeout: float = 15):
+    req, err = build_confirm_request(order_id, cookie_text)
+    if err:
+        return False, {}, err
+    headers, payload = req
+    status, body = http_post(SHOPEE_CONFIRM_URL, headers, payload=payload, timeout=timeout)
+    return confirm_result(status, body)
+
+def build_confirm_request(order_id: str, cookie_text):
+    """-> ((headers, payload), "") hoặc (None, lỗi input)."""
     order_id_val = str(order_id or "").strip()
-    cookie_val = sanitize_cookie(str(cookie_text or "").strip())
+    ctx = as_cookie_context(cookie_text)
     if not order_id_val:
-        return False, {}, "Thieu order_id."
-    if not cookie_val:
-        return False, {}, "Thieu cookie."
-
-    ckm = cookie_map(cookie_val)
-    csrf_val = str(ckm.get("csrftoken") or ckm.get("CSRFTOKEN") or "").strip()
-
-    headers = {
-        "Accept": "application/json, text/plain, */*",
-        "Content-Type": "application/json",
-        "Origin": "https://shopee.vn",
-        "Referer": "https://shopee.vn/user/purchase/?type=8",
-        "User-Agent": SHOPEE_CONFIRM_UA,
-        "X-API-SOURCE": "pc",
-        "X-Requested-With": "XMLHttpRequest",
-        "X-Shopee-Language": "vi",
-        "x-shopee-language": "vi",
-        "Cookie": cookie_val,
-    }
-    if csrf_val:
-        headers["X-CSRFToken"] = csrf_val
-        headers["x-csrftoken"] = csrf_val
+        return None, "Thieu order_id."
+    if not ctx.cookie:
+        return None, "Thieu cookie."
 
+    headers = ctx.confirm_headers
     payload = {"order_id": int(order_id_val) if str(order_id_val).isdigit() else order_id_val}
-    status, body = http_post(SHOPEE_CONFIRM_URL, headers, payload=payload, timeout=15)
+    return (headers, payload), ""
 
+def confirm_result(status, body):
     if status != 200:
         msg = ""
         if isinstance(body, dict):
@@ -894,7 +1792,11 @@ def request_buyer_confirm_order(order_id: str, cookie_text: str):
             ).strip()
         if not msg:
             msg = f"HTTP {status or 0}"
-        return False, (body if isinstance(body, dict) else {}), msg
+        data = body if isinstance(body, dict) else {}
+        if not status:
+            # không nhận được phản hồi (timeout / mất kết nối): chưa biết Shopee đã xác nhận hay chưa
+            data = dict(data, no_response=True)
+        return False, data, msg
 
     if not isinstance(body, dict):
         return False, {}, "API confirm khong tra JSON hop le."
@@ -915,11 +1817,2300 @@ def request_buyer_confirm_order(order_id: str, cookie_text: str):
 
     return True, body, ""
 
+def confirm_unsettled(ok_confirm: bool, confirm_data) -> bool:
+    """Confirm thất bại vì không có phản hồi -> chưa phải kết quả cuối, bulk để lại cho lượt sau (cursor)."""
+    return not ok_confirm and isinstance(confirm_data, dict) and bool(confirm_data.get("no_response"))
+
+# ================= Confirm idempotency =================
+# Nhớ kết quả confirm ok (success / already) theo (token phiên SPC_ST/SPC_EC, order_id) trong CONFIRM_IDEMPOTENCY_TTL_S giây:
+# retry / bấm 2 lần được trả lời tại chỗ, không POST lại Shopee. Confirm đồng thời cùng 1 đơn gộp thành 1 lần gọi.
+# CONFIRM_IDEMPOTENCY_TTL_S=0 để tắt.
+CONFIRM_IDEMPOTENCY_TTL_S = float(os.environ.get("CONFIRM_IDEMPOTENCY_TTL_S") or 600)
+CONFIRM_IDEMPOTENCY_MAX = int(os.environ.get("CONFIRM_IDEMPOTENCY_MAX") or 20000)
+
+class IdempotencyConflict(ValueError):
+    """Idempotency-Key đã dùng cho 1 đơn khác."""
+
+class _Flight:
+    __slots__ = ("event", "result")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+class ConfirmLedger:
+    """
+    Sổ kết quả confirm trong bộ nhớ (TTL + giới hạn số entry) + single-flight theo đơn.
+    Idempotency-Key (nếu có) là khóa phụ, gắn với đúng 1 order_id.
+    """
+
+    def __init__(self, ttl: float = CONFIRM_IDEMPOTENCY_TTL_S, max_entries: int = CONFIRM_IDEMPOTENCY_MAX):
+        self.ttl = float(ttl)
+        self.max_entries = max(1, int(max_entries))
+        self._done = {}            # key -> (expires_at, order_id, result)
+        self._flights = {}         # (session, order_id) -> _Flight
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "replayed": 0, "merged": 0}
+
+    @staticmethod
+    def keys_for(session: str, order_id: str, idempotency_key: Optional[str] = None) -> tuple:
+        # khóa theo hash token phiên, không theo SPC_U (client tự đặt được -> đọc trộm kết quả của người khác)
+        keys = (("order", session, str(order_id)),)
+        if idempotency_key:
+            keys += (("idem", session, str(idempotency_key)),)
+        return keys
+
+    def _lookup(self, keys, order_id: str, now: float):
+        for key in keys:
+            hit = self._done.get(key)
+            if hit is None:
+                continue
+            if hit[0] <= now:
+                del self._done[key]
+                continue
+            if hit[1] != order_id:
+                raise IdempotencyConflict(order_id)
+            return hit[2]
+        return None
+
+    def begin(self, keys, order_id: str):
+        """-> ("replay", result) | ("wait", flight) | ("lead", flight)."""
+        order_id = str(order_id)
+        with self._lock:
+            result = self._lookup(keys, order_id, time.monotonic())
+            if result is not None:
+                self.stats["replayed"] += 1
+                return "replay", result
+            flight = self._flights.get(keys[0])
+            if flight is not None:
+                self.stats["merged"] += 1
+                return "wait", flight
+            flight = self._flights[keys[0]] = _Flight()
+            self.stats["calls"] += 1
+            return "lead", flight
+
+    def finish(self, keys, order_id: str, flight: _Flight, result):
+        ok_confirm, confirm_data, confirm_err = result
+        with self._lock:
+            if ok_confirm or _confirm_error_is_already_done(confirm_err, confirm_data):
+                expires_at = time.monotonic() + self.ttl
+                for key in keys:
+                    self._done.pop(key, None)
+                    self._done[key] = (expires_at, str(order_id), result)
+                while len(self._done) > self.max_entries:
+                    del self._done[next(iter(self._done))]
+            self._flights.pop(keys[0], None)
+        flight.result = result
+        flight.event.set()
+
+CONFIRM_LEDGER = ConfirmLedger() if CONFIRM_IDEMPOTENCY_TTL_S > 0 else None
+
+def confirm_order_once(order_id: str, ctx: CookieContext, timeout: float = 15,
+                       idempotency_key: Optional[str] = None):
+    """
+    request_buyer_confirm_order qua ConfirmLedger. -> (ok, data, err, replayed);
+    replayed=True khi kết quả lấy từ sổ hoặc từ 1 confirm đồng thời khác (không tự gọi Shopee).
+    Raise IdempotencyConflict nếu Idempotency-Key đã gắn với đơn khác.
+    """
+    ledger = CONFIRM_LEDGER
+    if ledger is None:
+        return (*request_buyer_confirm_order(order_id, ctx, timeout=timeout), False)
+    keys = ledger.keys_for(ctx.session, order_id, idempotency_key)
+    kind, val = ledger.begin(keys, order_id)
+    if kind == "replay":
+        return (*val, True)
+    if kind == "wait":
+        if val.event.wait(timeout + 1) and val.result is not None:
+            return (*val.result, True)
+        return (*request_buyer_confirm_order(order_id, ctx, timeout=timeout), False)
+    result = (False, {}, "Xac nhan don that bai.")
+    try:
+        result = request_buyer_confirm_order(order_id, ctx, timeout=timeout)
+    finally:
+        ledger.finish(keys, order_id, val, result)
+    return (*result, False)
+
+# ================= Shared cache =================
+# Cache dùng chung cho account info / order detail / header variant, mỗi loại 1 namespace (TTL + stats riêng).
+# CACHE_BACKEND: memory (LRU trong process, mặc định) | sqlite (file CACHE_URL, chung cho các worker cùng máy)
+# | redis (CACHE_URL=redis://[:pass@]host:6379/0 hoặc rediss://, chung giữa các instance serverless) | off.
+CACHE_BACKEND = (os.environ.get("CACHE_BACKEND") or "memory").strip().lower()
+CACHE_URL = os.environ.get("CACHE_URL") or ""
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES") or 5000)
+CACHE_ACCOUNT_TTL_S = float(os.environ.get("CACHE_ACCOUNT_TTL_S") or 60)
+CACHE_DETAIL_TTL_S = float(os.environ.get("CACHE_DETAIL_TTL_S") or 20)
+CACHE_VARIANT_TTL_S = float(os.environ.get("CACHE_VARIANT_TTL_S") or 86400)
+
+class CacheError(Exception):
+    """Backend cache lỗi (mất kết nối, reply lạ...): caller coi như miss."""
+
+class MemoryCache:
+    """LRU trong process: dict giữ thứ tự dùng gần nhất, entry = (expires_at, value)."""
+
+    name = "memory"
+    blocking = False           # không I/O: coroutine gọi thẳng
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max(1, int(max_entries))
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            hit = self._data.pop(key, None)
+            if hit is None or hit[0] <= time.time():
+                return None
+            self._data[key] = hit
+            return hit[1]
+
+    def set(self, key: str, value: str, ttl: float):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.max_entries:
+                del self._data[next(iter(self._data))]
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+class SQLiteCache:
+    """Bảng key/value có hạn; entry hết hạn bị bỏ qua khi đọc và dọn định kỳ khi ghi."""
+
+    name = "sqlite"
+    blocking = True
+    PURGE_EVERY = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (k TEXT PRIMARY KEY, v TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT v FROM cache WHERE k = ? AND expires_at > ?", (key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (k, v, expires_at) VALUES (?, ?, ?)", (key, value, now + ttl),
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE k = ?", (key,))
+            self._conn.commit()
+
+class RedisCache:
+    """Client RESP tối thiểu (GET / SET PX / DEL) qua socket, không cần thư viện redis; giữ vài kết nối để dùng lại."""
+
+    name = "redis"
+    blocking = True
+    POOL_SIZE = 8
+    RETRY_AFTER_S = 5          # mất kết nối: coi như miss ngay trong vài giây, không chờ timeout từng call
+
+    def __init__(self, url: str, timeout: float = 1.0):
+        from urllib.parse import urlsplit
+        u = urlsplit(url or "redis://127.0.0.1:6379/0")
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.username = u.username
+        self.password = u.password
+        self.tls = u.scheme == "rediss"
+        self.timeout = timeout
+        self._pool = []
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        import socket
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        if self.tls:
+            import ssl
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        conn = (sock, sock.makefile("rb"))
+        if self.password:
+            self._call(conn, "AUTH", *([self.username] if self.username else []), self.password)
+        if self.db:
+            self._call(conn, "SELECT", self.db)
+        return conn
+
+    @classmethod
+    def _call(cls, conn, *args):
+        sock, rfile = conn
+        out = [b"*%d\r\n" % len(args)]
+        for a in args:
+            b = a if isinstance(a, bytes) else str(a).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(b), b))
+        sock.sendall(b"".join(out))
+        return cls._read(rfile)
+
+    @classmethod
+    def _read(cls, rfile):
+        line = rfile.readline()
+        if not line.endswith(b"\r\n"):
+            raise CacheError("redis: connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8", "replace")
+        if kind == b"-":
+            raise CacheError("redis: " + rest.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            return None if n < 0 else rfile.read(n + 2)[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [cls._read(rfile) for _ in range(n)]
+        raise CacheError("redis: unexpected reply")
+
+    def command(self, *args):
+        with self._lock:
+            conn = self._pool.pop() if self._pool else None
+        if conn is None and time.monotonic() < self._down_until:
+            raise CacheError("redis: unavailable")
+        try:
+            if conn is None:
+                conn = self._connect()
+            result = self._call(conn, *args)
+        except OSError as e:
+            if conn is not None:
+                conn[0].close()
+            self._down_until = time.monotonic() + self.RETRY_AFTER_S
+            raise CacheError(str(e) or type(e).__name__) from e
+        except (ValueError, CacheError) as e:
+            if conn is not None:
+                conn[0].close()
+            raise CacheError(str(e) or type(e).__name__) from e
+        with self._lock:
+            if len(self._pool) < self.POOL_SIZE:
+                self._pool.append(conn)
+                conn = None
+        if conn is not None:
+            conn[0].close()
+        return result
+
+    def get(self, key: str) -> Optional[str]:
+        val = self.command("GET", key)
+        return val.decode("utf-8") if val is not None else None
+
+    def set(self, key: str, value: str, ttl: float):
+        self.command("SET", key, value, "PX", max(1, int(ttl * 1000)))
+
+    def delete(self, key: str):
+        self.command("DEL", key)
+
+_cache_backend = None
+_cache_backend_lock = threading.Lock()
+
+def get_cache_backend():
+    global _cache_backend
+    if CACHE_BACKEND in ("", "0", "off", "none", "false"):
+        return None
+    if _cache_backend is None:
+        with _cache_backend_lock:
+            if _cache_backend is None:
+                try:
+                    if CACHE_BACKEND == "redis":
+                        _cache_backend = RedisCache(CACHE_URL)
+                    elif CACHE_BACKEND == "sqlite":
+                        _cache_backend = SQLiteCache(
+                            CACHE_URL or os.path.join(tempfile.gettempdir(), "ngamiu_cache.sqlite3")
+                        )
+                    else:
+                        _cache_backend = MemoryCache()
+                except (sqlite3.Error, ValueError):
+                    return None
+    return _cache_backend
+
+class CacheNamespace:
+    """
+    1 loại dữ liệu trong cache chung: key có prefix riêng, value lưu dạng JSON, TTL + stats riêng.
+    get_or_load gộp các lần load đồng thời cùng key trong process (single-flight).
+    """
+
+    def __init__(self, name: str, ttl: float):
+        self.name = name
+        self.ttl = float(ttl)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "sets": 0, "merged": 0, "errors": 0}
+
+    def _count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _backend(self):
+        return get_cache_backend() if self.ttl > 0 else None
+
+    @property
+    def blocking(self) -> bool:
+        """Backend có I/O (sqlite / redis): coroutine phải gọi qua off_loop."""
+        backend = self._backend()
+        return backend is not None and backend.blocking
+
+    def get(self, key: str):
+        backend = self._backend()
+        if backend is None:
+            return None
+        try:
+            raw = backend.get(f"ngamiu:{self.name}:{key}")
+            val = json_loads(raw) if raw is not None else None
+        except (CacheError, sqlite3.Error, ValueError):
+            self._count("errors")
+            return None
+        self._count("misses" if val is None else "hits")
+        return val
+
+    def set(self, key: str, value, ttl: Optional[float] = None):
+        backend = self._backend()
+        if backend is None:
+            return
+        try:
+            backend.set(f"ngamiu:{self.name}:{key}",
+                        json_dumps_bytes(value, default=str).decode("utf-8"),
+                        self.ttl if ttl is None else ttl)
+        except (CacheError, sqlite3.Error):
+            self._count("errors")
+            return
+        self._count("sets")
+
+    def get_or_load(self, key: str, loader, cacheable=lambda value: True, wait_s: float = 30):
+        if self._backend() is None:
+            return loader()
+        val = self.get(key)
+        if val is not None:
+            return val
+        with self._lock:
+            flight = self._flights.get(key)
+            lead = flight is None
+            if lead:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.stats["merged"] += 1
+        if not lead:
+            if flight.event.wait(wait_s) and flight.result is not None:
+                return flight.result
+            return loader()
+        result = None
+        try:
+            result = loader()
+            if cacheable(result):
+                self.set(key, result)
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.result = result
+            flight.event.set()
+        return result
+
+ACCOUNT_CACHE = CacheNamespace("account", CACHE_ACCOUNT_TTL_S)
+DETAIL_CACHE = CacheNamespace("detail", CACHE_DETAIL_TTL_S)
+VARIANT_CACHE = CacheNamespace("variant", CACHE_VARIANT_TTL_S)
+
+def cache_metrics() -> dict:
+    backend = get_cache_backend()
+    return {
+        "backend": backend.name if backend is not None else None,
+        "namespaces": {ns.name: dict(ns.stats) for ns in (ACCOUNT_CACHE, DETAIL_CACHE, VARIANT_CACHE)},
+    }
+
+def account_cache_key(ctx: CookieContext) -> str:
+    # theo cả chuỗi cookie, không theo identity: cookie chết cùng tài khoản không được nhận kết quả "live"
+    return hashlib.sha1(ctx.cookie.encode("utf-8")).hexdigest()
+
+def order_variants(ctx: CookieContext) -> list:
+    """[(index, headers)] theo thứ tự thử: bộ header lần trước chạy được với phiên này lên đầu."""
+    # detail / variant theo ctx.session (token phiên), không theo identity: SPC_U do client tự đặt được
+    variants = ctx.order_header_variants
+    pref = VARIANT_CACHE.get(ctx.session)
+    if isinstance(pref, int) and 0 < pref < len(variants):
+        return [(pref, variants[pref])] + [(i, h) for i, h in enumerate(variants) if i != pref]
+    return list(enumerate(variants))
+
+def remember_variant(ctx: CookieContext, tried: list, index: int):
+    if tried and tried[0][0] != index:
+        VARIANT_CACHE.set(ctx.session, index)
+
+# ================= Order state store (SQLite) =================
+ORDER_STORE_BACKEND = (os.environ.get("ORDER_STORE") or "sqlite").strip().lower()
+ORDER_STORE_PATH = os.environ.get("ORDER_STORE_PATH") or os.path.join(tempfile.gettempdir(), "ngamiu_order_state.sqlite3")
+
+# trạng thái "chốt": lần check sau lấy từ store, không gọi lại Shopee
+FINAL_ORDER_STATES = ("delivered", "confirmed", "cancelled")
+
+def content_hash(data) -> str:
+    blob = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+def order_state_of(view: OrderDetailView) -> str:
+    if view.buyer_cancelled:
+        return "cancelled"
+    txt, col = view.status
+    txt_l = str(txt or "").lower()
+    if col == "danger" and ("hủy" in txt_l or "cancel" in txt_l):
+        return "cancelled"
+    if view.delivered:
+        return "delivered"
+    return "active"
+
+class OrderStateStore:
+    """
+    Lưu trạng thái cuối cùng của từng cặp (cookie identity, order_id) + content hash.
+    Mặc định SQLite (trên Vercel chỉ /tmp ghi được nên path mặc định nằm ở tempdir).
+    Store chỉ để tăng tốc: lỗi SQLite (database is locked, disk đầy / read-only...) được log
+    rồi coi như không có store (get -> None, put bỏ qua), request vẫn chạy tiếp.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS order_state (
+                    identity     TEXT NOT NULL,
+                    order_id     TEXT NOT NULL,
+                    state        TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    tracking_no  TEXT,
+                    status_text  TEXT,
+                    raw          TEXT,
+                    updated_at   REAL NOT NULL,
+                    PRIMARY KEY (identity, order_id)
+                )
+                """
+            )
+            self._conn.commit()
+
+    def _failed(self, op: str, error: sqlite3.Error):
+        self.errors += 1
+        app.logger.warning("order store %s failed (%s): %s", op, self.path, error)
+
+    def get(self, identity: str, order_id: str) -> Optional[dict]:
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT state, content_hash, tracking_no, status_text, raw, updated_at"
+                    " FROM order_state WHERE identity = ? AND order_id = ?",
+                    (identity, str(order_id)),
+                ).fetchone()
+        except sqlite3.Error as e:
+            self._failed("get", e)
+            return None
+        if not row:
+            return None
+        state, chash, tracking_no, status_text, raw, updated_at = row
+        try:
+            raw = json_loads(raw) if raw else {}
+        except ValueError:
+            raw = {}
+        return {
+            "state": state,
+            "content_hash": chash,
+            "tracking_no": tracking_no,
+            "status_text": status_text,
+            "raw": raw,
+            "updated_at": updated_at,
+        }
+
+    def get_final(self, identity: str, order_id: str) -> Optional[dict]:
+        rec = self.get(identity, order_id)
+        if rec and rec["state"] in FINAL_ORDER_STATES:
+            return rec
+        return None
+
+    def put(self, identity: str, order_id: str, state: str, raw: dict,
+            tracking_no: Optional[str] = None, status_text: Optional[str] = None):
+        chash = content_hash(raw)
+        with self._lock:
+            try:
+                self._put_locked(identity, order_id, state, raw, chash, tracking_no, status_text)
+            except sqlite3.Error as e:
+                try:
+                    self._conn.rollback()
+                except sqlite3.Error:
+                    pass
+                self._failed("put", e)
+                return None
+        return chash
+
+    def _put_locked(self, identity, order_id, state, raw, chash, tracking_no, status_text):
+        self._conn.execute(
+            """
+            INSERT INTO order_state (identity, order_id, state, content_hash, tracking_no, status_text, raw, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (identity, order_id) DO UPDATE SET
+                state = excluded.state,
+                content_hash = excluded.content_hash,
+                tracking_no = excluded.tracking_no,
+                status_text = excluded.status_text,
+                raw = CASE WHEN order_state.content_hash = excluded.content_hash
+                           THEN order_state.raw ELSE excluded.raw END,
+                updated_at = excluded.updated_at
+            """,
+            (identity, str(order_id), state, chash, tracking_no, status_text,
+             json_dumps_bytes(raw, default=str).decode("utf-8"), time.time()),
+        )
+        self._conn.commit()
+
+    def put_view(self, identity: str, order_id: str, view: OrderDetailView, state: Optional[str] = None):
+        # raw lưu bản đã prune (DETAIL_PRUNE): request include_raw=full không đọc lại từ store (store_raw_usable)
+        s = view.summary()
+        return self.put(
+            identity, order_id, state or order_state_of(view),
+            prune_detail(view.raw) if DETAIL_PRUNE else view.raw,
+            tracking_no=s.tracking_no, status_text=s.status_text,
+        )
+
+_order_store = None
+_order_store_lock = threading.Lock()
+
+def get_order_store() -> Optional[OrderStateStore]:
+    global _order_store
+    if ORDER_STORE_BACKEND in ("", "0", "off", "none", "false"):
+        return None
+    if _order_store is None:
+        with _order_store_lock:
+            if _order_store is None:
+                try:
+                    _order_store = OrderStateStore(ORDER_STORE_PATH)
+                except sqlite3.Error:
+                    return None
+    return _order_store
+
+def store_raw_usable(prune: bool) -> bool:
+    """Raw trong store có dùng được cho response không: store giữ bản đã prune, include_raw=full thì phải gọi lại Shopee."""
+    return prune or not DETAIL_PRUNE
+
+# ================= Conditional responses (ETag / since) =================
+def project_summary(s: OrderSummary) -> dict:
+    out = s.to_dict()
+    out.pop("shopee_raw", None)
+    return out
+
+def order_status_sig(s: OrderSummary) -> str:
+    return content_hash([s.status_text, s.status_color, s.tracking_no])[:12]
+
+def encode_since_token(sigs: dict) -> str:
+    blob = json.dumps(sigs, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(blob).decode("ascii").rstrip("=")
+
+def decode_since_token(token) -> Optional[dict]:
+    if not isinstance(token, str) or not token.strip():
+        return None
+    tok = token.strip()
+    try:
+        out = json.loads(base64.urlsafe_b64decode(tok + "=" * (-len(tok) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return out if isinstance(out, dict) else None
+
+def not_modified(etag: str):
+    resp = app.response_class(status=304)
+    resp.set_etag(etag)
+    return resp
+
+# ================= Startup profile / warm-up =================
+BOOT_PROFILE = {
+    "startup_mode": STARTUP_MODE,
+    "import_ms": None,
+    "first_request_ms": None,
+    "first_request_path": None,
+    "warmed": False,
+}
+
+_WARMUP_SAMPLE = {
+    "data": {
+        "tracking_info": {"description": "Giao hàng thành công", "tracking_number": "SPXVN000000000"},
+        "status": {"status_label": {"text": "label_order_delivered"}},
+        "info_card": {"final_total": 100000, "order_sn": "WARMUP"},
+        "shop_info": {"username": "warmup", "shop_id": 0},
+        "items": [{"name": "warmup", "image": "warmup"}],
+        "processing_info": {"logs": [{"ctime": 1700000000, "description": "warmup"}]},
+    }
+}
+
+def warm_up(connect: bool = False) -> dict:
+    """Import requests + dựng pool + chạy 1 lượt extractor/regex mẫu + mở store."""
+    timings = {}
+    t = time.perf_counter()
+    http_session()
+    timings["http_pool_ms"] = round((time.perf_counter() - t) * 1000, 2)
+
+    t = time.perf_counter()
+    view = OrderDetailView(_WARMUP_SAMPLE, fallback_order_id="0")
+    view.summary()
+    is_buyer_cancelled(view)
+    is_detail_delivered(view)
+    CookieContext("SPC_ST=warmup; csrftoken=warmup")
+    timings["tables_ms"] = round((time.perf_counter() - t) * 1000, 2)
+
+    t = time.perf_counter()
+    get_order_store()
+    timings["store_ms"] = round((time.perf_counter() - t) * 1000, 2)
+
+    t = time.perf_counter()
+    get_cache_backend()
+    timings["cache_ms"] = round((time.perf_counter() - t) * 1000, 2)
+
+    if connect:
+        # mở sẵn 1 kết nối TLS tới Shopee để request thật đầu tiên không phải handshake
+        t = time.perf_counter()
+        try:
+            http_session().head(BASE.split("/api/")[0] + "/", timeout=3)
+            timings["connect_ok"] = True
+        except requests_module().RequestException:
+            timings["connect_ok"] = False
+        timings["connect_ms"] = round((time.perf_counter() - t) * 1000, 2)
+
+    BOOT_PROFILE["warmed"] = True
+    return timings
+
+_first_request_pending = True
+_first_request_lock = threading.Lock()
+
+@app.before_request
+def _profile_first_request_start():
+    global _first_request_pending
+    if _first_request_pending:
+        with _first_request_lock:
+            if _first_request_pending:
+                _first_request_pending = False
+                g.first_request_t0 = time.perf_counter()
+
+@app.after_request
+def _profile_first_request_end(resp):
+    t0 = g.get("first_request_t0")
+    if t0 is not None:
+        BOOT_PROFILE["first_request_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        BOOT_PROFILE["first_request_path"] = request.path
+    return resp
+
+# ================= Response compression =================
+# gzip / brotli theo Accept-Encoding cho JSON/text lớn hơn COMPRESS_MIN_BYTES (Apps Script nhận gzip).
+# Hook đăng ký trước profiling nên chạy sau cùng trong after_request (nén cả "_profile").
+RESPONSE_COMPRESS = (os.environ.get("RESPONSE_COMPRESS") or "on").strip().lower() not in ("0", "off", "false", "no")
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES") or 1024)
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL") or 6)            # gzip 1..9
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY") or 4)            # brotli 0..11
+_COMPRESSIBLE = ("application/json", "application/x-ndjson", "text/")
+
+COMPRESSION_STATS = {
+    "responses": 0, "compressed": 0, "streamed": 0,
+    "bytes_in": 0, "bytes_out": 0, "compress_ms": 0.0,
+    "by_encoding": {},
+}
+_compression_lock = threading.Lock()
+_brotli = None
+
+def brotli_module():
+    """brotli / brotlicffi nếu có cài, không thì False (chỉ dùng gzip)."""
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli as mod
+        except ImportError:
+            try:
+                import brotlicffi as mod
+            except ImportError:
+                mod = False
+        _brotli = mod
+    return _brotli
+
+def choose_encoding(accept) -> Optional[str]:
+    """Chọn "br" / "gzip" theo q-value của Accept-Encoding; ngang nhau thì ưu tiên br."""
+    q_br = accept.quality("br") if brotli_module() else 0
+    q_gzip = accept.quality("gzip")
+    if q_br > 0 and q_br >= q_gzip:
+        return "br"
+    return "gzip" if q_gzip > 0 else None
+
+def _compressor(encoding: str):
+    """-> (compress(chunk), flush() giữa chừng, finish())."""
+    if encoding == "br":
+        c = brotli_module().Compressor(quality=BROTLI_QUALITY)
+        return c.process, c.flush, c.finish
+    c = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)   # wbits 31 = header gzip
+    return c.compress, (lambda: c.flush(zlib.Z_SYNC_FLUSH)), c.flush
+
+def compress_body(data: bytes, encoding: str) -> bytes:
+    compress, _, finish = _compressor(encoding)
+    return compress(data) + finish()
+
+def compress_stream(chunks, encoding: str):
+    """Nén từng chunk và flush ngay: client vẫn nhận dữ liệu dần như response không nén."""
+    compress, flush, finish = _compressor(encoding)
+    size_in = size_out = 0
+    t = 0.0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        t0 = time.perf_counter()
+        out = compress(chunk) + flush()
+        t += time.perf_counter() - t0
+        size_in += len(chunk)
+        size_out += len(out)
+        if out:
+            yield out
+    tail = finish()
+    size_out += len(tail)
+    if tail:
+        yield tail
+    _record_compression(encoding, size_in, size_out, t, streamed=True)
+
+def _record_compression(encoding: str, size_in: int, size_out: int, seconds: float, streamed: bool = False):
+    with _compression_lock:
+        st = COMPRESSION_STATS
+        st["compressed"] += 1
+        st["streamed"] += int(streamed)
+        st["bytes_in"] += size_in
+        st["bytes_out"] += size_out
+        st["compress_ms"] = round(st["compress_ms"] + seconds * 1000, 3)
+        st["by_encoding"][encoding] = st["by_encoding"].get(encoding, 0) + 1
+
+def compression_metrics() -> dict:
+    with _compression_lock:
+        out = dict(COMPRESSION_STATS, by_encoding=dict(COMPRESSION_STATS["by_encoding"]))
+    out["enabled"] = RESPONSE_COMPRESS
+    out["ratio"] = round(out["bytes_out"] / out["bytes_in"], 4) if out["bytes_in"] else None
+    return out
+
+@app.after_request
+def _compress_response(resp):
+    if not RESPONSE_COMPRESS or request.method == "HEAD":
+        return resp
+    if resp.status_code < 200 or resp.status_code in (204, 206, 304) or "Content-Encoding" in resp.headers:
+        return resp
+    if not (resp.mimetype or "").startswith(_COMPRESSIBLE):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    with _compression_lock:
+        COMPRESSION_STATS["responses"] += 1
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return resp
+
+    if resp.is_streamed:
+        resp.response = compress_stream(resp.response, encoding)
+        resp.headers.pop("Content-Length", None)
+    else:
+        data = resp.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return resp
+        t0 = time.perf_counter()
+        packed = compress_body(data, encoding)
+        elapsed = time.perf_counter() - t0
+        if len(packed) >= len(data):
+            return resp
+        resp.set_data(packed)
+        _record_compression(encoding, len(data), len(packed), elapsed)
+    resp.headers["Content-Encoding"] = encoding
+    # cùng nội dung nhưng khác byte -> ETag yếu (If-None-Match so sánh weak)
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+# ================= Debug profiling (opt-in) =================
+# Chỉ bật khi server có PROFILE_SECRET và request gửi header X-Profile trùng secret.
+# Chạy request dưới cProfile (+ worker thread của bulk) và tracemalloc, gắn "_profile" vào JSON response.
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET") or ""
+PROFILE_TOP_DEFAULT = 30
+
+class ProfileBusy(RuntimeError):
+    """Đang profile 1 request khác: cProfile / tracemalloc là global, 2 session chồng nhau sẽ làm hỏng nhau."""
+
+_profile_active = threading.Lock()   # mỗi process chỉ 1 ProfileSession tại 1 thời điểm
+
+class ProfileSession:
+    """cProfile cho thread request + từng worker thread, gộp lại khi kết thúc; kèm tracemalloc peak."""
+
+    def __init__(self, top: int = PROFILE_TOP_DEFAULT):
+        import cProfile
+        self.top = max(1, min(int(top), 200))
+        self._cprofile = cProfile
+        self._main = cProfile.Profile()
+        self._profiles = [self._main]
+        self._lock = threading.Lock()
+        self._own_tracemalloc = False
+        self._t0 = 0.0
+
+    def start(self):
+        """Raise ProfileBusy nếu đang có session khác; ValueError nếu profiler khác (debugger...) đang chạy."""
+        import tracemalloc
+        if not _profile_active.acquire(blocking=False):
+            raise ProfileBusy()
+        try:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._own_tracemalloc = True
+            tracemalloc.reset_peak()
+            self._t0 = time.perf_counter()
+            self._main.enable()
+        except BaseException:
+            if self._own_tracemalloc:
+                tracemalloc.stop()
+            _profile_active.release()
+            raise
+
+    def wrap(self, fn):
+        """Bọc target của worker thread để thread đó cũng được profile."""
+        def run(*args, **kwargs):
+            prof = self._cprofile.Profile()
+            try:
+                prof.enable()
+            except ValueError:
+                # Python 3.12+: profiler của thread request đã theo dõi mọi thread
+                return fn(*args, **kwargs)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                prof.disable()
+                with self._lock:
+                    self._profiles.append(prof)
+        return run
+
+    def stop(self) -> dict:
+        import pstats, tracemalloc
+        try:
+            self._main.disable()
+            wall = time.perf_counter() - self._t0
+            _, peak = tracemalloc.get_traced_memory()
+            if self._own_tracemalloc:
+                tracemalloc.stop()
+        finally:
+            _profile_active.release()
+
+        with self._lock:
+            stats = pstats.Stats(self._profiles[0])
+            for prof in self._profiles[1:]:
+                stats.add(prof)
+
+        rows, by_file = [], {}
+        for (path, line, func), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            fname = os.path.basename(path) if path != "~" else "<builtin>"
+            rows.append((cumtime, tottime, ncalls, f"{fname}:{line}({func})"))
+            by_file[fname] = by_file.get(fname, 0.0) + tottime
+        rows.sort(reverse=True)
+        return {
+            "wall_ms": round(wall * 1000, 2),
+            "threads": len(self._profiles),
+            "tracemalloc_peak_kb": round(peak / 1024, 1),
+            "top_cumulative": [
+                {"func": name, "ncalls": n, "cum_ms": round(cum * 1000, 3), "self_ms": round(tot * 1000, 3)}
+                for cum, tot, n, name in rows[: self.top]
+            ],
+            # list [file, ms] thay vì dict: JSON provider sort key sẽ làm mất thứ tự
+            "self_ms_by_file": [
+                [k, round(v * 1000, 3)]
+                for k, v in sorted(by_file.items(), key=lambda kv: kv[1], reverse=True)[:15]
+            ],
+        }
+
+def current_profile_session() -> Optional[ProfileSession]:
+    return g.get("profile_session") if has_request_context() else None
+
+def profiled(fn):
+    session = current_profile_session()
+    return fn if session is None else session.wrap(fn)
+
+@app.before_request
+def _profile_request_start():
+    token = request.headers.get("X-Profile")
+    if not PROFILE_SECRET or not token:
+        return None
+    if not hmac.compare_digest(token.encode("utf-8"), PROFILE_SECRET.encode("utf-8")):
+        return None
+    try:
+        top = int(request.headers.get("X-Profile-Top") or PROFILE_TOP_DEFAULT)
+    except ValueError:
+        top = PROFILE_TOP_DEFAULT
+    session = ProfileSession(top)
+    try:
+        session.start()
+    except ProfileBusy:
+        return jsonify({"ok": False, "error": "Dang profile request khac, thu lai sau."}), 409
+    except ValueError as e:
+        return jsonify({"ok": False, "error": f"Khong bat duoc profiler: {e}"}), 409
+    g.profile_session = session
+    return None
+
+@app.after_request
+def _profile_request_end(resp):
+    session = g.pop("profile_session", None)
+    if session is None:
+        return resp
+    report = session.stop()
+    body = resp.get_json(silent=True) if resp.is_json and not resp.is_streamed else None
+    if isinstance(body, dict):
+        body["_profile"] = report
+        resp.set_data(app.json.dumps(body))
+    else:
+        resp.headers["X-Profile-Summary"] = (
+            f"wall_ms={report['wall_ms']}; tracemalloc_peak_kb={report['tracemalloc_peak_kb']}"
+        )
+    return resp
+
+@app.teardown_request
+def _profile_request_teardown(exc):
+    # request lỗi giữa chừng (không qua after_request) -> vẫn tắt profiler
+    session = g.pop("profile_session", None)
+    if session is not None:
+        session.stop()
+
+# ================= Bulk confirm (per cookie) =================
+def new_cookie_row(ck: str) -> CookieRow:
+    return CookieRow(
+        cookie=ck,
+        cookie_preview=(ck[:56] + "...") if len(ck) > 56 else ck,
+        live=False,
+        delivered_count=0,
+        confirmed_count=0,
+        already_count=0,
+        failed_count=0,
+        note="",
+        order_api_error="",
+    )
+
+def apply_no_orders(row: CookieRow, live_meta: dict):
+    row.live = bool(live_meta.get("live"))
+    if row.live:
+        row.note = row.order_api_error or "Khong co don gan day."
+    else:
+        row.note = str(live_meta.get("error") or "").strip() or "Cookie die/het han."
+
+def order_row_from_store(row: CookieRow, oid: str, rec: dict) -> OrderRow:
+    # đã xác nhận ở lần chạy trước -> trả kết quả từ store, không gọi Shopee
+    row.delivered_count += 1
+    row.confirmed_count += 1
+    row.already_count += 1
+    return OrderRow(
+        cookie_preview=row.cookie_preview,
+        order_id=oid,
+        tracking_no=rec["tracking_no"],
+        status_text=rec["status_text"] or "—",
+        ok=True,
+        state="already",
+        result_text="ℹ️ Da xac nhan truoc do",
+        api_data={},
+    )
+
+def order_row_from_confirm(row: CookieRow, oid: str, view: OrderDetailView,
+                           ok_confirm: bool, confirm_data, confirm_err, replayed: bool = False) -> OrderRow:
+    summary = view.summary()
+    confirm_state = "success"
+    result_text = "✅ Thanh cong"
+    if ok_confirm and replayed:
+        # kết quả lấy từ ConfirmLedger (vừa confirm ở request khác) -> coi như đã xác nhận trước đó
+        confirm_state = "already"
+        result_text = "ℹ️ Da xac nhan truoc do"
+    if not ok_confirm:
+        if _confirm_error_is_already_done(confirm_err, confirm_data):
+            ok_confirm = True
+            confirm_state = "already"
+            result_text = "ℹ️ Da xac nhan truoc do"
+        else:
+            confirm_state = "failed"
+            result_text = f"❌ {_humanize_confirm_error(confirm_err, confirm_data)}"
+
+    if ok_confirm:
+        row.confirmed_count += 1
+        if confirm_state == "already":
+            row.already_count += 1
+    else:
+        row.failed_count += 1
+
+    return OrderRow(
+        cookie_preview=row.cookie_preview,
+        order_id=oid,
+        tracking_no=summary.tracking_no,
+        status_text=summary.status_text or "—",
+        ok=bool(ok_confirm),
+        state=confirm_state,
+        result_text=result_text,
+        api_data=confirm_data if isinstance(confirm_data, dict) else {},
+    )
+
+def finish_cookie_row(row: CookieRow):
+    if row.delivered_count <= 0:
+        row.note = "Khong co don GTC de xac nhan."
+    elif row.failed_count > 0:
+        row.note = f"Xac nhan {row.confirmed_count}/{row.delivered_count} don."
+    elif row.already_count > 0:
+        row.note = f"Da xac nhan/da co san {row.confirmed_count} don."
+    else:
+        row.note = f"Da xac nhan {row.confirmed_count} don."
+
+def group_by_identity(contexts) -> list:
+    """
+    Gom các cookie cùng 1 tài khoản (CookieContext.identity: SPC_U -> session key -> hash).
+    -> list nhóm vị trí, giữ thứ tự xuất hiện; phần tử đầu của nhóm là cookie chạy chính.
+    """
+    groups, by_identity = [], {}
+    for pos, ctx in enumerate(contexts):
+        group = by_identity.get(ctx.identity)
+        if group is None:
+            group = by_identity[ctx.identity] = []
+            groups.append(group)
+        group.append(pos)
+    return groups
+
+def alias_cookie_row(ctx: CookieContext, primary: CookieRow, primary_index: int,
+                     tried: Optional[CookieRow] = None) -> CookieRow:
+    """
+    Cookie trùng tài khoản: trỏ về row chính (count = 0 để tổng không bị cộng 2 lần), chỉ đơn lấy từ row chính.
+    tried: row của chính cookie này khi nó đã được thử và die (token cũ) -> giữ live / note của nó.
+    Cookie chưa thử thì lấy live của row chính.
+    """
+    if tried is not None:
+        row = tried
+        row.note = f"{row.note.rstrip('. ')}. Trung tai khoan voi cookie #{primary_index}.".lstrip(". ")
+    else:
+        row = new_cookie_row(ctx.cookie)
+        row.live = primary.live
+        row.note = f"Trung tai khoan voi cookie #{primary_index} (khong kiem tra rieng)."
+    row.alias_of = primary_index
+    return row
+
+def expand_identity_groups(contexts, groups, group_results) -> list:
+    """
+    group_results[i] = (vị trí cookie đã chạy, (CookieRow, [OrderRow], store_hits), {vị trí: CookieRow die})
+    hoặc None (nhóm không chạy) -> results theo thứ tự input (None ở vị trí không chạy).
+    """
+    results = [None] * len(contexts)
+    for group, group_result in zip(groups, group_results):
+        if group_result is None:
+            continue
+        used_pos, res, dead_rows = group_result
+        results[used_pos] = res
+        for pos in group:
+            if pos != used_pos:
+                row = alias_cookie_row(contexts[pos], res[0], used_pos + 1, tried=dead_rows.get(pos))
+                results[pos] = (row, [], 0)
+    return results
+
+def unique_order_ids(ids, order_limit: int) -> list:
+    out, seen = [], set()
+    for oid in ids[:order_limit]:
+        oid = str(oid or "").strip()
+        if not oid or oid in seen:
+            continue
+        seen.add(oid)
+        out.append(oid)
+    return out
+
+# ================= Async engine (tùy chọn) =================
+# HTTP_ENGINE=async (hoặc body "engine": "async") -> fan-out bằng asyncio trên 1 ClientSession dùng chung.
+# Có aiohttp thì dùng aiohttp; không có thì rơi về http_get/http_post chạy trong thread.
+# Mọi request chạy trên 1 event loop nền của process -> session / pool keep-alive sống qua các request.
+HTTP_ENGINE = (os.environ.get("HTTP_ENGINE") or "sync").strip().lower()
+ASYNC_MAX_CONCURRENCY = int(os.environ.get("ASYNC_MAX_CONCURRENCY") or 64)
+
+def resolve_engine(payload: dict) -> str:
+    val = str((payload or {}).get("engine") or HTTP_ENGINE).strip().lower()
+    return "async" if val == "async" else "sync"
+
+def aiohttp_module():
+    try:
+        import aiohttp
+    except ImportError:
+        return None
+    return aiohttp
+
+_async_loop = None
+_async_client = None
+_async_lock = threading.Lock()
+
+def async_loop():
+    """Event loop nền dùng chung (thread daemon), dựng lần đầu có request async."""
+    global _async_loop
+    if _async_loop is None:
+        with _async_lock:
+            if _async_loop is None:
+                import asyncio, atexit
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="async-engine", daemon=True).start()
+                atexit.register(close_async_engine)
+                _async_loop = loop
+    return _async_loop
+
+def run_async(coro):
+    """
+    Chạy coroutine trên loop nền và chờ kết quả. Đang profile request (X-Profile) thì chạy
+    asyncio.run ngay trong thread hiện tại để cProfile thấy được (client riêng, không dùng pool chung).
+    """
+    import asyncio
+    if current_profile_session() is not None:
+        return asyncio.run(coro)
+    return asyncio.run_coroutine_threadsafe(coro, async_loop()).result()
+
+@asynccontextmanager
+async def async_http():
+    """AsyncHTTP dùng chung của loop nền (không đóng sau request); loop khác -> client riêng đóng khi xong."""
+    import asyncio
+    global _async_client
+    if _async_loop is not None and asyncio.get_running_loop() is _async_loop:
+        if _async_client is None:
+            # chỉ thread của loop nền chạy tới đây -> không cần lock
+            _async_client = await AsyncHTTP().__aenter__()
+        yield _async_client
+    else:
+        async with AsyncHTTP() as client:
+            yield client
+
+def close_async_engine(timeout: float = 2.0):
+    """Đóng session dùng chung + dừng loop nền (atexit)."""
+    global _async_loop, _async_client
+    loop, client = _async_loop, _async_client
+    _async_loop = _async_client = None
+    if loop is None:
+        return
+    import asyncio
+    if client is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(client.__aexit__(None, None, None), loop).result(timeout)
+        except Exception:
+            pass
+    loop.call_soon_threadsafe(loop.stop)
+
+async def read_capped_async(chunks, limit: int):
+    buf = bytearray()
+    async for chunk in chunks:
+        buf += chunk
+        if len(buf) > limit:
+            del buf[limit:]
+            return bytes(buf), True
+    return bytes(buf), False
+
+class AsyncHTTP:
+    """1 client (pool keep-alive) + semaphore giới hạn số request đang bay, gắn với 1 event loop."""
+
+    def __init__(self, max_concurrency: int = ASYNC_MAX_CONCURRENCY):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self._sem = None
+        self._client = None
+        self._aiohttp = aiohttp_module()
+
+    async def __aenter__(self):
+        import asyncio
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        if self._aiohttp is not None:
+            connector = self._aiohttp.TCPConnector(limit=self.max_concurrency, ttl_dns_cache=300)
+            # DummyCookieJar: không giữ Set-Cookie giữa các cookie khác nhau
+            self._client = self._aiohttp.ClientSession(
+                connector=connector, cookie_jar=self._aiohttp.DummyCookieJar(),
+            )
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def _send(self, method: str, url: str, headers: dict, timeout, **kw):
+        import asyncio
+        async with self._sem:
+            if self._client is None:
+                # http_get/http_post tự đi qua circuit breaker
+                if method == "GET":
+                    return await asyncio.to_thread(http_get, url, headers, kw.get("params"), timeout)
+                return await asyncio.to_thread(http_post, url, headers, kw.get("json"), timeout)
+            breaker = breaker_for(url)
+            ticket = breaker.allow() if breaker is not None else None
+            if breaker is not None and ticket is None:
+                return breaker.rejection()
+            status, t0 = 0, time.perf_counter()
+            try:
+                if HTTP_TRANSPORT == "replay":
+                    # lần đầu nạp corpus gzip -> chạy ngoài event loop
+                    corpus = await off_loop(True, get_replay_corpus)
+                    status, body, delay = await off_loop(True, corpus.lookup, method, url, headers, kw)
+                    await asyncio.sleep(delay)
+                    return status, body
+                status, result = await self._send_live(method, url, headers, timeout, kw)
+                if HTTP_TRANSPORT == "record":
+                    # ghi gzip dưới lock của recorder -> chạy ngoài event loop
+                    await off_loop(True, get_recorder().record, method, url, headers, kw, result,
+                                   time.perf_counter() - t0)
+                return result
+            finally:
+                if breaker is not None:
+                    breaker.record(ticket, status, time.perf_counter() - t0)
+
+    async def _send_live(self, method: str, url: str, headers: dict, timeout, kw: dict):
+        import asyncio
+        aiohttp = self._aiohttp
+        try:
+            async with self._client.request(
+                method, url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout), **kw
+            ) as r:
+                ctype = r.headers.get("Content-Type") or ""
+                if declared_too_large(ctype, r.content_length):
+                    data, truncated = b"", True
+                else:
+                    data, truncated = await read_capped_async(r.content.iter_chunked(_READ_CHUNK), body_limit(ctype))
+                return r.status, decode_upstream_body(r.status, ctype, data, truncated, r.charset)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            return 0, (0, {"error": str(e) or type(e).__name__})
+
+    async def get(self, url: str, headers: dict, params: dict | None = None, timeout: int = 12):
+        return await self._send("GET", url, headers, timeout, params=params)
+
+    async def post(self, url: str, headers: dict, payload: dict | None = None, timeout: int = 12):
+        return await self._send("POST", url, headers, timeout, json=(payload or {}))
+
+# Cache dùng chung với engine sync (get / set thường, không single-flight giữa coroutine).
+async def off_loop(blocking: bool, fn, *args):
+    """Gọi hàm có thể chặn (cache sqlite / redis, order store) từ coroutine: blocking -> chạy trong thread."""
+    if not blocking:
+        return fn(*args)
+    import asyncio
+    return await asyncio.to_thread(fn, *args)
+
+async def fetch_shopee_account_info_async(client: AsyncHTTP, cookie: str, timeout: int = 10):
+    ctx = as_cookie_context(cookie)
+    key = account_cache_key(ctx)
+    hit = await off_loop(ACCOUNT_CACHE.blocking, ACCOUNT_CACHE.get, key)
+    if hit is not None:
+        return hit
+    status, raw = await client.get(CHECK_URL, ctx.account_headers, timeout=timeout)
+    result = _account_info_result(status, raw)
+    if result["live"]:
+        await off_loop(ACCOUNT_CACHE.blocking, ACCOUNT_CACHE.set, key, result)
+    return result
+
+async def fetch_order_ids_with_meta_async(client: AsyncHTTP, cookie: str, limit: int = 6, offset: int = 0, timeout: int = 12):
+    ctx = as_cookie_context(cookie)
+    variants = await off_loop(VARIANT_CACHE.blocking, order_variants, ctx)
+    last_status, last_data = 0, {}
+    for idx, headers in variants:
+        status, data = await client.get(
+            ORDER_LIST_URL, headers, params={"limit": int(limit), "offset": int(offset)}, timeout=timeout,
+        )
+        last_status, last_data = status, data
+        if status != 200 or not isinstance(data, dict):
+            continue
+        uniq = order_ids_from_list(data)
+        if uniq:
+            await off_loop(VARIANT_CACHE.blocking, remember_variant, ctx, variants, idx)
+            return uniq, {"status_code": status, "error": ""}
+    return [], {"status_code": last_status, "error": upstream_error_text(last_status, last_data)}
+
+async def fetch_order_detail_by_id_async(client: AsyncHTTP, cookie: str, order_id: str, timeout: int = 12,
+                                         prune: bool = True):
+    ctx = as_cookie_context(cookie)
+    prune = prune or not DETAIL_PRUNE
+    key = f"{ctx.session}:{order_id}"
+    hit = await off_loop(DETAIL_CACHE.blocking, DETAIL_CACHE.get, key) if prune else None
+    if hit is not None:
+        return tuple(hit)
+    variants = await off_loop(VARIANT_CACHE.blocking, order_variants, ctx)
+    last_status, last_data = 0, {}
+    for idx, headers in variants:
+        status, data = await client.get(
+            ORDER_DETAIL_URL, headers, params={"order_id": str(order_id)}, timeout=timeout,
+        )
+        last_status, last_data = status, data
+        if status == 200 and isinstance(data, dict):
+            await off_loop(VARIANT_CACHE.blocking, remember_variant, ctx, variants, idx)
+            if not prune:
+                return data, {"status_code": status, "error": ""}
+            result = (prune_detail(data) if DETAIL_PRUNE else data), {"status_code": status, "error": ""}
+            await off_loop(DETAIL_CACHE.blocking, DETAIL_CACHE.set, key, result)
+            return result
+    return (
+        (last_data if isinstance(last_data, dict) else {}),
+        {"status_code": last_status, "error": upstream_error_text(last_status, last_data)},
+    )
+
+async def request_buyer_confirm_order_async(client: AsyncHTTP, order_id: str, cookie_text, timeout: float = 15):
+    req, err = build_confirm_request(order_id, cookie_text)
+    if err:
+        return False, {}, err
+    headers, payload = req
+    status, body = await client.post(SHOPEE_CONFIRM_URL, headers, payload=payload, timeout=timeout)
+    return confirm_result(status, body)
+
+async def confirm_order_once_async(client: AsyncHTTP, order_id: str, ctx: CookieContext, timeout: float = 15,
+                                   idempotency_key: Optional[str] = None):
+    """Bản async của confirm_order_once (dùng chung ConfirmLedger với engine sync)."""
+    import asyncio
+    ledger = CONFIRM_LEDGER
+    if ledger is None:
+        return (*await request_buyer_confirm_order_async(client, order_id, ctx, timeout=timeout), False)
+    keys = ledger.keys_for(ctx.session, order_id, idempotency_key)
+    kind, val = ledger.begin(keys, order_id)
+    if kind == "replay":
+        return (*val, True)
+    if kind == "wait":
+        if await asyncio.to_thread(val.event.wait, timeout + 1) and val.result is not None:
+            return (*val.result, True)
+        return (*await request_buyer_confirm_order_async(client, order_id, ctx, timeout=timeout), False)
+    result = (False, {}, "Xac nhan don that bai.")
+    try:
+        result = await request_buyer_confirm_order_async(client, order_id, ctx, timeout=timeout)
+    finally:
+        ledger.finish(keys, order_id, val, result)
+    return (*result, False)
+
+async def fetch_orders_and_details_async(client: AsyncHTTP, cookie: str, list_limit: int = DEFAULT_LIST_LIMIT,
+                                         offset: int = 0, store=None, identity: Optional[str] = None,
+                                         prune: bool = True):
+    """Giống fetch_orders_and_details, nhưng các get_order_detail chạy song song."""
+    import asyncio
+    ctx = as_cookie_context(cookie)
+    variants = await off_loop(VARIANT_CACHE.blocking, order_variants, ctx)
+    list_status, data1 = 0, {}
+    for idx, headers in variants:
+        list_status, data1 = await client.get(
+            ORDER_LIST_URL, headers, params={"limit": int(list_limit), "offset": int(offset)},
+        )
+        if list_status == 200 and isinstance(data1, dict):
+            await off_loop(VARIANT_CACHE.blocking, remember_variant, ctx, variants, idx)
+            break
+
+    order_ids = bfs_values_by_key(data1, ("order_id",)) if isinstance(data1, dict) else []
+    seen, uniq = set(), []
+    for oid in order_ids:
+        if oid not in seen:
+            seen.add(oid)
+            uniq.append(oid)
+
+    read_store = store is not None and identity and store_raw_usable(prune)
+
+    async def one(oid):
+        rec = await off_loop(True, store.get_final, identity, str(oid)) if read_store else None
+        if rec is not None:
+            return {"order_id": oid, "http_status": 200, "raw": rec["raw"], "from_store": True}
+        data2, meta = await fetch_order_detail_by_id_async(client, cookie, oid, prune=prune)
+        return {"order_id": oid, "http_status": meta.get("status_code"), "raw": data2}
+
+    details = await asyncio.gather(*(one(oid) for oid in uniq[: int(list_limit)]))
+    return {"list_http_status": list_status, "list_raw": data1, "details": list(details)}
+
+async def check_cookie_fetch_async(cookie: str, list_limit: int, store=None, identity: Optional[str] = None,
+                                   prune: bool = True):
+    import asyncio
+    async with async_http() as client:
+        return await asyncio.gather(
+            fetch_shopee_account_info_async(client, cookie, timeout=10),
+            fetch_orders_and_details_async(client, cookie, list_limit=list_limit, offset=0,
+                                           store=store, identity=identity, prune=prune),
+        )
+
+# ================= Graceful drain (server tự host) =================
+# SIGTERM -> begin_drain(): bulk đang chạy không mở cookie mới, làm nốt các cookie đang dở rồi trả partial + cursor;
+# bulk mới nhận 503 + Retry-After. Trên Vercel không ai gọi begin_drain() nên không đổi gì.
+DRAIN = threading.Event()
+_bulk_inflight = 0
+_bulk_inflight_cond = threading.Condition()
+
+def begin_drain():
+    DRAIN.set()
+    with _bulk_inflight_cond:
+        _bulk_inflight_cond.notify_all()
+
+def wait_drained(timeout: float) -> bool:
+    """Chờ các request bulk đang chạy xong (tối đa timeout giây). -> True nếu đã hết."""
+    until = time.monotonic() + max(0.0, timeout)
+    with _bulk_inflight_cond:
+        while _bulk_inflight:
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                break
+            _bulk_inflight_cond.wait(remaining)
+        return _bulk_inflight == 0
+
+def drain_metrics() -> dict:
+    with _bulk_inflight_cond:
+        return {"pid": os.getpid(), "draining": DRAIN.is_set(), "bulk_inflight": _bulk_inflight}
+
+def bulk_request(fn):
+    """Đếm request bulk đang chạy; đang drain thì từ chối request mới."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        global _bulk_inflight
+        with _bulk_inflight_cond:
+            if DRAIN.is_set():
+                resp = jsonify({"ok": False, "error": "Server dang tat, thu lai sau"})
+                resp.status_code = 503
+                resp.headers["Retry-After"] = "5"
+                return resp
+            _bulk_inflight += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with _bulk_inflight_cond:
+                _bulk_inflight -= 1
+                _bulk_inflight_cond.notify_all()
+    return wrapper
+
+# ================= Bulk pipeline (list -> detail -> classify -> confirm) =================
+# Mỗi cookie (nhóm cùng tài khoản) là 1 job; mỗi bước là 1 stage có hàng đợi giới hạn + số worker riêng,
+# nên confirm của đơn đã xong chạy song song với detail của đơn khác.
+# Trong từng stage, task được lấy xoay vòng giữa các cookie, cookie chưa chạy được ưu tiên.
+PIPELINE_STAGES = ("list", "detail", "classify", "confirm")
+
+def parse_stage_workers(raw: Optional[str], defaults: dict) -> dict:
+    """"detail=16,confirm=8" -> dict worker theo stage (stage không ghi giữ mặc định)."""
+    out = dict(defaults)
+    for part in (raw or "").split(","):
+        name, _, val = part.partition("=")
+        name = name.strip().lower()
+        if name in out and val.strip().isdigit():
+            out[name] = max(1, int(val))
+    return out
+
+BULK_STAGE_WORKERS = parse_stage_workers(
+    os.environ.get("BULK_STAGE_WORKERS"), {"list": 4, "detail": 8, "classify": 2, "confirm": 8},
+)
+ASYNC_STAGE_WORKERS = parse_stage_workers(
+    os.environ.get("ASYNC_STAGE_WORKERS"), {"list": 16, "detail": 32, "classify": 4, "confirm": 32},
+)
+BULK_STAGE_QUEUE = int(os.environ.get("BULK_STAGE_QUEUE") or 64)
+# Hạn chót của 1 request bulk (giây): còn < RESERVE thì không mở cookie mới, gần hết hạn thì dừng hẳn
+# và trả kết quả dở dang + cursor để gọi tiếp.
+BULK_DEADLINE_S = float(os.environ.get("BULK_DEADLINE_S") or 25)
+BULK_DEADLINE_RESERVE_S = float(os.environ.get("BULK_DEADLINE_RESERVE_S") or 6)
+
+def _ms_summary(values) -> dict:
+    vals = sorted(values)
+    if not vals:
+        return {"avg": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    pick = lambda q: vals[min(len(vals) - 1, int(q * len(vals)))]
+    return {
+        "avg": round(sum(vals) / len(vals) * 1000, 2),
+        "p50": round(pick(0.50) * 1000, 2),
+        "p95": round(pick(0.95) * 1000, 2),
+        "max": round(vals[-1] * 1000, 2),
+    }
+
+class FairQueue:
+    """Hàng đợi round-robin theo slot (cookie): mỗi lượt lấy 1 task của 1 slot rồi đưa slot xuống cuối vòng."""
+
+    def __init__(self):
+        self._fresh = deque()      # slot chưa lấy task nào
+        self._ring = deque()       # slot đã bắt đầu, còn task
+        self._tasks = {}           # slot -> deque[(enqueued_at, fn)]
+        self._started = set()
+        self.depth = 0
+
+    def __len__(self):
+        return self.depth
+
+    def push(self, slot, fn):
+        q = self._tasks.get(slot)
+        if q is None:
+            q = self._tasks[slot] = deque()
+            (self._ring if slot in self._started else self._fresh).append(slot)
+        q.append((time.perf_counter(), fn))
+        self.depth += 1
+
+    def ready(self, allow_fresh: bool = True) -> bool:
+        return bool(self._ring) or (allow_fresh and bool(self._fresh))
+
+    def pop(self, allow_fresh: bool = True):
+        """-> (slot, fn, thời gian chờ) hoặc None. allow_fresh=False: chỉ lấy task của slot đã bắt đầu."""
+        if allow_fresh and self._fresh:
+            slot = self._fresh.popleft()
+            self._started.add(slot)
+        elif self._ring:
+            slot = self._ring.popleft()
+        else:
+            return None
+        q = self._tasks[slot]
+        enqueued_at, fn = q.popleft()
+        if q:
+            self._ring.append(slot)
+        else:
+            del self._tasks[slot]
+        self.depth -= 1
+        return slot, fn, time.perf_counter() - enqueued_at
+
+class _StageStats:
+    __slots__ = ("workers", "capacity", "tasks", "depth_max", "depth_sum", "waits", "busy", "first_start", "last_end")
+
+    def __init__(self, workers: int, capacity: Optional[int]):
+        self.workers = workers
+        self.capacity = capacity
+        self.tasks = 0
+        self.depth_max = 0
+        self.depth_sum = 0
+        self.waits = []
+        self.busy = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def to_dict(self) -> dict:
+        window = (self.last_end - self.first_start) if self.tasks else 0.0
+        return {
+            "workers": self.workers,
+            "queue_capacity": self.capacity,
+            "tasks": self.tasks,
+            "queue_depth_max": self.depth_max,
+            "queue_depth_avg": round(self.depth_sum / self.tasks, 2) if self.tasks else 0.0,
+            "wait_ms": _ms_summary(self.waits),
+            "busy_ms": round(self.busy * 1000, 2),
+            "throughput_per_s": round(self.tasks / window, 2) if window > 0 else 0.0,
+        }
+
+class BulkPipeline:
+    """
+    Các stage nối tiếp, mỗi stage 1 FairQueue + nhóm worker riêng. Hàng đợi đầy thì submit chờ (backpressure);
+    stage đầu ("list") không giới hạn vì được nạp sẵn toàn bộ cookie. Chạy bằng thread (sync) hoặc coroutine (async).
+    """
+
+    def __init__(self, workers: dict, capacity: int = BULK_STAGE_QUEUE, deadline_at: Optional[float] = None):
+        self._queues = {name: FairQueue() for name in PIPELINE_STAGES}
+        self._stats = {
+            name: _StageStats(max(1, int(workers.get(name) or 1)), None if i == 0 else max(1, int(capacity)))
+            for i, name in enumerate(PIPELINE_STAGES)
+        }
+        self._cond = threading.Condition()
+        self._acond = None         # asyncio.Condition khi chạy async
+        self._inflight = 0
+        self._error = None
+        self._t0 = time.perf_counter()
+        self._first_result = {}    # slot -> thời điểm đơn đầu tiên của cookie được phân loại / xác nhận
+        self._pending = {}         # slot -> số task đã submit chưa chạy xong
+        self._listed_any = False
+        self.deadline_hit = False
+        self.drained = False       # server drain cắt bớt cookie chưa mở
+        # deadline_at (perf_counter): mốc dừng mở cookie mới và mốc dừng hẳn
+        self.deadline_at = deadline_at
+        if deadline_at is not None:
+            budget = max(0.0, deadline_at - self._t0)
+            self._stop_new_at = deadline_at - min(BULK_DEADLINE_RESERVE_S, budget / 2)
+            self._stop_all_at = deadline_at - min(1.0, budget / 10)
+
+    def pending(self, slot) -> int:
+        return self._pending.get(slot, 0)
+
+    def timeout_for(self, default: float) -> float:
+        """Timeout HTTP không vượt quá mốc dừng hẳn (tối thiểu 1s)."""
+        if self.deadline_at is None:
+            return default
+        return max(1.0, min(default, self._stop_all_at - time.perf_counter()))
+
+    # ---- bookkeeping (gọi khi giữ cond / trong event loop) ----
+    def _full(self, stage: str) -> bool:
+        # đã dừng (lỗi / hết hạn) thì không chặn submit nữa: task chỉ nằm lại trong hàng đợi
+        cap = self._stats[stage].capacity
+        return cap is not None and len(self._queues[stage]) >= cap and not self._stopped(time.perf_counter())
+
+    def _wait_timeout(self) -> Optional[float]:
+        # có deadline thì không chờ quá mốc dừng hẳn, để worker/submit tự thức dậy khi hết hạn
+        if self.deadline_at is None:
+            return None
+        return max(0.01, self._stop_all_at - time.perf_counter())
+
+    def _push(self, stage: str, slot, fn):
+        q, st = self._queues[stage], self._stats[stage]
+        q.push(slot, fn)
+        st.depth_max = max(st.depth_max, len(q))
+        self._pending[slot] = self._pending.get(slot, 0) + 1
+
+    def _allow_fresh(self, stage: str, now: float) -> bool:
+        # sau mốc stop_new / khi server drain không mở cookie mới (trừ khi chưa cookie nào chạy, để luôn có tiến triển)
+        if stage != PIPELINE_STAGES[0] or not self._listed_any:
+            return True
+        if DRAIN.is_set():
+            self.drained = True
+            return False
+        return self.deadline_at is None or now < self._stop_new_at
+
+    def _stopped(self, now: float) -> bool:
+        return self._error is not None or (self.deadline_at is not None and now >= self._stop_all_at)
+
+    def _ready(self, stage: str, now: float) -> bool:
+        return not self._stopped(now) and self._queues[stage].ready(self._allow_fresh(stage, now))
+
+    def _idle(self) -> bool:
+        # không còn task đang chạy và không stage nào còn task được phép lấy
+        if self._inflight:
+            return False
+        now = time.perf_counter()
+        return not any(self._ready(stage, now) for stage in PIPELINE_STAGES)
+
+    def _take(self, stage: str):
+        now = time.perf_counter()
+        if self._stopped(now):
+            return None
+        q = self._queues[stage]
+        depth = len(q)
+        item = q.pop(self._allow_fresh(stage, now))
+        if item is None:
+            return None
+        if stage == PIPELINE_STAGES[0]:
+            self._listed_any = True
+        st = self._stats[stage]
+        st.tasks += 1
+        st.depth_sum += depth
+        st.waits.append(item[2])
+        self._inflight += 1
+        return item[0], item[1], time.perf_counter()
+
+    def _finish(self, stage: str, slot, started: float, error=None):
+        now = time.perf_counter()
+        st = self._stats[stage]
+        st.busy += now - started
+        st.first_start = started if st.first_start is None else min(st.first_start, started)
+        st.last_end = now if st.last_end is None else max(st.last_end, now)
+        self._inflight -= 1
+        self._pending[slot] -= 1
+        if error is not None and self._error is None:
+            self._error = error
+
+    def mark_result(self, slot):
+        """Cookie vừa có kết quả đơn (phân loại / xác nhận / lấy từ store): chỉ ghi lần đầu."""
+        self._first_result.setdefault(slot, time.perf_counter() - self._t0)
+
+    def _mark_cut(self):
+        # worker thoát mà vẫn còn task trong hàng đợi -> bị cắt bởi deadline
+        if any(len(q) for q in self._queues.values()):
+            self.deadline_hit = True
+
+    # ---- sync ----
+    def submit(self, stage: str, slot, fn):
+        with self._cond:
+            while self._full(stage):
+                self._cond.wait(self._wait_timeout())
+            self._push(stage, slot, fn)
+            self._cond.notify_all()
+
+    def _worker(self, stage: str):
+        while True:
+            with self._cond:
+                item = self._take(stage)
+                while item is None and not self._idle() and self._error is None:
+                    self._cond.wait(self._wait_timeout())
+                    item = self._take(stage)
+                if item is None:
+                    self._mark_cut()
+                    self._cond.notify_all()
+                    return
+            slot, fn, started = item
+            error = None
+            try:
+                fn()
+            except Exception as e:
+                error = e
+            with self._cond:
+                self._finish(stage, slot, started, error)
+                self._cond.notify_all()
+
+    def run(self):
+        worker = profiled(self._worker)
+        threads = [
+            threading.Thread(target=worker, args=(stage,), daemon=True)
+            for stage in PIPELINE_STAGES for _ in range(self._stats[stage].workers)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if self._error is not None:
+            raise self._error
+
+    # ---- async ----
+    async def _wait_async(self):
+        import asyncio
+        try:
+            await asyncio.wait_for(self._acond.wait(), self._wait_timeout())
+        except asyncio.TimeoutError:
+            pass
+
+    async def submit_async(self, stage: str, slot, fn):
+        async with self._acond:
+            while self._full(stage):
+                await self._wait_async()
+            self._push(stage, slot, fn)
+            self._acond.notify_all()
+
+    async def _worker_async(self, stage: str):
+        while True:
+            async with self._acond:
+                item = self._take(stage)
+                while item is None and not self._idle() and self._error is None:
+                    await self._wait_async()
+                    item = self._take(stage)
+                if item is None:
+                    self._mark_cut()
+                    self._acond.notify_all()
+                    return
+            slot, fn, started = item
+            error = None
+            try:
+                await fn()
+            except Exception as e:
+                error = e
+            async with self._acond:
+                self._finish(stage, slot, started, error)
+                self._acond.notify_all()
+
+    async def run_async(self):
+        import asyncio
+        self._acond = asyncio.Condition()
+        await asyncio.gather(*(
+            self._worker_async(stage) for stage in PIPELINE_STAGES for _ in range(self._stats[stage].workers)
+        ))
+        if self._error is not None:
+            raise self._error
+
+    def stats(self) -> dict:
+        return {
+            "stages": {name: self._stats[name].to_dict() for name in PIPELINE_STAGES},
+            "first_result_ms": _ms_summary(self._first_result.values()),
+            "elapsed_ms": round((time.perf_counter() - self._t0) * 1000, 2),
+            "deadline_hit": self.deadline_hit,
+            "drained": self.drained,
+        }
+
+class BulkCookieJob:
+    """
+    Trạng thái list -> detail -> classify -> confirm của 1 nhóm cookie cùng tài khoản.
+    run_* gọi HTTP; on_* xử lý kết quả (dùng chung cho sync/async) và trả về các task tiếp theo,
+    được submit ngoài lock của job (submit có thể chờ khi stage sau đầy).
+    """
+
+    def __init__(self, pipeline: BulkPipeline, slot: int, contexts, group, order_limit: int,
+                 store=None, client: Optional[AsyncHTTP] = None, skip_oids=()):
+        self.pipeline = pipeline
+        self.slot = slot
+        self.contexts = contexts
+        self.group = group
+        self.order_limit = order_limit
+        self.store = store
+        self.client = client
+        self.attempt = 0
+        self.dead_rows = {}        # vị trí cookie đã thử nhưng die -> CookieRow của chính nó
+        self.skip_oids = frozenset(str(x) for x in skip_oids)   # đã xác nhận ở lượt trước (resume cursor)
+        self.started = False
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.ctx = self.contexts[self.group[self.attempt]]
+        self.identity = self.ctx.identity if self.store is not None else None
+        self.row = new_cookie_row(self.ctx.cookie)
+        self.order_rows = {}       # vị trí đơn trong list -> OrderRow (giữ thứ tự như chạy tuần tự)
+        self.store_hits = 0
+        self.listed = False
+        self.confirmed_oids = []
+        self.unsettled_oids = []   # confirm không có phản hồi (timeout) -> job chưa xong, cursor thử lại
+        self.detail_errors = 0
+        self.detail_error_text = ""
+
+    @property
+    def state(self) -> str:
+        """done | partial (đang dở khi hết hạn) | pending (chưa bắt đầu)."""
+        if self.pipeline.pending(self.slot) == 0:
+            return "partial" if self.unsettled_oids else "done"
+        return "partial" if self.started else "pending"
+
+    def result(self):
+        """-> (vị trí cookie đã chạy, (CookieRow, [OrderRow], store_hits), dead_rows); None nếu chưa bắt đầu."""
+        state = self.state
+        if state == "pending":
+            return None
+        if self.listed:
+            finish_cookie_row(self.row)
+            if self.detail_errors:
+                self.row.note += f" {self.detail_errors} don loi tai chi tiet: {self.detail_error_text[:120]}"
+        if state == "partial":
+            self.row.note = f"Chua xong ({self.row.confirmed_count} don da xac nhan), goi lai voi cursor de tiep tuc."
+        rows = [self.order_rows[k] for k in sorted(self.order_rows)]
+        return self.group[self.attempt], (self.row, rows, self.store_hits), self.dead_rows
+
+    def _task(self, stage: str, args):
+        suffix = "_async" if self.client is not None else ""
+        return partial(getattr(self, "run_" + stage + suffix), *args)
+
+    def submit_all(self, follow):
+        for stage, args in follow:
+            self.pipeline.submit(stage, self.slot, self._task(stage, args))
+
+    async def submit_all_async(self, follow):
+        for stage, args in follow:
+            await self.pipeline.submit_async(stage, self.slot, self._task(stage, args))
+
+    # ---- kết quả từng bước -> [(stage, args)] ----
+    def on_list(self, ids, meta, live_meta) -> list:
+        with self._lock:
+            row = self.row
+            row.order_api_error = str((meta or {}).get("error") or "").strip()
+            if not ids:
+                apply_no_orders(row, live_meta)
+                if not row.live and self.attempt + 1 < len(self.group):
+                    # cookie đầu die (token cũ) -> thử alias kế tiếp của cùng tài khoản
+                    self.dead_rows[self.group[self.attempt]] = row
+                    self.attempt += 1
+                    self._reset()
+                    return [("list", ())]
+                return []
+
+            row.live = True
+            self.listed = True
+            follow, store = [], self.store
+            for pos, oid in enumerate(unique_order_ids(ids, self.order_limit)):
+                if oid in self.skip_oids:
+                    continue
+                rec = store.get_final(self.identity, oid) if store is not None else None
+                if rec is None:
+                    follow.append(("detail", (pos, oid)))
+                    continue
+                self.store_hits += 1
+                if rec["state"] == "cancelled":
+                    self.pipeline.mark_result(self.slot)
+                    continue
+                if rec["state"] == "confirmed":
+                    self.pipeline.mark_result(self.slot)
+                    self.order_rows[pos] = order_row_from_store(row, oid, rec)
+                    self.confirmed_oids.append(oid)
+                    continue
+                follow.append(("classify", (pos, oid, rec["raw"], None)))
+            return follow
+
+    def on_classify(self, pos: int, oid: str, detail, detail_meta) -> list:
+        if detail_meta is not None and detail_meta.get("status_code") != 200:
+            with self._lock:
+                self.detail_errors += 1
+                self.detail_error_text = str(detail_meta.get("error") or "")
+        if not isinstance(detail, dict) or not detail:
+            return []
+        view = OrderDetailView(detail, fallback_order_id=oid)
+        delivered = view.delivered
+        self.pipeline.mark_result(self.slot)
+        with self._lock:
+            if self.store is not None and detail_meta is not None and detail_meta.get("status_code") == 200:
+                self.store.put_view(self.identity, oid, view)
+            if not delivered:
+                return []
+            self.row.delivered_count += 1
+        return [("confirm", (pos, oid, view))]
+
+    def on_confirm(self, pos: int, oid: str, view: OrderDetailView, result):
+        ok_confirm, confirm_data, confirm_err, replayed = result
+        with self._lock:
+            orow = order_row_from_confirm(self.row, oid, view, ok_confirm, confirm_data, confirm_err, replayed)
+            if orow.ok:
+                self.confirmed_oids.append(oid)
+                if self.store is not None:
+                    self.store.put_view(self.identity, oid, view, state="confirmed")
+            elif confirm_unsettled(ok_confirm, confirm_data):
+                self.unsettled_oids.append(oid)
+            self.order_rows[pos] = orow
+
+    # ---- sync ----
+    def run_list(self):
+        self.started = True
+        timeout = self.pipeline.timeout_for
+        ids, meta = fetch_order_ids_with_meta(self.ctx, limit=self.order_limit, offset=0, timeout=timeout(12))
+        live_meta = None if ids else fetch_shopee_account_info(self.ctx, timeout=timeout(8))
+        self.submit_all(self.on_list(ids, meta, live_meta))
+
+    def run_detail(self, pos: int, oid: str):
+        detail, meta = fetch_order_detail_by_id(self.ctx, oid, timeout=self.pipeline.timeout_for(12))
+        self.submit_all([("classify", (pos, oid, detail, meta))])
+
+    def run_classify(self, pos: int, oid: str, detail, detail_meta):
+        self.submit_all(self.on_classify(pos, oid, detail, detail_meta))
+
+    def run_confirm(self, pos: int, oid: str, view: OrderDetailView):
+        result = confirm_order_once(oid, self.ctx, timeout=self.pipeline.timeout_for(15))
+        self.on_confirm(pos, oid, view, result)
+
+    # ---- async ----
+    async def run_list_async(self):
+        self.started = True
+        timeout = self.pipeline.timeout_for
+        ids, meta = await fetch_order_ids_with_meta_async(
+            self.client, self.ctx, limit=self.order_limit, offset=0, timeout=timeout(12),
+        )
+        live_meta = None if ids else await fetch_shopee_account_info_async(self.client, self.ctx, timeout=timeout(8))
+        # on_* đọc / ghi order store (SQLite) -> chạy trong thread khi có store
+        await self.submit_all_async(await off_loop(self.store is not None, self.on_list, ids, meta, live_meta))
+
+    async def run_detail_async(self, pos: int, oid: str):
+        detail, meta = await fetch_order_detail_by_id_async(
+            self.client, self.ctx, oid, timeout=self.pipeline.timeout_for(12),
+        )
+        await self.submit_all_async([("classify", (pos, oid, detail, meta))])
+
+    async def run_classify_async(self, pos: int, oid: str, detail, detail_meta):
+        follow = await off_loop(self.store is not None, self.on_classify, pos, oid, detail, detail_meta)
+        await self.submit_all_async(follow)
+
+    async def run_confirm_async(self, pos: int, oid: str, view: OrderDetailView):
+        result = await confirm_order_once_async(
+            self.client, oid, self.ctx, timeout=self.pipeline.timeout_for(15),
+        )
+        await off_loop(self.store is not None, self.on_confirm, pos, oid, view, result)
+
+def bulk_confirm(contexts, groups, order_limit: int, store=None, engine: str = "sync",
+                 deadline_at: Optional[float] = None, skip_orders: Optional[dict] = None):
+    """
+    Chạy bulk confirm qua BulkPipeline. -> (jobs theo thứ tự groups, thống kê pipeline).
+    skip_orders: {vị trí cookie đầu nhóm: [order_id đã xác nhận ở lượt trước]}.
+    """
+    skip_orders = skip_orders or {}
+    if engine == "async":
+        pipeline = BulkPipeline(ASYNC_STAGE_WORKERS, deadline_at=deadline_at)
+        jobs = run_async(_bulk_confirm_async(pipeline, contexts, groups, order_limit, store, skip_orders))
+    else:
+        pipeline = BulkPipeline(BULK_STAGE_WORKERS, deadline_at=deadline_at)
+        jobs = [
+            BulkCookieJob(pipeline, slot, contexts, group, order_limit, store, skip_oids=skip_orders.get(group[0], ()))
+            for slot, group in enumerate(groups)
+        ]
+        for job in jobs:
+            job.submit_all([("list", ())])
+        pipeline.run()
+    return jobs, pipeline.stats()
+
+async def _bulk_confirm_async(pipeline: BulkPipeline, contexts, groups, order_limit: int, store, skip_orders: dict):
+    async with async_http() as client:
+        jobs = [
+            BulkCookieJob(pipeline, slot, contexts, group, order_limit, store, client=client,
+                          skip_oids=skip_orders.get(group[0], ()))
+            for slot, group in enumerate(groups)
+        ]
+        for job in jobs:
+            job.submit_all([("list", ())])     # stage "list" không giới hạn -> nạp sẵn không phải chờ
+        await pipeline.run_async()
+    return jobs
+
+# ================= Resume cursor (bulk hết hạn giữa chừng) =================
+def cookie_list_fingerprint(contexts, dedupe: bool) -> str:
+    h = hashlib.sha1(("1" if dedupe else "0").encode("ascii"))
+    for ctx in contexts:
+        h.update(b"\n" + ctx.cookie.encode("utf-8"))
+    return h.hexdigest()[:16]
+
+def decode_resume_cursor(token, fingerprint: str) -> Optional[dict]:
+    """-> {"next": int, "done": set, "orders": {pos: [oid]}}; None nếu cursor hỏng / không khớp danh sách cookie."""
+    data = decode_since_token(token)
+    if not data or data.get("fp") != fingerprint:
+        return None
+    try:
+        return {
+            "next": int(data.get("next") or 0),
+            "done": {int(x) for x in data.get("done") or ()},
+            "orders": {int(k): [str(x) for x in v] for k, v in (data.get("orders") or {}).items()},
+        }
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+def encode_resume_cursor(fingerprint: str, groups, jobs_by_head: dict, resume: Optional[dict]) -> Optional[str]:
+    """
+    Cursor cho lượt sau: next = vị trí cookie chưa xong nhỏ nhất, done = nhóm sau next đã xong,
+    orders = order_id đã xác nhận của các nhóm chưa xong (lượt sau bỏ qua, không confirm lại).
+    None nếu mọi nhóm đã xong.
+    """
+    prev_orders = (resume or {}).get("orders", {})
+    unfinished, done = [], []
+    for group in groups:
+        head = group[0]
+        job = jobs_by_head.get(head)
+        if job is None or job.state == "done":
+            done.append(head)
+        else:
+            unfinished.append(head)
+    if not unfinished:
+        return None
+    nxt = min(unfinished)
+    orders = {}
+    for head in unfinished:
+        oids = list(prev_orders.get(head, ())) + list(jobs_by_head[head].confirmed_oids)
+        if oids:
+            orders[str(head)] = oids
+    return encode_since_token({
+        "fp": fingerprint,
+        "next": nxt,
+        "done": sorted(h for h in done if h > nxt),
+        "orders": orders,
+    })
+
+# ================= Export (bảng cột / CSV / Google Sheets) =================
+# "export": "columns" -> {"columns": [...], "rows": [[...]]}; "csv" -> text/csv; "sheet" -> ghi thẳng lên Google Sheets.
+EXPORT_MODES = ("columns", "csv", "sheet")
+# check-cookie: cột lấy thẳng từ OrderSummary (không có raw / timeline_full)
+SUMMARY_EXPORT_COLUMNS = (
+    "order_id", "order_code", "order_time", "status_text", "status_color", "tracking_no",
+    "cod_amount", "cod_display", "shipping_name", "shipping_phone", "shipping_address",
+    "shipper_name", "shipper_phone", "shop_username", "shop_id", "product_name",
+    "product_image", "timeline_preview",
+)
+# bulk: không xuất cookie đầy đủ (đã có index + cookie_preview) và api_data
+COOKIE_ROW_EXPORT_COLUMNS = tuple(k for k in CookieRow.__slots__ if k != "cookie")
+ORDER_ROW_EXPORT_COLUMNS = tuple(k for k in OrderRow.__slots__ if k != "api_data")
+
+SHEETS_SERVICE_ACCOUNT = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON") or ""   # JSON service account hoặc đường dẫn file
+SHEETS_API_BASE = (os.environ.get("SHEETS_API_BASE") or "https://sheets.googleapis.com/v4").rstrip("/")  # override để chạy với stub local
+SHEETS_TIMEOUT_S = float(os.environ.get("SHEETS_TIMEOUT_S") or 15)
+SHEETS_SCOPES = ("https://www.googleapis.com/auth/spreadsheets",)
+# ai được ghi sheet: header X-Sheets-Secret trùng SHEETS_EXPORT_SECRET và/hoặc spreadsheet_id nằm trong
+# SHEETS_ALLOWED_IDS (phân cách dấu phẩy). Không cấu hình gì -> tắt export "sheet".
+SHEETS_EXPORT_SECRET = os.environ.get("SHEETS_EXPORT_SECRET") or ""
+SHEETS_ALLOWED_IDS = frozenset(x.strip() for x in (os.environ.get("SHEETS_ALLOWED_IDS") or "").split(",") if x.strip())
+_SHEETS_DEFAULT_BASE = "https://sheets.googleapis.com/v4"
+_A1_RE = re.compile(r"^([A-Za-z]{1,3})([1-9][0-9]*)$")
+
+def resolve_export(payload: dict) -> Optional[str]:
+    mode = str(payload.get("export") or "").strip().lower()
+    return mode if mode in EXPORT_MODES else None
+
+def export_cell(val):
+    """Giá trị 1 ô: None -> "", timeline [(ts, text)] -> mỗi mốc 1 dòng, dict/list khác -> JSON."""
+    if val is None:
+        return ""
+    if isinstance(val, (str, int, float)):
+        return val
+    if isinstance(val, (list, tuple)) and all(isinstance(x, (list, tuple)) for x in val):
+        return "\n".join(" ".join(str(p) for p in x if p) for x in val)
+    return json_dumps_bytes(val, default=RecordJSONProvider.default).decode("utf-8")
+
+def export_table(records, columns) -> dict:
+    """Bảng hướng cột dựng thẳng từ record (__slots__), không qua to_dict()."""
+    getter = attrgetter(*columns)
+    return {
+        "columns": list(columns),
+        "rows": [[export_cell(v) for v in getter(r)] for r in records],
+    }
+
+_CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def csv_safe(val):
+    """Ô text bắt đầu bằng = + - @ (Excel / Sheets hiểu là công thức) -> thêm ' phía trước."""
+    if isinstance(val, str) and val.startswith(_CSV_FORMULA_PREFIXES):
+        return "'" + val
+    return val
+
+def table_csv(table: dict) -> str:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([csv_safe(c) for c in table["columns"]])
+    writer.writerows([csv_safe(c) for c in row] for row in table["rows"])
+    return buf.getvalue()
+
+def csv_response(table: dict, filename: str, headers: Optional[dict] = None):
+    resp = app.response_class(table_csv(table), mimetype="text/csv")
+    resp.headers["Content-Disposition"] = f'inline; filename="{filename}"'
+    for k, v in (headers or {}).items():
+        resp.headers[k] = v
+    return resp
+
+class SheetsExportError(Exception):
+    pass
+
+def sheet_export_denied(spec) -> Optional[str]:
+    """Kiểm tra quyền ghi sheet trước khi chạy request; -> lỗi (403) hoặc None."""
+    if not SHEETS_EXPORT_SECRET and not SHEETS_ALLOWED_IDS:
+        return "Export sheet chua bat tren server (SHEETS_EXPORT_SECRET / SHEETS_ALLOWED_IDS)"
+    if SHEETS_EXPORT_SECRET:
+        token = request.headers.get("X-Sheets-Secret") or ""
+        if not hmac.compare_digest(token.encode("utf-8"), SHEETS_EXPORT_SECRET.encode("utf-8")):
+            return "Sai hoac thieu X-Sheets-Secret"
+    if SHEETS_ALLOWED_IDS:
+        spreadsheet_id = str((spec if isinstance(spec, dict) else {}).get("spreadsheet_id") or "").strip()
+        if spreadsheet_id not in SHEETS_ALLOWED_IDS:
+            return "spreadsheet_id khong nam trong SHEETS_ALLOWED_IDS"
+    return None
+
+_gspread = None
+_sheets_client = None
+_sheets_lock = threading.Lock()
+
+def gspread_module():
+    """gspread (+ google-auth) nếu có cài, không thì False."""
+    global _gspread
+    if _gspread is None:
+        try:
+            import gspread as mod
+        except ImportError:
+            mod = False
+        _gspread = mod
+    return _gspread
+
+def _sheets_http_client(gspread):
+    """HTTPClient của gspread; SHEETS_API_BASE khác mặc định thì đổi prefix URL (stub local)."""
+    base = gspread.http_client.HTTPClient
+    if SHEETS_API_BASE == _SHEETS_DEFAULT_BASE:
+        return base
+
+    class RebasedHTTPClient(base):
+        def request(self, method, endpoint, *args, **kwargs):
+            if endpoint.startswith(_SHEETS_DEFAULT_BASE):
+                endpoint = SHEETS_API_BASE + endpoint[len(_SHEETS_DEFAULT_BASE):]
+            return super().request(method, endpoint, *args, **kwargs)
+
+    return RebasedHTTPClient
+
+def get_sheets_client():
+    """gspread.Client từ service account (GOOGLE_SERVICE_ACCOUNT_JSON), dựng 1 lần / process (giữ token)."""
+    global _sheets_client
+    if _sheets_client is None:
+        with _sheets_lock:
+            if _sheets_client is None:
+                gspread = gspread_module()
+                if not gspread:
+                    raise SheetsExportError("Server chua cai gspread / google-auth")
+                src = SHEETS_SERVICE_ACCOUNT.strip()
+                if not src:
+                    raise SheetsExportError("Thieu GOOGLE_SERVICE_ACCOUNT_JSON")
+                try:
+                    if src.startswith("{"):
+                        info = json.loads(src)
+                    else:
+                        with open(src, "r", encoding="utf-8") as f:
+                            info = json.load(f)
+                    client = gspread.service_account_from_dict(
+                        info, scopes=SHEETS_SCOPES, http_client=_sheets_http_client(gspread),
+                    )
+                except (OSError, ValueError) as e:
+                    raise SheetsExportError(f"Service account khong hop le: {e}") from None
+                client.set_timeout(SHEETS_TIMEOUT_S)
+                _sheets_client = client
+    return _sheets_client
+
+def column_letters(n: int) -> str:
+    out = ""
+    while n > 0:
+        n, rem = divmod(n - 1, 26)
+        out = chr(65 + rem) + out
+    return out
+
+def column_number(letters: str) -> int:
+    n = 0
+    for ch in letters.upper():
+        n = n * 26 + ord(ch) - 64
+    return n
+
+def sheet_range(start: str, n_rows: int, n_cols: int) -> str:
+    """"Orders!B2" + kích thước bảng -> "Orders!B2:K12" (1 range duy nhất cho values.update)."""
+    sheet, _, cell = start.rpartition("!")
+    m = _A1_RE.match(cell.strip() or "A1")
+    if not m:
+        raise SheetsExportError(f"Range khong hop le: {start}")
+    col, row = column_number(m.group(1)), int(m.group(2))
+    end = f"{column_letters(col + max(1, n_cols) - 1)}{row + max(1, n_rows) - 1}"
+    rng = f"{column_letters(col)}{row}:{end}"
+    return f"{sheet}!{rng}" if sheet else rng
+
+class SheetsTableWriter:
+    """
+    Ghi 1 bảng (header + rows) lên Google Sheets bằng đúng 1 lần values.update (RAW, không chạy công thức).
+    min_rows: đệm thêm dòng trống để xóa dữ liệu cũ dài hơn, vẫn trong cùng 1 request.
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+        self.stats = {"writes": 0, "cells": 0, "errors": 0, "write_ms": 0.0}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else get_sheets_client()
+
+    def write(self, spreadsheet_id: str, start: str, table: dict, min_rows: int = 0) -> dict:
+        if not spreadsheet_id:
+            raise SheetsExportError("Thieu spreadsheet_id")
+        n_cols = len(table["columns"])
+        values = [list(table["columns"])] + table["rows"]
+        values += [[""] * n_cols for _ in range(max(0, min_rows - len(values)))]
+        rng = sheet_range(start or "A1", len(values), n_cols)
+        client = self.client
+        t0 = time.perf_counter()
+        try:
+            resp = client.http_client.values_update(
+                spreadsheet_id, rng,
+                params={"valueInputOption": "RAW"},
+                body={"majorDimension": "ROWS", "values": values},
+            )
+        except Exception as e:
+            with self._lock:
+                self.stats["errors"] += 1
+            raise SheetsExportError(f"Google Sheets loi: {e}") from None
+        elapsed = time.perf_counter() - t0
+        resp = resp if isinstance(resp, dict) else {}
+        with self._lock:
+            self.stats["writes"] += 1
+            self.stats["cells"] += len(values) * n_cols
+            self.stats["write_ms"] = round(self.stats["write_ms"] + elapsed * 1000, 3)
+        return {
+            "ok": True,
+            "spreadsheet_id": spreadsheet_id,
+            "updated_range": resp.get("updatedRange") or rng,
+            "updated_rows": resp.get("updatedRows", len(values)),
+            "updated_cells": resp.get("updatedCells", len(values) * n_cols),
+            "ms": round(elapsed * 1000, 2),
+        }
+
+SHEETS_WRITER = SheetsTableWriter()
+
+def push_table_to_sheet(table: dict, spec) -> dict:
+    """spec = payload["sheet"]: {"spreadsheet_id", "range": "Orders!A1", "min_rows"}; lỗi -> {"ok": False, "error"}."""
+    spec = spec if isinstance(spec, dict) else {}
+    try:
+        min_rows = max(0, min(int(spec.get("min_rows") or 0), 5000))
+    except (TypeError, ValueError):
+        min_rows = 0
+    try:
+        return SHEETS_WRITER.write(
+            str(spec.get("spreadsheet_id") or "").strip(),
+            str(spec.get("range") or "A1").strip(),
+            table, min_rows=min_rows,
+        )
+    except SheetsExportError as e:
+        return {"ok": False, "error": str(e)}
+
 # ================== Routes ==================
 @app.get("/api/ping")
 def api_ping():
+    if request.args.get("profile"):
+        return jsonify({"ok": True, "boot": BOOT_PROFILE})
     return jsonify({"ok": True})
 
+@app.get("/api/metrics")
+def api_metrics():
+    return jsonify({
+        "ok": True,
+        "breakers": breaker_metrics(),
+        "confirm_ledger": dict(CONFIRM_LEDGER.stats) if CONFIRM_LEDGER is not None else None,
+        "transport": transport_metrics(),
+        "compression": compression_metrics(),
+        "cache": cache_metrics(),
+        "sheets": dict(SHEETS_WRITER.stats),
+        "server": drain_metrics(),
+    })
+
+@app.route("/api/warmup", methods=["GET", "POST"])
+def api_warmup():
+    connect = str(request.args.get("connect") or "").strip().lower() in ("1", "true", "yes")
+    timings = warm_up(connect=connect)
+    return jsonify({"ok": True, "timings": timings, "boot": BOOT_PROFILE})
+
 @app.post("/api/check-cookie")
 def api_check_cookie_single():
     """
@@ -932,13 +4123,18 @@ def api_check_cookie_single():
         "cookie": "SPC_ST=....",
         "max_orders": 4        # optional
         "list_limit": 5        # optional
+        "include_raw": "full"  # optional, mặc định "summary" (shopee_raw đã prune)
+        "export": "columns"    # optional: "columns" | "csv" | "sheet" (kèm "sheet": {...})
       }
     """
     data = request.get_json(silent=True) or {}
     cookie = (data.get("cookie") or "").strip()
     if not cookie:
         return jsonify({"error": "Missing cookie"}), 400
-    cookie = sanitize_cookie(cookie)
+    cookie = CookieContext(cookie)
+    denied = sheet_export_denied(data.get("sheet")) if resolve_export(data) == "sheet" else None
+    if denied:
+        return jsonify({"ok": False, "error": denied}), 403
 
     # cho phép override (nếu bạn muốn)
     max_orders = data.get("max_orders", DEFAULT_MAX_ORDERS)
@@ -954,8 +4150,19 @@ def api_check_cookie_single():
     except Exception:
         list_limit = DEFAULT_LIST_LIMIT
 
-    account_meta = fetch_shopee_account_info(cookie, timeout=10)
-    fetched = fetch_orders_and_details(cookie, list_limit=list_limit, offset=0)
+    store = get_order_store() if data.get("use_store", True) is not False else None
+    identity = cookie.identity if store is not None else None
+    # include_raw: "summary" (mặc định, raw đã prune) | "full" (detail nguyên vẹn, không qua cache)
+    prune = str(data.get("include_raw") or "summary").strip().lower() != "full"
+
+    if resolve_engine(data) == "async":
+        account_meta, fetched = run_async(
+            check_cookie_fetch_async(cookie, list_limit, store=store, identity=identity, prune=prune)
+        )
+    else:
+        account_meta = fetch_shopee_account_info(cookie, timeout=10)
+        fetched = fetch_orders_and_details(cookie, list_limit=list_limit, offset=0, store=store,
+                                           identity=identity, prune=prune)
     details = fetched.get("details", []) if isinstance(fetched, dict) else []
     shopee_full = {
         "list_http_status": fetched.get("list_http_status") if isinstance(fetched, dict) else None,
@@ -965,14 +4172,18 @@ def api_check_cookie_single():
         "account_raw": account_meta.get("raw"),
     }
 
+    store_hits = sum(1 for det in details if det.get("from_store"))
     picked = []
     for det in details:
         raw = det.get("raw") or {}
+        view = OrderDetailView(raw, fallback_order_id=det.get("order_id"))
+        if store is not None and det.get("http_status") == 200 and not det.get("from_store"):
+            store.put_view(identity, str(det.get("order_id")), view)
         # skip đơn bị buyer hủy
-        if is_buyer_cancelled(raw):
+        if view.buyer_cancelled:
             continue
 
-        s = pick_columns_from_detail(raw, fallback_order_id=det.get("order_id"))
+        s = view.summary()
         s["order_id"] = str(det.get("order_id")) if det.get("order_id") is not None else None
         s["shopee_raw"] = raw
 
@@ -989,39 +4200,103 @@ def api_check_cookie_single():
         if len(picked) >= max_orders:
             break
 
-    if not picked:
+    # since: chỉ trả các đơn đổi trạng thái so với token lần trước
+    sigs = {str(s.order_id): order_status_sig(s) for s in picked}
+    prev_sigs = decode_since_token(data.get("since")) if data.get("since") else None
+    if prev_sigs is not None:
+        picked = [s for s in picked if prev_sigs.get(str(s.order_id)) != sigs[str(s.order_id)]]
+        changed_ids = {str(s.order_id) for s in picked}
+        shopee_full["details_raw"] = [
+            d for d in shopee_full["details_raw"] if str(d.get("order_id")) in changed_ids
+        ]
+
+    projection = {
+        "data_list": [project_summary(s) for s in picked],
+        "user_shopee": account_meta.get("user"),
+        "cookie_live": bool(account_meta.get("live")),
+        "since": sorted(sigs.items()),
+        "changed_only": prev_sigs is not None,
+    }
+    # export / include_raw: cùng dữ liệu nhưng khác dạng -> ETag khác; "sheet" có ghi ra ngoài nên không trả 304,
+    # include_raw=full cũng không (raw đầy đủ có những key nằm ngoài projection)
+    export = resolve_export(data)
+    etag = content_hash([projection, export, prune])
+    if (export != "sheet" and prune
+            and request.if_none_match and request.if_none_match.contains_weak(etag)):
+        return not_modified(etag)
+
+    if export is not None:
+        meta = {
+            "count": len(picked),
+            "user_shopee": account_meta.get("user"),
+            "cookie_live": bool(account_meta.get("live")),
+            "store_hits": store_hits,
+            "since": encode_since_token(sigs),
+            "changed_only": prev_sigs is not None,
+        }
+        table = export_table(picked, SUMMARY_EXPORT_COLUMNS)
+        if export == "sheet":
+            return jsonify(dict(meta, sheet=push_table_to_sheet(table, data.get("sheet"))))
+        if export == "csv":
+            resp = csv_response(table, "orders.csv", {
+                "X-Count": str(meta["count"]),
+                "X-Cookie-Live": "1" if meta["cookie_live"] else "0",
+                "X-Since": meta["since"],
+            })
+        else:
+            resp = jsonify(dict(meta, table=table))
+        resp.set_etag(etag)
+        return resp
+
+    if not picked and prev_sigs is None:
         # giữ đúng kiểu “cookie die” như bản gốc
-        return jsonify({
+        resp = jsonify({
             "data": None,
             "data_list": [],
             "count": 0,
             "message": "Cookie khóa/hết hạn hoặc không có đơn hợp lệ",
             "user_shopee": account_meta.get("user"),
             "cookie_live": bool(account_meta.get("live")),
+            "store_hits": store_hits,
+            "since": encode_since_token(sigs),
             "shopee_full": shopee_full
         })
+        resp.set_etag(etag)
+        return resp
 
-    return jsonify({
-        "data": picked[0],
+    resp = jsonify({
+        "data": picked[0] if picked else None,
         "data_list": picked,
         "count": len(picked),
         "user_shopee": account_meta.get("user"),
         "cookie_live": bool(account_meta.get("live")),
+        "store_hits": store_hits,
+        "since": encode_since_token(sigs),
+        "changed_only": prev_sigs is not None,
         "shopee_full": shopee_full
     })
+    resp.set_etag(etag)
+    return resp
 
 @app.post("/api/confirm-order")
 def api_confirm_order():
     data = request.get_json(silent=True) or {}
-    cookie = sanitize_cookie(str(data.get("cookie") or "").strip())
+    cookie = CookieContext(str(data.get("cookie") or "").strip())
     order_id = str(data.get("order_id") or "").strip()
 
-    if not cookie:
+    if not cookie.cookie:
         return jsonify({"ok": False, "error": "Missing cookie"}), 400
     if not order_id:
         return jsonify({"ok": False, "error": "Missing order_id"}), 400
 
-    ok_confirm, confirm_data, confirm_err = request_buyer_confirm_order(order_id, cookie)
+    idempotency_key = (request.headers.get("Idempotency-Key") or "").strip()[:200] or None
+    try:
+        ok_confirm, confirm_data, confirm_err, replayed = confirm_order_once(
+            order_id, cookie, idempotency_key=idempotency_key,
+        )
+    except IdempotencyConflict:
+        return jsonify({"ok": False, "error": "Idempotency-Key da dung cho don khac"}), 422
+
     if ok_confirm:
         return jsonify({
             "ok": True,
@@ -1029,6 +4304,7 @@ def api_confirm_order():
             "message": "Xac nhan thanh cong",
             "order_id": order_id,
             "api_data": confirm_data if isinstance(confirm_data, dict) else {},
+            "replayed": replayed,
         })
 
     if _confirm_error_is_already_done(confirm_err, confirm_data):
@@ -1038,6 +4314,7 @@ def api_confirm_order():
             "message": "Don da xac nhan truoc do",
             "order_id": order_id,
             "api_data": confirm_data if isinstance(confirm_data, dict) else {},
+            "replayed": replayed,
         })
 
     return jsonify({
@@ -1046,12 +4323,24 @@ def api_confirm_order():
         "message": _humanize_confirm_error(confirm_err, confirm_data),
         "order_id": order_id,
         "api_data": confirm_data if isinstance(confirm_data, dict) else {},
+        "replayed": replayed,
     }), 400
 
 @app.post("/api/confirm-received-sll")
+@bulk_request
 def api_confirm_received_sll():
     payload = request.get_json(silent=True) or {}
+    denied = sheet_export_denied(payload.get("sheet")) if resolve_export(payload) == "sheet" else None
+    if denied:
+        return jsonify({"ok": False, "error": denied}), 403
     started = time.time()
+    deadline_s = BULK_DEADLINE_S
+    try:
+        if payload.get("deadline_s") is not None:
+            deadline_s = max(1.0, min(float(payload["deadline_s"]), BULK_DEADLINE_S))
+    except (TypeError, ValueError):
+        pass
+    deadline_at = time.perf_counter() + deadline_s
 
     order_limit = payload.get("order_limit", 6)
     max_cookies = payload.get("max_cookies", 50)
@@ -1066,111 +4355,61 @@ def api_confirm_received_sll():
 
     cookies_all = parse_cookie_inputs(payload)
     input_count = len(cookies_all)
-    cookies = cookies_all[:max_cookies]
-    truncated_count = max(0, len(cookies_all) - len(cookies))
-
-    cookie_rows = []
-    order_rows = []
-
-    for ck in cookies:
-        row = {
-            "cookie": ck,
-            "cookie_preview": (ck[:56] + "...") if len(ck) > 56 else ck,
-            "live": False,
-            "delivered_count": 0,
-            "confirmed_count": 0,
-            "already_count": 0,
-            "failed_count": 0,
-            "note": "",
-            "order_api_error": "",
-        }
-
-        ids, meta = fetch_order_ids_with_meta(ck, limit=order_limit, offset=0, timeout=12)
-        row["order_api_error"] = str((meta or {}).get("error") or "").strip()
-        if not ids:
-            live_meta = fetch_shopee_account_info(ck, timeout=8)
-            row["live"] = bool(live_meta.get("live"))
-            if row["live"]:
-                row["note"] = row["order_api_error"] or "Khong co don gan day."
-            else:
-                row["note"] = str(live_meta.get("error") or "").strip() or "Cookie die/het han."
-            cookie_rows.append(row)
-            continue
-
-        row["live"] = True
-        seen_oid = set()
-        for oid in ids[:order_limit]:
-            oid = str(oid or "").strip()
-            if not oid or oid in seen_oid:
-                continue
-            seen_oid.add(oid)
-
-            detail, _detail_meta = fetch_order_detail_by_id(ck, oid, timeout=12)
-            if not isinstance(detail, dict) or not detail:
-                continue
-            if not is_detail_delivered(detail):
-                continue
-
-            row["delivered_count"] += 1
-            summary = pick_columns_from_detail(detail, fallback_order_id=oid)
-            tracking_no = summary.get("tracking_no")
-            status_text = summary.get("status_text") or "—"
-
-            ok_confirm, confirm_data, confirm_err = request_buyer_confirm_order(oid, ck)
-            confirm_state = "success"
-            result_text = "✅ Thanh cong"
-            if not ok_confirm:
-                if _confirm_error_is_already_done(confirm_err, confirm_data):
-                    ok_confirm = True
-                    confirm_state = "already"
-                    result_text = "ℹ️ Da xac nhan truoc do"
-                else:
-                    confirm_state = "failed"
-                    result_text = f"❌ {_humanize_confirm_error(confirm_err, confirm_data)}"
-
-            if ok_confirm:
-                row["confirmed_count"] += 1
-                if confirm_state == "already":
-                    row["already_count"] += 1
-            else:
-                row["failed_count"] += 1
-
-            order_rows.append({
-                "cookie_preview": row["cookie_preview"],
-                "order_id": oid,
-                "tracking_no": tracking_no,
-                "status_text": status_text,
-                "ok": bool(ok_confirm),
-                "state": confirm_state,
-                "result_text": result_text,
-                "api_data": confirm_data if isinstance(confirm_data, dict) else {},
-            })
-
-        if row["delivered_count"] <= 0:
-            row["note"] = "Khong co don GTC de xac nhan."
-        elif row["failed_count"] > 0:
-            row["note"] = f"Xac nhan {row['confirmed_count']}/{row['delivered_count']} don."
-        elif row["already_count"] > 0:
-            row["note"] = f"Da xac nhan/da co san {row['confirmed_count']} don."
-        else:
-            row["note"] = f"Da xac nhan {row['confirmed_count']} don."
-        cookie_rows.append(row)
+    contexts = [CookieContext(ck, sanitized=True) for ck in cookies_all[:max_cookies]]
+    truncated_count = max(0, len(cookies_all) - len(contexts))
+
+    store = get_order_store() if payload.get("use_store", True) is not False else None
+    engine = resolve_engine(payload)
+
+    dedupe = payload.get("dedupe_identity", True) is not False
+    if dedupe:
+        groups = group_by_identity(contexts)
+    else:
+        groups = [[pos] for pos in range(len(contexts))]
+
+    fingerprint = cookie_list_fingerprint(contexts, dedupe)
+    resume = None
+    if payload.get("cursor"):
+        resume = decode_resume_cursor(payload.get("cursor"), fingerprint)
+        if resume is None:
+            return jsonify({"ok": False, "error": "Cursor khong hop le hoac khong khop danh sach cookie"}), 400
+    todo = [
+        group for group in groups
+        if resume is None or (group[0] >= resume["next"] and group[0] not in resume["done"])
+    ]
+
+    jobs, pipeline_stats = bulk_confirm(
+        contexts, todo, order_limit, store, engine=engine,
+        deadline_at=deadline_at, skip_orders=(resume or {}).get("orders"),
+    )
+    jobs_by_head = {job.group[0]: job for job in jobs}
+    group_results = [
+        jobs_by_head[group[0]].result() if group[0] in jobs_by_head else None for group in groups
+    ]
+    results = expand_identity_groups(contexts, groups, group_results)
+    alias_count = len(contexts) - len(groups)
+    cursor = encode_resume_cursor(fingerprint, groups, jobs_by_head, resume)
+
+    # cookie chưa chạy (hết hạn / đã xong ở lượt trước) không có row; index = vị trí trong input
+    for pos, res in enumerate(results):
+        if res is not None:
+            res[0].index = pos + 1
+    results = [res for res in results if res is not None]
+    cookie_rows = [res[0] for res in results]
+    order_rows = [orow for res in results for orow in res[1]]
+    store_hits = sum(res[2] for res in results)
 
-    for idx, row in enumerate(cookie_rows, start=1):
-        row["index"] = idx
     for idx, row in enumerate(order_rows, start=1):
-        row["index"] = idx
+        row.index = idx
 
-    live_count = sum(1 for r in cookie_rows if bool(r.get("live")))
-    delivered_count = sum(max(0, int(r.get("delivered_count") or 0)) for r in cookie_rows)
-    confirmed_count = sum(max(0, int(r.get("confirmed_count") or 0)) for r in cookie_rows)
-    already_count = sum(max(0, int(r.get("already_count") or 0)) for r in cookie_rows)
-    failed_count = sum(max(0, int(r.get("failed_count") or 0)) for r in cookie_rows)
+    live_count = sum(1 for r in cookie_rows if bool(r.live))
+    delivered_count = sum(max(0, int(r.delivered_count or 0)) for r in cookie_rows)
+    confirmed_count = sum(max(0, int(r.confirmed_count or 0)) for r in cookie_rows)
+    already_count = sum(max(0, int(r.already_count or 0)) for r in cookie_rows)
+    failed_count = sum(max(0, int(r.failed_count or 0)) for r in cookie_rows)
 
-    return jsonify({
+    summary = {
         "ok": True,
-        "cookie_rows": cookie_rows,
-        "order_rows": order_rows,
         "input_count": int(input_count),
         "total": len(cookie_rows),
         "live_count": int(live_count),
@@ -1182,7 +4421,142 @@ def api_confirm_received_sll():
         "elapsed": round(max(0.0, time.time() - started), 3),
         "truncated_count": int(truncated_count),
         "order_limit": int(order_limit),
-    })
+        "store_hits": int(store_hits),
+        "engine": engine,
+        "alias_count": int(alias_count),
+        "pipeline": pipeline_stats,
+        "partial": cursor is not None,
+        "cursor": cursor,
+        "deadline_s": deadline_s,
+    }
+    export = resolve_export(payload)
+    if export is None:
+        return jsonify(dict(summary, cookie_rows=cookie_rows, order_rows=order_rows))
+    if export == "columns":
+        return jsonify(dict(
+            summary,
+            cookie_table=export_table(cookie_rows, COOKIE_ROW_EXPORT_COLUMNS),
+            order_table=export_table(order_rows, ORDER_ROW_EXPORT_COLUMNS),
+        ))
+
+    # csv / sheet: 1 bảng, mặc định order_rows ("export_table": "cookies" để lấy cookie_rows)
+    which = "cookies" if str(payload.get("export_table") or "").strip().lower() == "cookies" else "orders"
+    if which == "cookies":
+        table = export_table(cookie_rows, COOKIE_ROW_EXPORT_COLUMNS)
+    else:
+        table = export_table(order_rows, ORDER_ROW_EXPORT_COLUMNS)
+    if export == "csv":
+        headers = {"X-Total": str(summary["total"]), "X-Partial": "1" if cursor is not None else "0"}
+        if cursor is not None:
+            headers["X-Cursor"] = cursor
+        return csv_response(table, f"{which}.csv", headers)
+    return jsonify(dict(summary, sheet=push_table_to_sheet(table, payload.get("sheet"))))
+
+# ================= Self-hosted server (ngoài Vercel) =================
+# python -m api.index: chạy cùng app dưới gunicorn (gthread: SERVE_WORKERS process x SERVE_THREADS thread),
+# không có gunicorn (Windows...) thì waitress (1 process, nhiều thread). Mỗi worker warm_up() trước khi nhận request.
+SERVE_SERVER = (os.environ.get("SERVE_SERVER") or "auto").strip().lower()     # auto | gunicorn | waitress
+SERVE_BIND = os.environ.get("SERVE_BIND") or "0.0.0.0:8000"
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS") or min(8, (os.cpu_count() or 1) * 2))
+SERVE_THREADS = int(os.environ.get("SERVE_THREADS") or 8)
+SERVE_DRAIN_S = int(float(os.environ.get("SERVE_DRAIN_S") or BULK_DEADLINE_S + 5))
+SERVE_WARM_CONNECT = (os.environ.get("SERVE_WARM_CONNECT") or "on").strip().lower() not in ("0", "off", "false", "no")
+
+def _reset_after_fork():
+    # pool HTTP / SQLite / Redis / Sheets / loop async mở trước khi fork không được dùng chung giữa các process
+    global _http_session, _order_store, _cache_backend, _sheets_client, _async_loop, _async_client
+    _http_session = _order_store = _cache_backend = _sheets_client = None
+    _async_loop = _async_client = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _install_drain_signal(then_exit=None):
+    """SIGTERM -> begin_drain() rồi mới tới handler cũ (gunicorn: ngừng nhận kết nối, chờ request đang chạy)."""
+    import signal
+    prev = signal.getsignal(signal.SIGTERM)
+
+    def handler(signum, frame):
+        begin_drain()
+        if then_exit is not None:
+            threading.Thread(target=then_exit, daemon=True).start()
+        elif callable(prev):
+            prev(signum, frame)
+
+    signal.signal(signal.SIGTERM, handler)
+
+def _serve_worker_init(worker=None):
+    timings = warm_up(connect=SERVE_WARM_CONNECT)
+    _install_drain_signal()
+    (worker.log if worker is not None else app.logger).info("worker %s warmed %s", os.getpid(), timings)
+
+def _serve_gunicorn(workers: int, threads: int):
+    from gunicorn.app.base import BaseApplication
+
+    class StandaloneApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": [b.strip() for b in SERVE_BIND.split(",") if b.strip()],
+                "workers": max(1, workers),
+                "threads": max(1, threads),
+                "worker_class": "gthread",
+                # bulk tự dừng trước BULK_DEADLINE_S; timeout chỉ để bắt worker treo
+                "timeout": int(max(30, BULK_DEADLINE_S * 2)),
+                "graceful_timeout": SERVE_DRAIN_S,
+                "keepalive": 5,
+                "post_worker_init": _serve_worker_init,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    StandaloneApplication().run()
+
+def _serve_waitress(threads: int):
+    import signal
+    import waitress
+    import _thread
+
+    def drain_then_exit():
+        wait_drained(SERVE_DRAIN_S)
+        time.sleep(0.5)            # cho response bulk cuối kịp ghi ra socket
+        _thread.interrupt_main()
+
+    warm_up(connect=SERVE_WARM_CONNECT)
+    # chạy nền (nohup / systemd) SIGINT có thể bị ignore -> interrupt_main() không dừng được
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    _install_drain_signal(then_exit=drain_then_exit)
+    try:
+        waitress.serve(app, listen=SERVE_BIND.replace(",", " "), threads=max(1, threads))
+    except KeyboardInterrupt:
+        pass
+
+def serve(workers: Optional[int] = None, threads: Optional[int] = None, server: Optional[str] = None):
+    """Chạy server tự host (gunicorn / waitress). Cache nên để CACHE_BACKEND=sqlite|redis để các worker dùng chung."""
+    from importlib.util import find_spec
+    server = server or SERVE_SERVER
+    workers = workers or SERVE_WORKERS
+    threads = threads or SERVE_THREADS
+    if server == "auto":
+        # chỉ dò có cài hay không, không import gunicorn vào process cha
+        server = "gunicorn" if os.name == "posix" and find_spec("gunicorn") is not None else "waitress"
+    server = "gunicorn" if server == "gunicorn" else "waitress"
+    if find_spec(server) is None:
+        raise SystemExit(f"Chua cai {server}: pip install -r requirements-server.txt")
+    if server == "gunicorn":
+        _serve_gunicorn(workers, threads)
+    else:
+        _serve_waitress(threads)
+
+if STARTUP_MODE == "eager":
+    warm_up()
+
+BOOT_PROFILE["import_ms"] = round((time.perf_counter() - _BOOT_STARTED) * 1000, 2)
+
+if __name__ == "__main__":
+    serve()
 
 # Vercel needs "app" exported
 # (this file is used as api/index.py)
@@ -0,0 +1,74 @@
+"""
+Benchmark: row dict cũ vs record dataclass(slots=True) (bộ nhớ / row; thời gian serialize để kiểm tra không chậm đi nhiều).
+
+    python bench/bench_records.py [--rows 2400] [--codec auto|stdlib|orjson]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def build(n: int, as_record: bool):
+    """2400 row kiểu OrderRow (200 cookie x 12 đơn); cùng giá trị, chỉ khác kiểu row (dict literal / record)."""
+    make = dict
+    if as_record:
+        from api.index import OrderRow as make
+    return [
+        make(
+            index=i + 1,
+            cookie_preview=f"SPC_ST=abc{i % 200}...",
+            order_id=str(200000000000 + i),
+            tracking_no=f"SPXVN{i:010d}",
+            status_text="Giao hàng thành công",
+            ok=i % 3 != 0,
+            state=("success", "already", "failed")[i % 3],
+            result_text="Xac nhan thanh cong",
+            api_data={"error": 0, "data": {"order_id": 200000000000 + i}},
+        )
+        for i in range(n)
+    ]
+
+
+def measure(n: int, as_record: bool, dumps, repeat: int) -> dict:
+    tracemalloc.start()
+    base = tracemalloc.take_snapshot()
+    rows = build(n, as_record)
+    snap = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in snap.compare_to(base, "filename"))
+    t_build = min(_timed(lambda: build(n, as_record)) for _ in range(repeat))
+    t_dump = min(_timed(lambda: dumps({"order_rows": rows})) for _ in range(repeat))
+    t_total = min(_timed(lambda: dumps({"order_rows": build(n, as_record)})) for _ in range(repeat))
+    return {"bytes_per_row": round(size / n), "build_ms": t_build, "dumps_ms": t_dump, "total_ms": t_total}
+
+
+def _timed(fn) -> float:
+    t = time.perf_counter()
+    fn()
+    return round((time.perf_counter() - t) * 1000, 2)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=2400)
+    ap.add_argument("--repeat", type=int, default=7)
+    ap.add_argument("--codec", default=None, help="auto | stdlib | orjson (mặc định theo JSON_CODEC)")
+    args = ap.parse_args()
+    if args.codec:
+        os.environ["JSON_CODEC"] = args.codec
+    import api.index as app_module
+
+    dumps = app_module.app.json.dumps
+    print(f"codec={'orjson' if app_module.orjson_module() else 'stdlib'} rows={args.rows}")
+    for label, as_record in (("dict", False), ("record", True)):
+        out = measure(args.rows, as_record, dumps, args.repeat)
+        print(f"  {label:<7} {out['bytes_per_row']:>5} B/row  build {out['build_ms']:>7} ms  "
+              f"dumps {out['dumps_ms']:>7} ms  build+dumps {out['total_ms']:>7} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Chạy lại traffic đã ghi (HTTP_TRANSPORT=record) trên corpus, không gọi mạng: mỗi request vào đã ghi được gửi lại
+qua app (test client) với HTTP_TRANSPORT=replay, đo wall / CPU theo route để so sánh giữa các phiên bản.
+
+    python bench/replay_corpus.py [--corpus /tmp/ngamiu_http_corpus.jsonl.gz] [--repeat 3] [--scale 0]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def replay_inbound(client, inbound, repeat: int = 1) -> list:
+    """-> [{"path", "status", "recorded_status", "wall_ms", "cpu_ms", "recorded_ms", "body"}] theo thứ tự đã ghi."""
+    out = []
+    for _ in range(max(1, repeat)):
+        for entry in inbound:
+            t, c = time.perf_counter(), time.process_time()
+            resp = client.post(entry["in"], json=entry["b"])
+            wall, cpu = time.perf_counter() - t, time.process_time() - c
+            out.append({
+                "path": entry["in"],
+                "status": resp.status_code,
+                "recorded_status": entry.get("s"),
+                "wall_ms": round(wall * 1000, 2),
+                "cpu_ms": round(cpu * 1000, 2),
+                "recorded_ms": entry.get("ms"),
+                "body": resp.get_json(silent=True),
+            })
+    return out
+
+
+def _pct(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def summarize(results) -> dict:
+    by_path = {}
+    for r in results:
+        by_path.setdefault(r["path"], []).append(r)
+    return {
+        path: {
+            "n": len(rows),
+            "wall_p50_ms": _pct([r["wall_ms"] for r in rows], 0.5),
+            "wall_p95_ms": _pct([r["wall_ms"] for r in rows], 0.95),
+            "cpu_avg_ms": round(sum(r["cpu_ms"] for r in rows) / len(rows), 2),
+            "recorded_p50_ms": _pct([r["recorded_ms"] or 0 for r in rows], 0.5),
+            "status_mismatch": sum(1 for r in rows if r["status"] != r["recorded_status"]),
+        }
+        for path, rows in by_path.items()
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--corpus", default=None, help="mặc định TRANSPORT_CORPUS")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--scale", default="0", help="REPLAY_LATENCY_SCALE (0 = không chờ, 1 = như lúc ghi)")
+    args = ap.parse_args()
+    os.environ["HTTP_TRANSPORT"] = "replay"
+    os.environ["REPLAY_LATENCY_SCALE"] = args.scale
+    if args.corpus:
+        os.environ["TRANSPORT_CORPUS"] = args.corpus
+    # mỗi lượt chạy như request đầu tiên: không store / cache / sổ confirm giữa các lượt
+    os.environ.setdefault("ORDER_STORE", "off")
+    os.environ.setdefault("CACHE_BACKEND", "off")
+    os.environ.setdefault("CONFIRM_IDEMPOTENCY_TTL_S", "0")
+    import api.index as app_module
+
+    corpus = app_module.get_replay_corpus()
+    print(f"corpus={corpus.path} exchanges={len(corpus)} inbound={len(corpus.inbound)} repeat={args.repeat}")
+    results = replay_inbound(app_module.app.test_client(), corpus.inbound, args.repeat)
+    for path, s in summarize(results).items():
+        print(f"  {path:<28} n={s['n']:<4} wall p50 {s['wall_p50_ms']:>8} ms  p95 {s['wall_p95_ms']:>8} ms  "
+              f"cpu {s['cpu_avg_ms']:>7} ms  (ghi: p50 {s['recorded_p50_ms']} ms)  status khác: {s['status_mismatch']}")
+    print(f"  replay miss: {corpus.misses}")
+
+
+if __name__ == "__main__":
+    main()
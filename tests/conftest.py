@@ -0,0 +1,98 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("ORDER_STORE", "off")
+os.environ.setdefault("CACHE_BACKEND", "off")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import api.index as index  # noqa: E402
+
+DELIVERED, SHIPPING, CANCELLED = "delivered", "shipping", "cancel"
+
+
+def order_detail(order_id: int, kind: str = DELIVERED) -> dict:
+    """Body get_order_detail rút gọn, đủ key cho các extractor."""
+    d = {"error": 0, "data": {
+        "info_card": {"final_total": 12300000, "order_sn": f"SN{order_id}"},
+        "shop_info": {"username": "shopx", "shop_id": 99},
+        "status": {"header_text": {"text": "label_order_delivered" if kind == DELIVERED else "label_order_to_ship"}},
+        "recipient_address": {"name": "Ng", "phone": "0900", "full_address": "HN"},
+        "items": [{"name": "Áo", "image": "abcdefghijklmnopqrstuvwxyz"}],
+        "tracking_info": {
+            "description": {DELIVERED: "Giao hàng thành công", CANCELLED: "Đã hủy"}.get(kind, "Đang vận chuyển"),
+            "tracking_number": f"VN{order_id}",
+        },
+        "processing_info": {"logs": [{"ctime": 1700000000 + i * 3600, "description": f"ev {i}"} for i in range(3)]},
+        "create_time": 1699990000,
+    }}
+    if kind == CANCELLED:
+        d["data"]["cancel_info"] = {"cancel_by": "buyer", "reason": "Người mua hủy"}
+    return d
+
+
+class FakeShopee:
+    """Thay http_get / http_post: mỗi cookie có list đơn riêng; cookie nằm trong `dead` thì account trả lỗi."""
+
+    def __init__(self, orders=None, dead=(), kinds=(DELIVERED,)):
+        self.orders = orders or {}
+        self.dead = set(dead)
+        self.kinds = kinds
+        self.calls = {"get": 0, "post": 0}
+        self.confirmed = []
+
+    @staticmethod
+    def _session(headers) -> str:
+        cookie = (headers or {}).get("Cookie") or (headers or {}).get("cookie") or ""
+        return index.cookie_map(cookie).get("SPC_ST", "")
+
+    def get(self, url, headers, params=None, timeout=12, **kw):
+        self.calls["get"] += 1
+        st = self._session(headers)
+        if st in self.dead:
+            return 403, {"error": 19, "error_msg": "not login"}
+        if "get_account_info" in url:
+            return 200, {"error": 0, "data": {"username": f"user_{st}", "userid": 1}}
+        if "get_all_order" in url:
+            ids = self.orders.get(st, [1000, 1001])[: params["limit"]]
+            return 200, {"data": {"order_data": {"details_list": [{"info_card": {"order_id": i}} for i in ids]}}}
+        if "get_order_detail" in url:
+            oid = int(params["order_id"])
+            return 200, order_detail(oid, self.kinds[oid % len(self.kinds)])
+        return 404, {}
+
+    def post(self, url, headers, payload=None, timeout=12, **kw):
+        self.calls["post"] += 1
+        self.confirmed.append(str(payload["order_id"]))
+        return 200, {"error": 0}
+
+
+@pytest.fixture
+def shopee(monkeypatch):
+    fake = FakeShopee()
+    monkeypatch.setattr(index, "http_get", fake.get)
+    monkeypatch.setattr(index, "http_post", fake.post)
+    monkeypatch.setattr(index, "CONFIRM_LEDGER", None)
+    return fake
+
+
+@pytest.fixture
+def client():
+    return index.app.test_client()
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """Server Shopee giả local (tests/stub_shopee.py), các URL Shopee trỏ về nó."""
+    from stub_shopee import start_stub
+    server = start_stub()
+    base = f"http://127.0.0.1:{server.server_address[1]}/api/v4"
+    monkeypatch.setattr(index, "CHECK_URL", f"{base}/account/basic/get_account_info")
+    monkeypatch.setattr(index, "ORDER_LIST_URL", f"{base}/order/get_all_order_and_checkout_list")
+    monkeypatch.setattr(index, "ORDER_DETAIL_URL", f"{base}/order/get_order_detail")
+    monkeypatch.setattr(index, "SHOPEE_CONFIRM_URL", f"{base}/order/action/confirm_order_delivered/")
+    monkeypatch.setattr(index, "CONFIRM_LEDGER", None)
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,60 @@
+"""Server RESP (Redis) tối thiểu chạy local: GET / SET PX / DEL / AUTH / SELECT, đếm kết nối, có thể làm chậm GET."""
+import socketserver
+import threading
+import time
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _args(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            n = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(n + 2)[:-2])
+        return args
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        while True:
+            args = self._args()
+            if args is None:
+                return
+            cmd = args[0].upper()
+            server.commands.append(cmd.decode())
+            if cmd == b"GET":
+                time.sleep(server.get_delay)
+                hit = server.data.get(args[1])
+                if hit is None or hit[1] <= time.time():
+                    self.wfile.write(b"$-1\r\n")
+                else:
+                    self.wfile.write(b"$%d\r\n%s\r\n" % (len(hit[0]), hit[0]))
+            elif cmd == b"SET":
+                ttl = int(args[4]) / 1000 if len(args) > 4 and args[3].upper() == b"PX" else 1e9
+                server.data[args[1]] = (args[2], time.time() + ttl)
+                self.wfile.write(b"+OK\r\n")
+            elif cmd == b"DEL":
+                self.wfile.write(b":%d\r\n" % (1 if server.data.pop(args[1], None) else 0))
+            elif cmd == b"AUTH":
+                ok = args[-1].decode() == server.password
+                self.wfile.write(b"+OK\r\n" if ok else b"-WRONGPASS invalid password\r\n")
+            elif cmd == b"SELECT":
+                self.wfile.write(b"+OK\r\n")
+            else:
+                self.wfile.write(b"-ERR unknown command\r\n")
+
+
+def start_resp_server(password: str = ""):
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.commands = []
+    server.data = {}
+    server.get_delay = 0.0
+    server.password = password
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
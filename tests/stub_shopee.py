@@ -0,0 +1,57 @@
+"""Server Shopee giả chạy local (HTTP/1.1 keep-alive), đếm số kết nối TCP và số request."""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from conftest import order_detail
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _reply(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        url = urlparse(self.path)
+        q = parse_qs(url.query)
+        if url.path.endswith("get_account_info"):
+            return self._reply({"error": 0, "data": {"username": "stub", "userid": 7}})
+        if url.path.endswith("get_all_order_and_checkout_list"):
+            n = int(q.get("limit", ["5"])[0])
+            return self._reply({"data": {"details_list": [{"info_card": {"order_id": 1000 + i}} for i in range(n)]}})
+        if url.path.endswith("get_order_detail"):
+            return self._reply(order_detail(int(q["order_id"][0])))
+        return self._reply({"error": 404}, 404)
+
+    def do_POST(self):
+        with self.server.lock:
+            self.server.requests += 1
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        return self._reply({"error": 0})
+
+
+def start_stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
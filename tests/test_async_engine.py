@@ -0,0 +1,64 @@
+import pytest
+
+import api.index as index
+
+pytestmark = pytest.mark.skipif(index.aiohttp_module() is None, reason="aiohttp chưa cài")
+
+
+def strip_timing(body: dict) -> dict:
+    return {k: v for k, v in body.items() if k not in ("elapsed", "pipeline", "engine")}
+
+
+def test_async_engine_matches_sync(stub, client):
+    payload = {"cookie": "SPC_ST=a; csrftoken=z"}
+    sync = client.post("/api/check-cookie", json=payload).get_json()
+    async_ = client.post("/api/check-cookie", json=dict(payload, engine="async")).get_json()
+    assert async_["data_list"] == sync["data_list"]
+    assert async_["count"] == sync["count"] == 4
+
+    bulk = {"cookies": ["SPC_ST=a", "SPC_ST=b"], "order_limit": 3}
+    sync = client.post("/api/confirm-received-sll", json=bulk).get_json()
+    async_ = client.post("/api/confirm-received-sll", json=dict(bulk, engine="async")).get_json()
+    assert async_["engine"] == "async"
+    assert strip_timing(async_) == strip_timing(sync)
+    assert async_["confirmed_count"] == 6
+
+
+def test_async_engine_reuses_connections_across_requests(stub, client):
+    payload = {"cookie": "SPC_ST=a; csrftoken=z", "engine": "async", "use_store": False}
+    assert client.post("/api/check-cookie", json=payload).status_code == 200
+    opened, requests = stub.connections, stub.requests
+    for _ in range(5):
+        assert client.post("/api/check-cookie", json=payload).status_code == 200
+    assert stub.requests - requests == 5 * 7          # account + list + 5 detail mỗi lần
+    assert stub.connections - opened <= 1             # pool của session dùng chung, không mở lại
+
+
+def on_loop() -> bool:
+    import asyncio
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def test_async_record_and_replay_stay_off_the_event_loop(stub, client, monkeypatch, tmp_path):
+    path = str(tmp_path / "corpus.jsonl.gz")
+    payload = {"cookie": "SPC_ST=a; csrftoken=z", "engine": "async", "use_store": False}
+    recorder, seen = index.ExchangeRecorder(path), []
+    record = recorder.record
+    monkeypatch.setattr(recorder, "record", lambda *a: (seen.append(on_loop()), record(*a))[1])
+    monkeypatch.setattr(index, "HTTP_TRANSPORT", "record")
+    monkeypatch.setattr(index, "_recorder", recorder)
+    assert client.post("/api/check-cookie", json=payload).status_code == 200
+    recorder.close()
+    assert seen and not any(seen)
+
+    corpus, seen = index.ReplayCorpus(path), []
+    monkeypatch.setattr(index, "HTTP_TRANSPORT", "replay")
+    monkeypatch.setattr(index, "REPLAY_LATENCY_SCALE", 0.0)
+    monkeypatch.setattr(index, "get_replay_corpus", lambda: (seen.append(on_loop()), corpus)[1])
+    # cookie trong corpus đã đổi sang cookie tổng hợp -> gửi lại đúng body đã ghi
+    assert client.post("/api/check-cookie", json=corpus.inbound[0]["b"]).get_json()["count"] == 4
+    assert seen and not any(seen) and corpus.misses == 0
@@ -0,0 +1,22 @@
+import time
+
+import api.index as index
+
+
+def test_first_result_counts_order_results_not_first_task():
+    pipeline = index.BulkPipeline({name: 2 for name in index.PIPELINE_STAGES})
+
+    def classify(slot):
+        time.sleep(0.05)
+        pipeline.mark_result(slot)
+
+    def listed(slot, has_orders):
+        if has_orders:
+            pipeline.submit("classify", slot, lambda: classify(slot))
+
+    # slot 0: cookie không có đơn -> không có kết quả; slot 1: kết quả đầu tiên sau ~50ms
+    pipeline.submit("list", 0, lambda: listed(0, False))
+    pipeline.submit("list", 1, lambda: listed(1, True))
+    pipeline.run()
+    first = pipeline.stats()["first_result_ms"]
+    assert first["p50"] >= 50 and first["max"] >= 50
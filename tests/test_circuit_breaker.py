@@ -0,0 +1,31 @@
+import api.index as index
+
+
+def tripped(monkeypatch):
+    monkeypatch.setattr(index, "BREAKER_MIN_CALLS", 2)
+    monkeypatch.setattr(index, "BREAKER_OPEN_S", 0)
+    b = index.CircuitBreaker("get_order_list")
+    late = b.allow()
+    for _ in range(2):
+        b.record(b.allow(), 500, 0.1)
+    assert b.state == "open"
+    return b, late
+
+
+def test_late_call_does_not_close_half_open_breaker(monkeypatch):
+    b, late = tripped(monkeypatch)
+    probe = b.allow()
+    assert probe is not None and b.state == "half_open"
+    b.record(late, 200, 0.1)
+    assert b.state == "half_open" and b.allow() is None
+    b.record(probe, 200, 0.1)
+    assert b.state == "closed" and b.calls == 4
+
+
+def test_late_failure_does_not_retrip_half_open_breaker(monkeypatch):
+    b, late = tripped(monkeypatch)
+    probe = b.allow()
+    b.record(late, 0, 0.1)
+    assert b.state == "half_open" and b.opened == 1
+    b.record(probe, 500, 0.1)
+    assert b.state == "open" and b.opened == 2
@@ -0,0 +1,18 @@
+import api.index as index
+
+
+def confirm(client, cookie, order_id="1000"):
+    return client.post("/api/confirm-order", json={"cookie": cookie, "order_id": order_id}).get_json()
+
+
+def test_replay_is_keyed_on_session_token(shopee, client, monkeypatch):
+    monkeypatch.setattr(index, "CONFIRM_LEDGER", index.ConfirmLedger())
+    owner = "SPC_U=42; SPC_ST=owner"
+    assert confirm(client, owner)["replayed"] is False
+    assert confirm(client, owner)["replayed"] is True
+    assert shopee.calls["post"] == 1
+
+    # cùng SPC_U nhưng token khác (tự đặt) -> không được trả lại kết quả / payload của chủ tài khoản
+    forged = confirm(client, "SPC_U=42; SPC_ST=forged")
+    assert forged["replayed"] is False
+    assert shopee.calls["post"] == 2
@@ -0,0 +1,54 @@
+import csv
+import io
+
+import api.index as index
+
+COOKIE = {"cookie": "SPC_ST=a; csrftoken=z"}
+SHEET = {"export": "sheet", "sheet": {"spreadsheet_id": "SID", "range": "Orders!A1"}}
+
+
+class FakeWriter:
+    def __init__(self):
+        self.writes = []
+
+    def write(self, spreadsheet_id, start, table, min_rows=0):
+        self.writes.append(spreadsheet_id)
+        return {"ok": True, "spreadsheet_id": spreadsheet_id}
+
+
+def test_csv_cells_cannot_start_formulas(shopee, client, monkeypatch):
+    get = index.http_get
+
+    def evil_shop(url, headers, params=None, timeout=12, **kw):
+        status, body = get(url, headers, params, timeout, **kw)
+        if "get_order_detail" in url:
+            body["data"]["shop_info"]["username"] = '=HYPERLINK("http://x","y")'
+        return status, body
+
+    monkeypatch.setattr(index, "http_get", evil_shop)
+    resp = client.post("/api/check-cookie", json=dict(COOKIE, export="csv"))
+    rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+    assert rows[0]["shop_username"] == '\'=HYPERLINK("http://x","y")'
+    assert [index.csv_safe(v) for v in ("+1", "-2", "@a", "ok", -3)] == ["'+1", "'-2", "'@a", "ok", -3]
+
+
+def test_sheet_export_requires_secret_or_allowlist(shopee, client, monkeypatch):
+    writer = FakeWriter()
+    monkeypatch.setattr(index, "SHEETS_WRITER", writer)
+    bulk = {"cookies": ["SPC_ST=a"], "order_limit": 3}
+
+    # chưa cấu hình -> tắt hẳn, không gọi Shopee
+    for path, body in (("/api/check-cookie", COOKIE), ("/api/confirm-received-sll", bulk)):
+        assert client.post(path, json=dict(body, **SHEET)).status_code == 403
+    assert shopee.calls == {"get": 0, "post": 0}
+
+    monkeypatch.setattr(index, "SHEETS_ALLOWED_IDS", frozenset({"SID"}))
+    other = dict(SHEET, sheet={"spreadsheet_id": "someone-elses-sheet"})
+    assert client.post("/api/check-cookie", json=dict(COOKIE, **other)).status_code == 403
+    assert client.post("/api/check-cookie", json=dict(COOKIE, **SHEET)).get_json()["sheet"]["ok"] is True
+
+    monkeypatch.setattr(index, "SHEETS_EXPORT_SECRET", "s3cret")
+    assert client.post("/api/check-cookie", json=dict(COOKIE, **SHEET)).status_code == 403
+    resp = client.post("/api/check-cookie", json=dict(COOKIE, **SHEET), headers={"X-Sheets-Secret": "s3cret"})
+    assert resp.status_code == 200
+    assert writer.writes == ["SID", "SID"]
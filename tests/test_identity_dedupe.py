@@ -0,0 +1,40 @@
+import api.index as index
+
+
+def bulk(client, cookies, **extra):
+    resp = client.post("/api/confirm-received-sll", json=dict({"cookies": cookies, "order_limit": 3}, **extra))
+    assert resp.status_code == 200
+    return resp.get_json()
+
+
+def test_dead_alias_is_not_reported_live(shopee, client):
+    shopee.dead = {"dead1"}
+    body = bulk(client, ["SPC_U=42; SPC_ST=dead1", "SPC_U=42; SPC_ST=live1", "SPC_U=7; SPC_ST=other"])
+    dead, live, other = body["cookie_rows"]
+    assert dead["live"] is False and dead["alias_of"] == 2
+    assert dead["confirmed_count"] == 0 and "not login" in dead["note"]
+    assert live["live"] is True and live["alias_of"] is None and live["confirmed_count"] == 2
+    assert other["live"] is True
+    assert (body["live_count"], body["die_count"]) == (2, 1)
+    # đơn chỉ lấy từ cookie chính, không nhân đôi theo alias
+    assert [r["cookie_preview"] for r in body["order_rows"]].count("SPC_U=42; SPC_ST=live1") == 2
+    assert body["confirmed_count"] == 4
+
+
+def test_untried_alias_follows_primary(shopee, client):
+    body = bulk(client, ["SPC_U=42; SPC_ST=live1", "SPC_U=42; SPC_ST=live2"])
+    primary, alias = body["cookie_rows"]
+    assert primary["live"] is True and alias["live"] is True
+    assert alias["alias_of"] == 1 and alias["confirmed_count"] == 0
+    assert shopee.confirmed == ["1000", "1001"]
+
+
+def test_detail_cache_is_not_shared_by_spoofed_spc_u(shopee, monkeypatch):
+    monkeypatch.setattr(index, "CACHE_BACKEND", "memory")
+    monkeypatch.setattr(index, "_cache_backend", index.MemoryCache())
+    shopee.dead = {"other"}
+    owner = index.fetch_order_detail_by_id("SPC_U=42; SPC_ST=live1", "1000")
+    assert index.detail_result_ok(owner)
+    # cùng SPC_U (client tự đặt được) nhưng phiên khác -> không được nhận detail đã cache của phiên kia
+    spoofed = index.fetch_order_detail_by_id("SPC_U=42; SPC_ST=other", "1000")
+    assert not index.detail_result_ok(spoofed)
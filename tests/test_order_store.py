@@ -0,0 +1,105 @@
+import json
+import sqlite3
+
+import api.index as index
+
+
+class LockedConnection:
+    """sqlite3 connection giả: mọi lệnh đều gặp "database is locked"."""
+
+    def execute(self, *args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    def commit(self):
+        raise sqlite3.OperationalError("database is locked")
+
+    def rollback(self):
+        pass
+
+
+def locked_store(tmp_path):
+    store = index.OrderStateStore(str(tmp_path / "store.sqlite3"))
+    store._conn = LockedConnection()
+    return store
+
+
+def test_store_errors_are_swallowed(tmp_path):
+    store = locked_store(tmp_path)
+    assert store.get("id", "1") is None
+    assert store.get_final("id", "1") is None
+    assert store.put("id", "1", "delivered", {"a": 1}) is None
+    assert store.errors == 3
+
+
+def test_routes_survive_locked_store(tmp_path, monkeypatch, shopee, client):
+    store = locked_store(tmp_path)
+    monkeypatch.setattr(index, "get_order_store", lambda: store)
+
+    r = client.post("/api/check-cookie", json={"cookie": "SPC_ST=a; csrftoken=z"})
+    assert r.status_code == 200
+    assert r.get_json()["count"] == 2
+
+    r = client.post("/api/confirm-received-sll", json={"cookies": ["SPC_ST=a", "SPC_ST=b"]})
+    body = r.get_json()
+    assert r.status_code == 200
+    assert body["confirmed_count"] == 4
+    assert sorted(row["state"] for row in body["order_rows"]) == ["success"] * 4
+    assert store.errors > 0
+
+
+def test_full_raw_is_not_served_from_pruned_store(tmp_path, monkeypatch, shopee, client):
+    store = index.OrderStateStore(str(tmp_path / "store.sqlite3"))
+    monkeypatch.setattr(index, "get_order_store", lambda: store)
+    monkeypatch.setattr(index, "DETAIL_PRUNE", True)
+    detail = index.http_get
+
+    def with_extra(url, headers, params=None, timeout=12, **kw):
+        status, body = detail(url, headers, params, timeout, **kw)
+        if "get_order_detail" in url:
+            body["data"]["extra_blob"] = {"kept": "only in full raw"}
+        return status, body
+
+    monkeypatch.setattr(index, "http_get", with_extra)
+    cookie = {"cookie": "SPC_ST=a; csrftoken=z"}
+    first = client.post("/api/check-cookie", json=cookie).get_json()
+    assert "extra_blob" not in first["data_list"][0]["shopee_raw"]["data"]
+
+    cached = client.post("/api/check-cookie", json=cookie).get_json()
+    assert cached["store_hits"] == 2
+    assert "extra_blob" not in cached["data_list"][0]["shopee_raw"]["data"]
+
+    full = client.post("/api/check-cookie", json=dict(cookie, include_raw="full")).get_json()
+    assert full["store_hits"] == 0
+    assert all(d["shopee_raw"]["data"]["extra_blob"] for d in full["data_list"])
+
+
+def test_full_raw_with_nan_body_is_valid_json(shopee, client, monkeypatch):
+    detail = index.http_get
+
+    def nan_body(url, headers, params=None, timeout=12, **kw):
+        status, body = detail(url, headers, params, timeout, **kw)
+        if "get_order_detail" in url:
+            data = b'{"price_ratio": NaN, ' + json.dumps(body).encode("utf-8")[1:]
+            return index.decode_upstream_body(status, "application/json", data, False)
+        return status, body
+
+    def reject(token):
+        raise ValueError(token)
+
+    monkeypatch.setattr(index, "http_get", nan_body)
+    resp = client.post("/api/check-cookie", json={"cookie": "SPC_ST=a; csrftoken=z", "include_raw": "full"})
+    body = json.loads(resp.get_data(), parse_constant=reject)
+    assert body["data_list"][0]["shopee_raw"]["price_ratio"] is None
+
+
+def test_full_raw_is_not_answered_with_summary_etag(shopee, client):
+    cookie = {"cookie": "SPC_ST=a; csrftoken=z"}
+    summary = client.post("/api/check-cookie", json=cookie)
+    etag = summary.headers["ETag"]
+    assert client.post("/api/check-cookie", json=cookie, headers={"If-None-Match": etag}).status_code == 304
+
+    full = client.post("/api/check-cookie", json=dict(cookie, include_raw="full"), headers={"If-None-Match": etag})
+    assert full.status_code == 200 and full.headers["ETag"] != etag
+    again = client.post("/api/check-cookie", json=dict(cookie, include_raw="full"),
+                        headers={"If-None-Match": full.headers["ETag"]})
+    assert again.status_code == 200 and again.get_json()["data_list"]
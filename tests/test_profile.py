@@ -0,0 +1,24 @@
+import api.index as index
+
+PROFILE = {"X-Profile": "s3cret", "X-Profile-Top": "5"}
+
+
+def check(client):
+    return client.post("/api/check-cookie", json={"cookie": "SPC_ST=a"}, headers=PROFILE)
+
+
+def test_overlapping_profile_is_rejected(shopee, client, monkeypatch):
+    monkeypatch.setattr(index, "PROFILE_SECRET", "s3cret")
+    other = index.ProfileSession()
+    other.start()           # request khác đang được profile
+    try:
+        resp = check(client)
+        assert resp.status_code == 409
+        assert "profile" in resp.get_json()["error"].lower()
+    finally:
+        other.stop()
+
+    resp = check(client)
+    assert resp.status_code == 200
+    assert resp.get_json()["_profile"]["wall_ms"] > 0
+    assert check(client).status_code == 200      # session trước đã nhả lock
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import pytest
+
+import api.index as index
+from resp_server import start_resp_server
+
+
+@pytest.fixture
+def resp():
+    server = start_resp_server(password="pw")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def redis_url(server, db: int = 2) -> str:
+    return f"redis://:pw@127.0.0.1:{server.server_address[1]}/{db}"
+
+
+def test_resp_client_roundtrip(resp):
+    cache = index.RedisCache(redis_url(resp))
+    assert cache.get("k") is None
+    cache.set("k", "giá trị", ttl=30)
+    assert cache.get("k") == "giá trị"
+    cache.set("short", "x", ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get("short") is None
+    cache.delete("k")
+    assert cache.get("k") is None
+    assert resp.commands[:2] == ["AUTH", "SELECT"]
+    assert resp.connections == 1          # kết nối được giữ lại trong pool
+
+
+def test_resp_errors_become_cache_errors(resp, monkeypatch):
+    with pytest.raises(index.CacheError):
+        index.RedisCache(f"redis://:wrong@127.0.0.1:{resp.server_address[1]}/0").get("k")
+    port = resp.server_address[1]
+    resp.shutdown()
+    resp.server_close()
+    down = index.RedisCache(f"redis://127.0.0.1:{port}/0", timeout=0.2)
+    with pytest.raises(index.CacheError):
+        down.get("k")
+    monkeypatch.setattr(index, "CACHE_BACKEND", "redis")
+    monkeypatch.setattr(index, "_cache_backend", down)
+    ns = index.CacheNamespace("account", 60)
+    assert ns.get("k") is None            # namespace coi lỗi backend là miss
+    assert ns.stats["errors"] == 1
+
+
+def test_async_cache_get_does_not_block_loop(resp, monkeypatch):
+    monkeypatch.setattr(index, "CACHE_BACKEND", "redis")
+    monkeypatch.setattr(index, "_cache_backend", index.RedisCache(redis_url(resp)))
+    ctx = index.as_cookie_context("SPC_U=1; SPC_ST=a")
+    info = {"live": True, "user": {"username": "u"}}
+    index.ACCOUNT_CACHE.set(index.account_cache_key(ctx), info)
+    assert index.ACCOUNT_CACHE.blocking
+    resp.get_delay = 0.2
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.ensure_future(ticker())
+        hit = await index.fetch_shopee_account_info_async(None, ctx)   # cache hit: không cần HTTP client
+        task.cancel()
+        return hit, ticks
+
+    hit, ticks = asyncio.run(main())
+    assert hit == info
+    assert ticks >= 10                    # loop vẫn chạy trong lúc GET chờ Redis
@@ -0,0 +1,45 @@
+import gzip
+import os
+import sys
+
+import api.index as index
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench"))
+from replay_corpus import replay_inbound  # noqa: E402
+
+COOKIES = ["SPC_U=42; SPC_ST=realtoken-a; csrftoken=x", "SPC_U=42; SPC_ST=realtoken-b", "SPC_U=7; SPC_ST=realtoken-c"]
+
+
+def counts(body: dict) -> dict:
+    keys = ("ok", "total", "live_count", "die_count", "alias_count", "delivered_count", "confirmed_count", "count")
+    out = {k: body[k] for k in keys if k in body}
+    out["orders"] = [r.get("order_id") for r in body.get("order_rows") or body.get("data_list") or []]
+    return out
+
+
+def test_recorded_traffic_replays_without_network(stub, client, monkeypatch, tmp_path):
+    path = str(tmp_path / "corpus.jsonl.gz")
+    monkeypatch.setattr(index, "HTTP_TRANSPORT", "record")
+    monkeypatch.setattr(index, "_recorder", index.ExchangeRecorder(path))
+    recorded = [
+        client.post("/api/check-cookie", json={"cookie": COOKIES[0]}).get_json(),
+        client.post("/api/confirm-received-sll", json={"cookies": COOKIES, "order_limit": 3}).get_json(),
+    ]
+    index._recorder.close()
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        text = f.read()
+    assert "realtoken" not in text and "SPC_U=42" not in text
+
+    stub.shutdown()        # replay không được gọi mạng
+    corpus = index.ReplayCorpus(path)
+    assert [e["in"] for e in corpus.inbound] == ["/api/check-cookie", "/api/confirm-received-sll"]
+    monkeypatch.setattr(index, "HTTP_TRANSPORT", "replay")
+    monkeypatch.setattr(index, "REPLAY_LATENCY_SCALE", 0.0)
+    monkeypatch.setattr(index, "_replay_corpus", corpus)
+    results = replay_inbound(client, corpus.inbound)
+
+    assert corpus.misses == 0
+    assert [r["status"] for r in results] == [r["recorded_status"] for r in results] == [200, 200]
+    assert [counts(r["body"]) for r in results] == [counts(b) for b in recorded]
+    # nhóm cookie cùng tài khoản giữ nguyên sau khi đổi sang cookie tổng hợp
+    assert [r["alias_of"] for r in results[1]["body"]["cookie_rows"]] == [None, 1, None]
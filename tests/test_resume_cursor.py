@@ -0,0 +1,20 @@
+import api.index as index
+
+
+def test_confirm_without_response_is_retried_via_cursor(shopee, client, monkeypatch):
+    def flaky(url, headers, payload=None, timeout=12, **kw):
+        if str(payload["order_id"]) == "1001":
+            return 0, {"error": "Read timed out."}
+        return shopee.post(url, headers, payload, timeout, **kw)
+
+    monkeypatch.setattr(index, "http_post", flaky)
+    body = {"cookies": ["SPC_ST=a"], "order_limit": 3}
+    first = client.post("/api/confirm-received-sll", json=body).get_json()
+    assert first["partial"] is True and first["cursor"]
+    assert first["confirmed_count"] == 1 and first["failed_count"] == 1
+    assert first["order_rows"][1]["api_data"]["no_response"] is True
+
+    monkeypatch.setattr(index, "http_post", shopee.post)
+    second = client.post("/api/confirm-received-sll", json=dict(body, cursor=first["cursor"])).get_json()
+    assert second["partial"] is False and second["cursor"] is None
+    assert shopee.confirmed == ["1000", "1001"]
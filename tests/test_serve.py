@@ -0,0 +1,32 @@
+import importlib.util
+
+import pytest
+
+import api.index as index
+
+
+@pytest.fixture
+def launched(monkeypatch):
+    calls = []
+    monkeypatch.setattr(index, "_serve_gunicorn", lambda workers, threads: calls.append("gunicorn"))
+    monkeypatch.setattr(index, "_serve_waitress", lambda threads: calls.append("waitress"))
+    return calls
+
+
+def fake_find_spec(installed):
+    return lambda name, *a: object() if name in installed else None
+
+
+def test_auto_picks_installed_server(launched, monkeypatch):
+    monkeypatch.setattr(importlib.util, "find_spec", fake_find_spec({"gunicorn", "waitress"}))
+    index.serve(server="auto")
+    monkeypatch.setattr(importlib.util, "find_spec", fake_find_spec({"waitress"}))
+    index.serve(server="auto")
+    assert launched == (["gunicorn", "waitress"] if index.os.name == "posix" else ["waitress", "waitress"])
+
+
+def test_missing_server_exits_with_install_hint(launched, monkeypatch):
+    monkeypatch.setattr(importlib.util, "find_spec", fake_find_spec(set()))
+    with pytest.raises(SystemExit, match="requirements-server.txt"):
+        index.serve(server="gunicorn")
+    assert launched == []